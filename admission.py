@@ -0,0 +1,138 @@
+from collections import deque
+from bisect import bisect_left
+from threading import Lock
+from math import ceil
+from time import time
+
+from metrics import LENGTH_BUCKETS
+
+
+class AdmissionControl:
+    """
+    Допуск запросов в обработку по стоимости.
+
+    Стоимость запроса - его длина в токенах, умноженная на ожидаемую стоимость декодирования одного токена.
+    Сумма стоимостей запросов в обработке ограничена общим бюджетом, а запросы каждой группы длин
+    могут занимать не больше своей доли бюджета, чтобы длинные запросы не вытесняли короткие.
+    Отклонённому запросу сообщается, через сколько секунд повторить его, исходя из скорости,
+    с которой завершаются запросы в обработке
+    """
+    def __init__(self, budget=None, max_tasks=None, decode_cost=1.0, bucket_bounds=LENGTH_BUCKETS, bucket_share=1.0,
+                 window=10.0, max_retry_after=60):
+        """
+        :param budget: общий бюджет стоимости запросов в обработке, None - без ограничения
+        :param max_tasks: максимальное количество запросов в обработке, None - без ограничения
+        :param decode_cost: ожидаемая стоимость декодирования в расчёте на токен запроса
+        :param bucket_bounds: верхние границы длин групп по возрастанию
+        :param bucket_share: доля бюджета, доступная запросам одной группы длин
+        :param window: интервал в секундах, по которому оценивается скорость завершения запросов
+        :param max_retry_after: наибольшее время до повтора в секундах
+        """
+        self.budget = budget
+        self.max_tasks = max_tasks
+        self.decode_cost = decode_cost
+        self.bucket_bounds = bucket_bounds
+        self.bucket_budget = None if budget is None else budget * bucket_share
+        self.window = window
+        self.max_retry_after = max_retry_after
+
+        self.lock = Lock()
+        self.in_use = 0
+        self.tasks = 0
+        # стоимость запросов в обработке для каждой группы длин и за последней границей
+        self.buckets = [0] * (len(bucket_bounds) + 1)
+        # завершённые запросы за последние window секунд: (время, стоимость)
+        self.completed = deque()
+        self.rejected = 0
+
+    def units(self, length):
+        """
+        Стоимость запроса длины length
+        """
+        return max(length, 1) * self.decode_cost
+
+    def bucket(self, length):
+        return bisect_left(self.bucket_bounds, length)
+
+    def acquire(self, lengths):
+        """
+        Допускает в обработку все запросы с длинами lengths или ни одного
+        :return: None, если запросы допущены, иначе рекомендуемое время до повтора в секундах
+        """
+        units = [self.units(length) for length in lengths]
+        requested = {}
+        for length, cost in zip(lengths, units):
+            idx = self.bucket(length)
+            requested[idx] = requested.get(idx, 0) + cost
+
+        with self.lock:
+            now = time()
+            # превышение каждого из ограничений: (избыток, единица избытка - стоимость или количество запросов)
+            excess = []
+            if self.max_tasks is not None and self.tasks + len(lengths) > self.max_tasks:
+                excess.append((self.tasks + len(lengths) - self.max_tasks, False))
+            if self.budget is not None:
+                # запрос дороже всего бюджета допускается, когда в обработке ничего нет
+                if self.in_use and self.in_use + sum(units) > self.budget:
+                    excess.append((self.in_use + sum(units) - self.budget, True))
+                for idx, cost in requested.items():
+                    # аналогично для доли группы
+                    if self.buckets[idx] and self.buckets[idx] + cost > self.bucket_budget:
+                        excess.append((self.buckets[idx] + cost - self.bucket_budget, True))
+            if excess:
+                self.rejected += len(lengths)
+                return max(self._retry_after(amount, by_units, now) for amount, by_units in excess)
+
+            self.in_use += sum(units)
+            self.tasks += len(lengths)
+            for idx, cost in requested.items():
+                self.buckets[idx] += cost
+            return None
+
+    def release(self, length, completed=True):
+        """
+        Освобождает место запроса
+        :param completed: завершена ли обработка запроса; скорость учитывает только завершённые запросы
+        """
+        cost = self.units(length)
+        with self.lock:
+            self.in_use -= cost
+            self.tasks -= 1
+            self.buckets[self.bucket(length)] -= cost
+            if completed:
+                self.completed.append((time(), cost))
+
+    def _expire(self, now):
+        while self.completed and self.completed[0][0] < now - self.window:
+            self.completed.popleft()
+
+    def drain_rate(self, now=None):
+        """
+        Скорость завершения запросов за последние window секунд
+        :return: (стоимость в секунду, запросов в секунду)
+        """
+        now = time() if now is None else now
+        self._expire(now)
+        if not self.completed:
+            return 0.0, 0.0
+        return sum(cost for _, cost in self.completed) / self.window, len(self.completed) / self.window
+
+    def _retry_after(self, amount, by_units, now):
+        """
+        Время, за которое при текущей скорости завершится избыток amount
+        """
+        units_rate, tasks_rate = self.drain_rate(now)
+        rate = units_rate if by_units else tasks_rate
+        if rate <= 0:
+            return self.max_retry_after
+        return min(max(ceil(amount / rate), 1), self.max_retry_after)
+
+    def stats(self):
+        with self.lock:
+            units_rate, tasks_rate = self.drain_rate()
+            return {
+                'units': self.in_use,
+                'tasks': self.tasks,
+                'rejected': self.rejected,
+                'drain_rate': units_rate,
+            }
@@ -0,0 +1,178 @@
+from processor import BaseProcessor, ProcessingQueueOverflowException, UnknownModelException
+from server import InvalidRequestSizeException, parse_bulk_queries, bulk_line, overload_headers, \
+    request_class, request_model, wants_events, stream_event
+from workers.model import ModelLoadingError
+import asyncio
+from aiohttp import web
+
+
+class AsyncServer:
+    """
+    Класс, занимающийся принятием и отправкой http запросов в цикле событий asyncio
+    """
+    def __init__(self, processor: BaseProcessor, host='localhost', port=2532, timeout=5, max_query_len=50,
+                 max_bulk_size=500):
+        self.app = web.Application(middlewares=[self.overloaded])
+        self.timeout = timeout
+        self.host = host
+        self.port = port
+        self.max_query_len = max_query_len
+        self.max_bulk_size = max_bulk_size
+        self.register_callbacks()
+        self.processor = processor
+
+    def register_callbacks(self):
+        """
+        Привязывает обработчик http запросов к пути запроса
+        """
+        self.app.router.add_get('/', self.get_query)
+        self.app.router.add_post('/bulk', self.post_queries)
+        self.app.router.add_get('/stream', self.get_stream)
+        self.app.router.add_get('/metrics', self.get_metrics)
+        self.app.router.add_get('/ready', self.get_ready)
+        self.app.router.add_post('/reload', self.post_reload)
+        self.app.router.add_get('/debug/traces', self.get_traces)
+        self.app.router.add_get('/debug/trace_events', self.get_trace_events)
+
+    @web.middleware
+    async def overloaded(self, request, handler):
+        """
+        Ответ на запрос, не допущенный в обработку: клиенту сообщается, когда повторить запрос.
+        Запрос к модели, которой нет в обработчике, получает ответ 404, неудачная перезагрузка модели - 500
+        """
+        try:
+            return await handler(request)
+        except ProcessingQueueOverflowException as e:
+            return web.Response(text=e.message, status=503, headers=overload_headers(e))
+        except UnknownModelException as e:
+            return web.Response(text=e.message, status=404)
+        except ModelLoadingError as e:
+            return web.Response(text=e.message, status=500)
+
+    async def get_ready(self, request):
+        """
+        Проверка готовности: 200, когда модели загружены и прогреты, иначе 503
+        """
+        if self.processor.ready():
+            return web.Response(text='ready')
+        return web.Response(text='not ready', status=503)
+
+    async def post_reload(self, request):
+        """
+        Перезагружает модель из её файла без остановки обработки; отвечает после перехода на новую модель
+        """
+        model = request_model(request.headers, request.query)
+        await asyncio.get_running_loop().run_in_executor(None, self.processor.reload, model)
+        return web.Response(text='reloaded')
+
+    async def get_query(self, request):
+        """
+        Обработчик запроса
+        """
+        query = request.query.get('query', '')
+        assert self.max_query_len >= len(query) > 0, InvalidRequestSizeException
+
+        priority, tenant = request_class(request.headers, request.query)
+        model = request_model(request.headers, request.query)
+        result = await self.processor.process_query_async(query, self.timeout, priority, tenant, model)
+
+        return web.Response(text=result)
+
+    async def get_stream(self, request):
+        """
+        Обработчик запроса с передачей результата частями по мере декодирования:
+        server-sent events, если клиент их принимает, иначе текст с chunked transfer encoding
+        """
+        query = request.query.get('query', '')
+        assert self.max_query_len >= len(query) > 0, InvalidRequestSizeException
+
+        priority, tenant = request_class(request.headers, request.query)
+        model = request_model(request.headers, request.query)
+        chunks = self.processor.stream_query_async(query, self.timeout, priority, tenant, model)
+
+        events = wants_events(request.headers.get('Accept'))
+        response = web.StreamResponse(headers={'Cache-Control': 'no-cache'} if events else None)
+        response.content_type = 'text/event-stream' if events else 'text/plain'
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        try:
+            async for chunk in chunks:
+                await response.write((stream_event(chunk) if events else chunk).encode())
+            if events:
+                await response.write(stream_event('', 'end').encode())
+        except asyncio.TimeoutError:
+            if events:
+                await response.write(stream_event('timeout', 'error').encode())
+        await response.write_eof()
+        return response
+
+    async def post_queries(self, request):
+        """
+        Обработчик группы запросов; результаты отправляются строками NDJSON по мере готовности
+        """
+        queries = parse_bulk_queries(await request.text(), request.content_type,
+                                     self.max_query_len, self.max_bulk_size)
+
+        priority, tenant = request_class(request.headers, request.query)
+        model = request_model(request.headers, request.query)
+        results = self.processor.process_queries_async(queries, self.timeout, priority, tenant, model)
+
+        response = web.StreamResponse()
+        response.content_type = 'application/x-ndjson'
+        await response.prepare(request)
+
+        done = set()
+        try:
+            async for index, result in results:
+                done.add(index)
+                await response.write(bulk_line(index, result).encode())
+        except TimeoutError:
+            for index in range(len(queries)):
+                if index not in done:
+                    await response.write(bulk_line(index, error='timeout').encode())
+        await response.write_eof()
+        return response
+
+    async def get_metrics(self, request):
+        """
+        Показатели обработки запросов в формате Prometheus
+        """
+        return web.Response(text=self.processor.metrics(), content_type='text/plain',
+                            headers={'X-Prometheus-Format': '0.0.4'})
+
+    async def get_traces(self, request):
+        """
+        Самые долгие из недавних трассировок запросов, количество задаётся параметром n
+        """
+        if self.processor.tracer is None:
+            return web.Response(text='tracing is disabled', status=404)
+        try:
+            n = int(request.query.get('n', 10))
+        except ValueError:
+            n = 10
+        return web.json_response(self.processor.tracer.slowest(n))
+
+    async def get_trace_events(self, request):
+        """
+        Недавние трассировки запросов в формате Chrome trace events
+        """
+        if self.processor.tracer is None:
+            return web.Response(text='tracing is disabled', status=404)
+        return web.json_response(self.processor.tracer.chrome_trace())
+
+    def run(self):
+        """
+        Запускает сервер
+        """
+        self.processor.start()
+        try:
+            # сервер не принимает запросы, если модель не удалось загрузить
+            self.processor.wait_loaded()
+        except ModelLoadingError:
+            self.processor.stop()
+            raise
+
+        web.run_app(self.app, host=self.host, port=self.port)
+
+        self.processor.stop()
@@ -0,0 +1,244 @@
+"""
+Сравнение стратегий группировки на одинаковом потоке запросов к DummyTestModel.
+
+Поток запросов - синтетический (пуассоновский или с всплесками) или записанный в файл JSONL.
+В режиме simulated этап группировки выполняется с виртуальным временем, результат детерминирован
+и получается за секунды; в режиме realtime запросы проходят через конвейер BaseProcessor в реальном времени.
+Результат - JSON со значениями пропускной способности, перцентилей задержки и доли дополнения для каждой стратегии
+
+Запуск: python benchmarks/batching_benchmark.py [--mode simulated|realtime] [--arrival poisson|bursty|trace]
+    [--rate QPS] [--duration S] [--trace FILE] [--strategies Naive,Simple,CostBased,Adaptive] [--output FILE]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+from concurrent.futures import Future, wait
+from contextlib import redirect_stdout
+from time import time, sleep
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_model'))
+
+from dummy_test_model import DummyTestModel
+from pipeline import Pipeline, ReplicatedWorker
+from processor import BaseProcessor
+from workers.adaptive import AdaptiveBatchGenerator
+from workers.batch_generation import NaiveBatchGenerator, TimeoutBatchGenerator, TimeoutCostBatchGenerator
+from workers.model import ModelApplier, batch_cells
+from simulation import simulate
+
+# распределение длин запросов из test_server.py: вес длины 1, 2, ...
+QUERY_LEN_WEIGHTS = [0, 42, 213, 462, 699, 878, 982, 1014, 987, 916, 816, 702, 586, 475, 374, 288, 216, 158, 113, 79]
+
+STRATEGIES = {
+    'Naive': lambda args: NaiveBatchGenerator(),
+    'Simple': lambda args: TimeoutBatchGenerator(args.batch_size, args.timeout),
+    'CostBased': lambda args: TimeoutCostBatchGenerator(args.batch_size, args.timeout, args.parallel_size),
+    'Adaptive': lambda args: AdaptiveBatchGenerator(args.batch_size, args.timeout, args.parallel_size,
+                                                    args.latency_slo),
+}
+
+
+def random_query(rng, max_len=None):
+    length = rng.choices(range(1, len(QUERY_LEN_WEIGHTS) + 1), QUERY_LEN_WEIGHTS)[0]
+    if max_len is not None:
+        length = min(length, max_len)
+    return ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(length))
+
+
+def poisson_arrivals(rate, duration, rng):
+    """
+    Пуассоновский поток интенсивности rate
+    :return: пары (время поступления, запрос)
+    """
+    arrivals = []
+    now = rng.expovariate(rate)
+    while now < duration:
+        arrivals.append((now, random_query(rng)))
+        now += rng.expovariate(rate)
+    return arrivals
+
+
+def bursty_arrivals(rate, duration, rng, burst_factor=4, burst_fraction=0.2, period=1.0):
+    """
+    Поток со всплесками: интенсивность переключается между rate * burst_factor во всплеске и пониженной
+    вне его так, что средняя интенсивность равна rate
+    :param burst_fraction: доля времени во всплесках
+    :param period: средняя длительность состояния вне всплеска, в секундах
+    """
+    high = rate * burst_factor
+    low = rate * (1 - burst_fraction * burst_factor) / (1 - burst_fraction)
+    assert low > 0, 'burst_factor * burst_fraction must be less than 1'
+    arrivals = []
+    now = 0.0
+    burst = False
+    while now < duration:
+        length = rng.expovariate(1 / (period * (burst_fraction / (1 - burst_fraction) if burst else 1)))
+        end = min(now + length, duration)
+        current_rate = high if burst else low
+        now += rng.expovariate(current_rate)
+        while now < end:
+            arrivals.append((now, random_query(rng)))
+            now += rng.expovariate(current_rate)
+        now = end
+        burst = not burst
+    return arrivals
+
+
+def trace_arrivals(path, rate, max_len, rng):
+    """
+    Записанный поток запросов: строки JSON с полями time (секунды от начала, необязательно) и query или length.
+    Если поля query и length отсутствуют, запросом считается первое строковое поле.
+    Строки без time поступают пуассоновским потоком интенсивности rate
+    """
+    arrivals = []
+    now = 0.0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'query' in record:
+                query = record['query']
+            elif 'length' in record:
+                query = 'A' * int(record['length'])
+            else:
+                query = next((value for value in record.values() if isinstance(value, str)), '')
+            query = query[:max_len] or 'A'
+            if 'time' in record:
+                now = float(record['time'])
+            else:
+                now += rng.expovariate(rate)
+            arrivals.append((now, query))
+    arrivals.sort(key=lambda arrival: arrival[0])
+    return arrivals
+
+
+def summary(latencies, started, finished, n_batches, n_tasks, padding_waste):
+    latencies = np.asarray(latencies)
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / max(finished - started, 1e-9),
+        'latency': {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+        },
+        'batches': n_batches,
+        'mean_batch_size': n_tasks / n_batches if n_batches else 0.0,
+        'padding_waste': padding_waste,
+    }
+
+
+def run_simulated(batch_generator, arrivals, model, replicas):
+    """
+    Прогон с виртуальным временем
+    """
+    result = simulate(batch_generator, arrivals, model.cost, replicas)
+    latencies = [finish - task.time_created for task, finish in result.finished]
+    return summary(latencies, arrivals[0][0], max(finish for _, finish in result.finished),
+                   len(result.batch_sizes), sum(result.batch_sizes), 1 - result.tokens / max(result.cells, 1))
+
+
+def run_realtime(batch_generator, arrivals, model, replicas, mode, timeout):
+    """
+    Прогон через конвейер в реальном времени
+    """
+    appliers = [ModelApplier(None, model) for _ in range(replicas)]
+    if replicas > 1:
+        model_stage = ReplicatedWorker(appliers, cost=batch_cells)
+    else:
+        model_stage = appliers[0]
+    processor = BaseProcessor(batch_generator, model_stage, mode=mode, queue_size=len(arrivals) + 1)
+    # стандартный вывод занят отчётом
+    with redirect_stdout(sys.stderr):
+        processor.start()
+    try:
+        latencies = []
+        futures = []
+        started = time()
+        for idx, (arrival, query) in enumerate(arrivals):
+            delay = started + arrival - arrivals[0][0] - time()
+            if delay > 0:
+                sleep(delay)
+            future = Future()
+            sent = time()
+            future.add_done_callback(lambda _, sent=sent: latencies.append(time() - sent))
+            processor.submit(query, future, timeout)
+            futures.append(future)
+        wait(futures, timeout)
+        finished = time()
+
+        metrics = batch_generator.batch_metrics
+        _, ratio_sum = metrics.padding_ratio.snapshot()
+        sizes, n_tasks = metrics.size.snapshot()
+        n_batches = int(sizes[-1])
+        # доля дополнения оценивается по среднему отношению размера группы к числу реальных токенов
+        padding_waste = 1 - n_batches / ratio_sum if ratio_sum else 0.0
+        result = summary(latencies, started, finished, n_batches, n_tasks, padding_waste)
+        result['timed_out'] = sum(not future.done() for future in futures)
+        return result
+    finally:
+        processor.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['simulated', 'realtime'], default='simulated')
+    parser.add_argument('--arrival', choices=['poisson', 'bursty', 'trace'], default='poisson')
+    parser.add_argument('--trace', help='JSONL file for --arrival trace')
+    parser.add_argument('--rate', type=float, default=50, help='mean requests per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of synthetic traffic')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--strategies', default=','.join(STRATEGIES))
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--timeout', type=float, default=0.5)
+    parser.add_argument('--parallel-size', type=float, default=1000)
+    parser.add_argument('--latency-slo', type=float, default=1.0)
+    parser.add_argument('--alpha', type=float, default=0.01)
+    parser.add_argument('--model-delay', type=float, default=0.05)
+    parser.add_argument('--replicas', type=int, default=1)
+    parser.add_argument('--pipeline-mode', choices=[Pipeline.PROCESSES, Pipeline.THREADS], default=Pipeline.PROCESSES)
+    parser.add_argument('--request-timeout', type=float, default=30)
+    parser.add_argument('--max-query-len', type=int, default=50)
+    parser.add_argument('--output', help='write the JSON report to a file instead of stdout')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.arrival == 'poisson':
+        arrivals = poisson_arrivals(args.rate, args.duration, rng)
+    elif args.arrival == 'bursty':
+        arrivals = bursty_arrivals(args.rate, args.duration, rng)
+    else:
+        assert args.trace, '--trace is required for --arrival trace'
+        arrivals = trace_arrivals(args.trace, args.rate, args.max_query_len, rng)
+    assert arrivals, 'no requests to send'
+
+    model = DummyTestModel(args.alpha, args.parallel_size, args.model_delay)
+    report = {
+        'mode': args.mode,
+        'arrival': args.arrival,
+        'seed': args.seed,
+        'parameters': {name: value for name, value in vars(args).items() if name not in ('output', 'strategies')},
+        'results': {},
+    }
+    for name in args.strategies.split(','):
+        batch_generator = STRATEGIES[name](args)
+        if args.mode == 'simulated':
+            report['results'][name] = run_simulated(batch_generator, arrivals, model, args.replicas)
+        else:
+            report['results'][name] = run_realtime(batch_generator, arrivals, model, args.replicas,
+                                                   args.pipeline_mode, args.request_timeout)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,128 @@
+"""
+Перебор параметров стратегий группировки на моделировании с виртуальным временем.
+
+Для каждой комбинации batch_size, batch_wait_timeout и parallel_size и каждой интенсивности потока
+этап группировки прогоняется в benchmarks/simulation.py на пуассоновском потоке; время обработки групп
+вычисляется как в DummyTestModel: alpha * max_len * ceil(size * max_len / parallel_size) + delay.
+Результат - JSON со всеми прогонами и границей Парето для каждой стратегии: точки, для которых нет прогона
+с не меньшей пропускной способностью и меньшим 99-м перцентилем задержки
+
+Запуск: python benchmarks/parameter_sweep.py [--strategies CostBased,Simple] [--rates 10,25,50,100]
+    [--batch-sizes 16,32,64] [--timeouts 0.05,0.1,0.25,0.5] [--parallel-sizes 500,1000] [--output FILE]
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+from argparse import Namespace
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from batching_benchmark import STRATEGIES, poisson_arrivals, run_simulated
+from dummy_test_model import DummyTestModel
+
+
+def values(text, kind=float):
+    return [kind(value) for value in text.split(',') if value]
+
+
+def frontier(runs):
+    """
+    Граница Парето прогонов по пропускной способности (больше - лучше) и 99-му перцентилю задержки (меньше - лучше)
+    """
+    points = sorted(runs, key=lambda run: (-run['throughput'], run['latency']['p99']))
+    result = []
+    best_p99 = float('inf')
+    for run in points:
+        if run['latency']['p99'] < best_p99:
+            best_p99 = run['latency']['p99']
+            result.append(run)
+    return result[::-1]
+
+
+def best(runs, strategy, rate, sustained):
+    """
+    Параметры с наименьшим 99-м перцентилем задержки среди прогонов, выдерживающих интенсивность rate
+    """
+    candidates = [run for run in runs if run['strategy'] == strategy and run['rate'] == rate
+                  and run['throughput'] >= sustained * rate]
+    if not candidates:
+        return None
+    run = min(candidates, key=lambda run: run['latency']['p99'])
+    return {'p99': run['latency']['p99'], 'p50': run['latency']['p50'], 'padding_waste': run['padding_waste'],
+            'parameters': run['parameters']}
+
+
+def sweep(strategies, rates, grid, duration, replicas, model, seed, latency_slo=1.0):
+    """
+    :param grid: словарь название параметра -> список значений
+    :return: список прогонов с параметрами и показателями
+    """
+    arrivals = {rate: poisson_arrivals(rate, duration, random.Random(seed)) for rate in rates}
+    runs = []
+    names = list(grid)
+    for strategy in strategies:
+        # стратегии без параметров прогоняются один раз
+        combinations = [()] if strategy == 'Naive' else itertools.product(*(grid[name] for name in names))
+        for combination in combinations:
+            parameters = dict(zip(names, combination))
+            args = Namespace(latency_slo=latency_slo, **{name: grid[name][0] for name in names})
+            for name, value in parameters.items():
+                setattr(args, name, value)
+            for rate in rates:
+                result = run_simulated(STRATEGIES[strategy](args), arrivals[rate], model, replicas)
+                result.update(strategy=strategy, rate=rate, parameters=parameters)
+                runs.append(result)
+    return runs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--strategies', default='CostBased,Simple')
+    parser.add_argument('--rates', default='10,25,50,100', help='requests per second')
+    parser.add_argument('--batch-sizes', default='16,32,64,128')
+    parser.add_argument('--timeouts', default='0.05,0.1,0.25,0.5,1')
+    parser.add_argument('--parallel-sizes', default='500,1000,2000')
+    parser.add_argument('--latency-slo', type=float, default=1.0, help='used by the Adaptive strategy')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of traffic per run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--alpha', type=float, default=0.01)
+    parser.add_argument('--model-delay', type=float, default=0.05)
+    parser.add_argument('--model-parallel-size', type=float, default=1000)
+    parser.add_argument('--replicas', type=int, default=1)
+    parser.add_argument('--sustained', type=float, default=0.95,
+                        help='a run sustains its rate if throughput is at least this fraction of it')
+    parser.add_argument('--output', help='write the JSON report to a file instead of stdout')
+    args = parser.parse_args()
+
+    grid = {
+        'batch_size': values(args.batch_sizes, int),
+        'timeout': values(args.timeouts),
+        'parallel_size': values(args.parallel_sizes),
+    }
+    model = DummyTestModel(args.alpha, args.model_parallel_size, args.model_delay)
+    started = time()
+    strategies = args.strategies.split(',')
+    rates = values(args.rates)
+    runs = sweep(strategies, rates, grid, args.duration, args.replicas, model, args.seed, args.latency_slo)
+    report = {
+        'parameters': {name: value for name, value in vars(args).items() if name != 'output'},
+        'elapsed': time() - started,
+        'runs': runs,
+        'frontier': {strategy: [{'throughput': run['throughput'], 'p99': run['latency']['p99'], 'rate': run['rate'],
+                                 'parameters': run['parameters']}
+                                for run in frontier([run for run in runs if run['strategy'] == strategy])]
+                     for strategy in strategies},
+        'best': {strategy: {str(rate): best(runs, strategy, rate, args.sustained) for rate in rates}
+                 for strategy in strategies},
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
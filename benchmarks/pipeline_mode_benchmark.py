@@ -0,0 +1,67 @@
+"""
+Накладные расходы конвейера на запрос в режимах PROCESSES и THREADS.
+Модель не тратит время на вычисления, поэтому измеряется только передача задач между этапами
+
+Запуск: python benchmarks/pipeline_mode_benchmark.py [--requests N] [--concurrency C] [--len L]
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_model'))
+
+from dummy_test_model import DummyTestModel
+from pipeline import Pipeline
+from processor import BaseProcessor
+from workers.batch_generation import NaiveBatchGenerator, TimeoutCostBatchGenerator
+from workers.model import ModelApplier
+
+
+def make_processor(mode, batch_generator):
+    model = DummyTestModel(alpha=0, default_delay=0)
+    return BaseProcessor(batch_generator, ModelApplier(None, model), mode=mode)
+
+
+def run(mode, n_requests, concurrency, query_len):
+    """
+    :return: средняя задержка последовательных запросов и пропускная способность параллельных запросов
+    """
+    query = 'a' * query_len
+    processor = make_processor(mode, NaiveBatchGenerator())
+    processor.start()
+    try:
+        processor.process_query(query, 10)
+        start = time()
+        for i in range(n_requests):
+            processor.process_query(query + str(i), 10)
+        latency = (time() - start) / n_requests
+    finally:
+        processor.stop()
+
+    processor = make_processor(mode, TimeoutCostBatchGenerator(batch_size=concurrency, timeout=0.01))
+    processor.start()
+    try:
+        processor.process_query(query, 10)
+        start = time()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(lambda i: processor.process_query(query + str(i), 10), range(n_requests)))
+        throughput = n_requests / (time() - start)
+    finally:
+        processor.stop()
+    return latency, throughput
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--len', type=int, default=30)
+    args = parser.parse_args()
+
+    for mode in (Pipeline.PROCESSES, Pipeline.THREADS):
+        latency, throughput = run(mode, args.requests, args.concurrency, args.len)
+        print('{:10s} {:8.3f} ms/request sequential  {:10.1f} requests/s concurrent'.format(
+            mode, latency * 1000, throughput))
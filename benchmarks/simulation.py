@@ -0,0 +1,164 @@
+"""
+Моделирование этапа группировки с виртуальным временем.
+
+Этап группировки выполняется без изменений: его входная очередь выдаёт запросы в моменты их поступления,
+сдвигая виртуальное время вместо ожидания, а выходная очередь вычисляет время обработки каждой группы
+по модели стоимости. Процессы, межпроцессные очереди и sleep не используются
+"""
+import os
+import sys
+from math import inf
+from queue import Empty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from processor import ProcessingTask
+from workers.model import batch_cells
+
+
+class SimulationFinished(Exception):
+    """
+    Raised when the batch generator waits for a request after the last one
+    """
+    pass
+
+
+class VirtualClock:
+    """
+    Виртуальное время моделирования
+    """
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class ArrivalQueue:
+    """
+    Входная очередь этапа группировки: запросы поступают в заданные моменты виртуального времени
+    """
+    def __init__(self, clock, arrivals):
+        """
+        :param arrivals: задачи, упорядоченные по time_created
+        """
+        self.clock = clock
+        self.arrivals = arrivals
+        self.next = 0
+
+    def get(self, block=True, timeout=None):
+        if self.next < len(self.arrivals) and self.arrivals[self.next].time_created <= self.clock.now:
+            return self._pop()
+        if not block or timeout == 0:
+            raise Empty()
+        next_arrival = self.arrivals[self.next].time_created if self.next < len(self.arrivals) else inf
+        limit = inf if timeout is None else self.clock.now + timeout
+        if next_arrival != inf and next_arrival <= limit:
+            self.clock.now = next_arrival
+            return self._pop()
+        if limit == inf:
+            raise SimulationFinished()
+        self.clock.now = limit
+        raise Empty()
+
+    def _pop(self):
+        task = self.arrivals[self.next]
+        self.next += 1
+        return task
+
+    def qsize(self):
+        count = 0
+        while self.next + count < len(self.arrivals) and \
+                self.arrivals[self.next + count].time_created <= self.clock.now:
+            count += 1
+        return count
+
+
+class SimulatedModel:
+    """
+    Выходная очередь этапа группировки: группа обрабатывается первой освободившейся репликой модели,
+    время обработки задаётся функцией cost(batch_size, max_len)
+    """
+    def __init__(self, clock, cost, replicas=1, latency_estimator=None):
+        """
+        :param latency_estimator: LatencyEstimator этапа группировки, получающий время обработки групп
+            после их завершения
+        """
+        self.clock = clock
+        self.cost = cost
+        self.free_at = [0.0] * replicas
+        self.latency_estimator = latency_estimator
+        # время начала обработки отправленных групп, для размера очереди
+        self.starts = []
+        # завершения групп, ещё не переданные оценке времени работы: (время завершения, размер, длительность)
+        self.observations = []
+
+        self.finished = []
+        self.batch_sizes = []
+        self.cells = 0
+        self.tokens = 0
+
+    def put(self, batch, block=True, timeout=None):
+        now = self.clock.now
+        self._observe(now)
+        replica = min(range(len(self.free_at)), key=self.free_at.__getitem__)
+        start = max(now, self.free_at[replica])
+        lengths = [len(task.data) for task in batch]
+        duration = self.cost(len(batch), max(lengths))
+        finish = self.free_at[replica] = start + duration
+
+        self.starts.append(start)
+        self.observations.append((finish, batch_cells(batch), duration))
+        self.finished.extend((task, finish) for task in batch)
+        self.batch_sizes.append(len(batch))
+        self.cells += len(batch) * max(lengths)
+        self.tokens += sum(lengths)
+
+    def _observe(self, now):
+        if self.latency_estimator is None:
+            return
+        done = [observation for observation in self.observations if observation[0] <= now]
+        if done:
+            self.observations = [observation for observation in self.observations if observation[0] > now]
+            for _, cells, duration in sorted(done):
+                self.latency_estimator.observe(cells, duration)
+
+    def qsize(self):
+        now = self.clock.now
+        self._observe(now)
+        self.starts = [start for start in self.starts if start > now]
+        return len(self.starts)
+
+
+def make_tasks(arrivals):
+    """
+    Задачи для моделирования
+    :param arrivals: пары (время поступления, запрос)
+    """
+    tasks = []
+    for arrival, query in arrivals:
+        task = ProcessingTask(list(map(ord, query)))
+        task.time_created = arrival
+        tasks.append(task)
+    return tasks
+
+
+def simulate(batch_generator, arrivals, cost, replicas=1):
+    """
+    Прогоняет этап группировки на запросах с заданным временем поступления
+    :param arrivals: пары (время поступления, запрос), упорядоченные по времени
+    :param cost: время обработки группы, функция (размер группы, максимальная длина)
+    :return: SimulatedModel с результатами
+    """
+    clock = VirtualClock(arrivals[0][0] if arrivals else 0.0)
+    model = SimulatedModel(clock, cost, replicas, getattr(batch_generator, 'latency_estimator', None))
+    batch_generator.clock = clock
+    batch_generator.input = ArrivalQueue(clock, make_tasks(arrivals))
+    batch_generator.output = model
+    batch_generator.before_start()
+    try:
+        while True:
+            batch_generator.job()
+    except SimulationFinished:
+        pass
+    return model
@@ -0,0 +1,127 @@
+"""
+Скорость кодировщиков строк в токены: количество токенов в секунду при кодировании и декодировании
+
+Запуск: python benchmarks/tokenizer_benchmark.py [--texts N] [--words W] [--vocab PATH] [--merges PATH] [--wordpiece PATH]
+Без файлов словарей BPE и WordPiece обучаются на синтетическом корпусе
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+from collections import Counter
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text_encoders import CharEncoder, BPEEncoder, WordPieceEncoder
+
+
+def make_corpus(n_texts, n_words, seed=0):
+    """
+    Синтетический корпус: слова распределены по закону Ципфа
+    """
+    rng = random.Random(seed)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 10)))
+             for _ in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    return [' '.join(rng.choices(words, weights, k=n_words)) for _ in range(n_texts)]
+
+
+def learn_bpe(corpus, n_merges, directory):
+    """
+    Обучает слияния BPE на корпусе
+    :return: пути к файлам словаря и слияний
+    """
+    words = Counter(word for text in corpus for word in BPEEncoder.WORD_PATTERN.findall(text))
+    split = {word: list(word) for word in words}
+    vocab = {ch: idx for idx, ch in enumerate(sorted(set(''.join(words))))}
+    merges = []
+    for _ in range(n_merges):
+        pairs = Counter()
+        for word, parts in split.items():
+            for pair in zip(parts, parts[1:]):
+                pairs[pair] += words[word]
+        if not pairs:
+            break
+        left, right = pairs.most_common(1)[0][0]
+        merges.append((left, right))
+        vocab.setdefault(left + right, len(vocab))
+        for parts in split.values():
+            idx = 0
+            while idx < len(parts) - 1:
+                if parts[idx] == left and parts[idx + 1] == right:
+                    parts[idx:idx + 2] = [left + right]
+                idx += 1
+
+    vocab_path = os.path.join(directory, 'vocab.json')
+    merges_path = os.path.join(directory, 'merges.txt')
+    with open(vocab_path, 'w', encoding='utf-8') as f:
+        json.dump({token.replace(' ', 'Ġ'): idx for token, idx in vocab.items()}, f)
+    with open(merges_path, 'w', encoding='utf-8') as f:
+        for left, right in merges:
+            f.write('{} {}\n'.format(left.replace(' ', 'Ġ'), right.replace(' ', 'Ġ')))
+    return vocab_path, merges_path
+
+
+def make_wordpiece(corpus, n_tokens, directory):
+    """
+    Словарь WordPiece из частых слов корпуса и всех символов
+    :return: путь к файлу словаря
+    """
+    words = Counter(word for text in corpus for word in text.split())
+    chars = sorted(set(''.join(words)))
+    tokens = ['[UNK]'] + chars + ['##' + ch for ch in chars] + [word for word, _ in words.most_common(n_tokens)]
+    path = os.path.join(directory, 'wordpiece.txt')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(tokens))
+    return path
+
+
+def run(encoder, corpus, batch_size=64):
+    """
+    :return: токенов в секунду при кодировании и при декодировании
+    """
+    start = time()
+    sequences = []
+    for idx in range(0, len(corpus), batch_size):
+        sequences.extend(encoder.encode_batch(corpus[idx:idx + batch_size]))
+    encode_time = time() - start
+    n_tokens = sum(map(len, sequences))
+
+    start = time()
+    for idx in range(0, len(sequences), batch_size):
+        encoder.decode_batch(sequences[idx:idx + batch_size])
+    decode_time = time() - start
+    return n_tokens / encode_time, n_tokens / decode_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--texts', type=int, default=20000)
+    parser.add_argument('--words', type=int, default=10)
+    parser.add_argument('--merges-count', type=int, default=2000)
+    parser.add_argument('--vocab')
+    parser.add_argument('--merges')
+    parser.add_argument('--wordpiece')
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.texts, args.words)
+    with tempfile.TemporaryDirectory() as directory:
+        vocab_path, merges_path = args.vocab, args.merges
+        if not (vocab_path and merges_path):
+            vocab_path, merges_path = learn_bpe(corpus[:2000], args.merges_count, directory)
+        wordpiece_path = args.wordpiece or make_wordpiece(corpus[:2000], args.merges_count, directory)
+
+        encoders = {
+            'char': CharEncoder(),
+            'bpe': BPEEncoder(vocab_path, merges_path),
+            'wordpiece': WordPieceEncoder(wordpiece_path),
+        }
+        for name, encoder in encoders.items():
+            # первый проход заполняет кэш слов
+            for label, corpus_pass in (('cold', corpus), ('warm', corpus)):
+                encode_rate, decode_rate = run(encoder, corpus_pass)
+                print('{:10s} {:5s} encode {:12.0f} tokens/s  decode {:12.0f} tokens/s'.format(
+                    name, label, encode_rate, decode_rate))
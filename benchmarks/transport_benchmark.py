@@ -0,0 +1,62 @@
+"""
+Сравнение транспорта между этапами конвейера: multiprocessing.Queue и кольцевой буфер в разделяемой памяти
+
+Запуск: python benchmarks/transport_benchmark.py [--tasks N] [--len L] [--hops H] [--min-length M]
+"""
+import argparse
+import os
+import sys
+from functools import partial
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import Pipeline, CustomWorker
+from processor import ProcessingTask
+from transport import TRANSPORTS
+
+
+def relay(worker):
+    worker.output.put(worker.input.get())
+
+
+def run(transport, n_tasks, seq_len, n_hops):
+    """
+    Прогоняет n_tasks задач через n_hops этапов-пересыльщиков
+    :return: количество задач в секунду
+    """
+    pipeline = Pipeline(*[CustomWorker(relay) for _ in range(n_hops)], transport=transport)
+    pipeline.start()
+    try:
+        # прогрев
+        pipeline.input.put(ProcessingTask(list(range(seq_len))))
+        pipeline.output.get()
+
+        start = time()
+        window = 64
+        sent = received = 0
+        while received < n_tasks:
+            while sent < n_tasks and sent - received < window:
+                pipeline.input.put(ProcessingTask(list(range(seq_len))))
+                sent += 1
+            task = pipeline.output.get()
+            assert len(task.data) == seq_len
+            received += 1
+        return n_tasks / (time() - start)
+    finally:
+        pipeline.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=5000)
+    parser.add_argument('--len', type=int, default=50)
+    parser.add_argument('--hops', type=int, default=5)
+    parser.add_argument('--min-length', type=int, default=None,
+                        help='минимальная длина последовательности для разделяемой памяти')
+    args = parser.parse_args()
+
+    for name, transport in TRANSPORTS.items():
+        if name == 'shared_memory' and args.min_length is not None:
+            transport = partial(transport, min_length=args.min_length)
+        print('{:15s} {:10.1f} tasks/s'.format(name, run(transport, args.tasks, args.len, args.hops)))
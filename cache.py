@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+import json
+import sqlite3
+import sys
+
+
+class ResultCache:
+    """
+    LRU-кэш результатов с ограничением по количеству записей и занимаемой памяти и необязательным временем жизни.
+
+    Вытесненные записи могут сохраняться на диск (sqlite), откуда они читаются при промахе и после перезапуска.
+    """
+    def __init__(self, max_entries=10000, max_bytes=64 << 20, ttl=None, spill_path=None):
+        """
+        :param max_entries: максимальное количество записей в памяти
+        :param max_bytes: максимальный оценочный объём записей в памяти
+        :param ttl: время жизни записи в секундах, None - без ограничения
+        :param spill_path: путь к файлу sqlite для вытесненных записей, None - не сохранять
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.spill = None
+        if spill_path:
+            self.spill = sqlite3.connect(spill_path, check_same_thread=False)
+            self.spill.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    @staticmethod
+    def entry_size(key, value):
+        """
+        Оценка памяти, занимаемой записью
+        """
+        return sys.getsizeof(key) + sum(map(sys.getsizeof, key)) + sys.getsizeof(value)
+
+    def get(self, key):
+        """
+        Возвращает результат по ключу или None
+        """
+        with self.lock:
+            value = self._get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Сохраняет результат
+        """
+        with self.lock:
+            self._put(key, value)
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, expires, _ = entry
+            if expires is None or expires > time():
+                self.entries.move_to_end(key)
+                return value
+            self._remove(key)
+
+        if self.spill is not None:
+            row = self.spill.execute('SELECT value, expires FROM cache WHERE key = ?', (json.dumps(key),)).fetchone()
+            if row is not None and (row[1] is None or row[1] > time()):
+                self._put(key, row[0], row[1])
+                return row[0]
+        return None
+
+    def _put(self, key, value, expires=None):
+        if expires is None and self.ttl:
+            expires = time() + self.ttl
+        if key in self.entries:
+            self._remove(key)
+        size = self.entry_size(key, value)
+        self.entries[key] = (value, expires, size)
+        self.bytes += size
+        spilled = False
+        while len(self.entries) > self.max_entries or (self.bytes > self.max_bytes and len(self.entries) > 1):
+            evicted_key, (evicted, evicted_expires, _) = next(iter(self.entries.items()))
+            self._remove(evicted_key)
+            self.evictions += 1
+            spilled = self._spill(evicted_key, evicted, evicted_expires) or spilled
+        if spilled:
+            self.spill.commit()
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+
+    def _spill(self, key, value, expires):
+        if self.spill is None:
+            return False
+        self.spill.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)', (json.dumps(key), value, expires))
+        return True
+
+    def stats(self):
+        """
+        Возвращает счётчики кэша
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def close(self):
+        """
+        Сохраняет записи из памяти на диск
+        """
+        if self.spill is not None:
+            with self.lock:
+                for key, (value, expires, _) in self.entries.items():
+                    self._spill(key, value, expires)
+                self.spill.commit()
+                self.spill.close()
+                self.spill = None
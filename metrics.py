@@ -0,0 +1,307 @@
+from multiprocessing import Array
+from bisect import bisect_left
+from time import time
+
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+LENGTH_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048)
+RATIO_BUCKETS = (1, 1.1, 1.25, 1.5, 2, 3, 5, 10)
+
+
+class Histogram:
+    """
+    Гистограмма в разделяемой памяти: значения записываются этапом в своём процессе, а читаются сервером
+    """
+    def __init__(self, buckets):
+        """
+        :param buckets: верхние границы интервалов по возрастанию
+        """
+        self.buckets = buckets
+        # количество значений в каждом интервале и за последней границей, затем сумма значений
+        self.values = Array('d', len(buckets) + 2)
+
+    def observe(self, value, count=1):
+        """
+        Учитывает значение count раз
+        """
+        idx = bisect_left(self.buckets, value)
+        with self.values.get_lock():
+            self.values[idx] += count
+            self.values[-1] += value * count
+
+    def snapshot(self):
+        """
+        :return: накопленные количества для каждой границы (последняя - +Inf), сумма значений
+        """
+        with self.values.get_lock():
+            values = self.values[:]
+        cumulative = []
+        total = 0
+        for count in values[:-1]:
+            total += count
+            cumulative.append(total)
+        return cumulative, values[-1]
+
+
+class WorkerMetrics:
+    """
+    Показатели этапа: время ожидания задач во входной очереди, время обработки и количество задач в сообщении
+    """
+    def __init__(self):
+        self.queue_wait = Histogram(TIME_BUCKETS)
+        self.processing = Histogram(TIME_BUCKETS)
+        self.items = Histogram(COUNT_BUCKETS)
+        # номер этапа в конвейере, задаёт место отметок времени этапа в трассировке задачи
+        self.position = None
+        # время, проведённое текущим заданием в ожидании входной очереди, и количество полученных
+        # и отправленных им сообщений
+        self.blocked = 0
+        self.received = 0
+        self.sent = 0
+
+    def begin_job(self):
+        self.blocked = 0
+        self.received = 0
+        self.sent = 0
+
+    def end_job(self, elapsed):
+        """
+        Учитывает время обработки задания без ожидания входной очереди
+        """
+        if self.received or self.sent:
+            self.processing.observe(max(elapsed - self.blocked, 0))
+
+    def received_message(self, tasks, blocked, now):
+        """
+        Учитывает полученное сообщение
+        :param blocked: время ожидания сообщения
+        """
+        self.blocked += blocked
+        self.received += 1
+        self.items.observe(len(tasks))
+        for task in tasks:
+            queued = getattr(task, 'time_queued', None)
+            if queued is not None:
+                self.queue_wait.observe(max(now - queued, 0))
+            trace = getattr(task, 'trace', None)
+            if trace is not None and self.position is not None:
+                trace[2 * self.position] = now
+
+    def sent_message(self, tasks, now):
+        """
+        Учитывает отправленное сообщение
+        """
+        self.sent += 1
+        if self.position is not None:
+            for task in tasks:
+                trace = getattr(task, 'trace', None)
+                if trace is not None:
+                    trace[2 * self.position + 1] = now
+
+    def histograms(self):
+        return {
+            'queue_wait_seconds': self.queue_wait,
+            'processing_seconds': self.processing,
+            'items_per_message': self.items,
+        }
+
+
+class BatchMetrics:
+    """
+    Показатели этапа группировки: размер группы, максимальная длина, отношение размера дополненной группы
+    к количеству реальных токенов и причина отправки группы
+    """
+    FULL, TIMEOUT, FORCED = 'full', 'timeout', 'forced'
+    REASONS = (FULL, TIMEOUT, FORCED)
+
+    def __init__(self):
+        self.size = Histogram(COUNT_BUCKETS)
+        self.max_len = Histogram(LENGTH_BUCKETS)
+        self.padding_ratio = Histogram(RATIO_BUCKETS)
+        self.flushes = Array('L', len(self.REASONS))
+
+    def observe(self, batch, reason):
+        """
+        Учитывает отправленную группу
+        :param reason: FULL - группа заполнена, TIMEOUT - истекло время ожидания следующего запроса,
+            FORCED - самый старый запрос ждёт дольше допустимого
+        """
+        lengths = [len(task.data) for task in batch]
+        max_len = max(lengths)
+        self.size.observe(len(batch))
+        self.max_len.observe(max_len)
+        self.padding_ratio.observe(len(batch) * max_len / max(sum(lengths), 1))
+        with self.flushes.get_lock():
+            self.flushes[self.REASONS.index(reason)] += 1
+
+    def histograms(self):
+        return {
+            'batch_size': self.size,
+            'batch_max_len': self.max_len,
+            'batch_padding_ratio': self.padding_ratio,
+        }
+
+
+class ClassMetrics:
+    """
+    Показатели классов приоритета: время от постановки запроса в очередь до получения результата.
+    Количество значений гистограммы задаёт пропускную способность класса
+    """
+    def __init__(self, classes):
+        self.latency = {cls: Histogram(TIME_BUCKETS) for cls in classes}
+
+    def observe(self, cls, latency):
+        histogram = self.latency.get(cls)
+        if histogram is not None:
+            histogram.observe(latency)
+
+
+class MeteredQueue:
+    """
+    Очередь этапа, отмечающая время отправки задач и учитывающая полученные этапом сообщения.
+    Остальные атрибуты берутся у исходной очереди
+    """
+    def __init__(self, queue, metrics=None, incoming=True):
+        """
+        :param metrics: WorkerMetrics этапа, None - только отмечать время отправки
+        :param incoming: входная ли это очередь этапа; для выходной учитываются только отправленные сообщения
+        """
+        self.queue = queue
+        self.metrics = metrics
+        self.incoming = incoming
+
+    def put(self, message, *args, **kwargs):
+        now = time()
+        tasks = message if isinstance(message, list) else (message,)
+        for task in tasks:
+            task.time_queued = now
+        if self.metrics is not None and not self.incoming:
+            self.metrics.sent_message(tasks, now)
+        self.queue.put(message, *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        started = time()
+        message = self.queue.get(*args, **kwargs)
+        if self.metrics is not None and self.incoming:
+            now = time()
+            self.metrics.received_message(message if isinstance(message, list) else (message,), now - started, now)
+        return message
+
+    def __getattr__(self, name):
+        if name == 'queue':
+            raise AttributeError(name)
+        return getattr(self.queue, name)
+
+
+def unwrap(queue):
+    """
+    Исходная очередь MeteredQueue
+    """
+    return queue.queue if isinstance(queue, MeteredQueue) else queue
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in labels.items()) + '}'
+
+
+class MetricsWriter:
+    """
+    Формирует текст показателей в формате Prometheus; строки одного показателя выводятся вместе
+    """
+    def __init__(self, prefix='seq2seq_'):
+        self.prefix = prefix
+        # имя показателя -> строки, начиная с описания
+        self.families = {}
+
+    def family(self, name, kind, description):
+        lines = self.families.get(name)
+        if lines is None:
+            lines = self.families[name] = ['# HELP {}{} {}'.format(self.prefix, name, description),
+                                           '# TYPE {}{} {}'.format(self.prefix, name, kind)]
+        return lines
+
+    def value(self, name, kind, description, value, **labels):
+        self.family(name, kind, description).append('{}{}{} {}'.format(self.prefix, name, format_labels(labels), value))
+
+    def histogram(self, name, description, histogram, **labels):
+        lines = self.family(name, 'histogram', description)
+        cumulative, total = histogram.snapshot()
+        for bound, count in zip(list(histogram.buckets) + ['+Inf'], cumulative):
+            lines.append('{}{}_bucket{} {}'.format(self.prefix, name, format_labels(dict(labels, le=bound)), int(count)))
+        lines.append('{}{}_sum{} {}'.format(self.prefix, name, format_labels(labels), total))
+        lines.append('{}{}_count{} {}'.format(self.prefix, name, format_labels(labels), int(cumulative[-1])))
+
+    def text(self):
+        return ''.join(line + '\n' for lines in self.families.values() for line in lines)
+
+
+DESCRIPTIONS = {
+    'queue_wait_seconds': 'Time tasks spend in the input queue of a stage',
+    'processing_seconds': 'Time a stage spends on one job, excluding waiting for input',
+    'items_per_message': 'Tasks per message received by a stage',
+    'batch_size': 'Tasks per batch sent by a batch generator',
+    'batch_max_len': 'Longest task of a batch',
+    'batch_padding_ratio': 'Cells of the padded batch per real token',
+    'request_latency_seconds': 'Time from submitting a task to its result, by priority class',
+}
+
+
+def render_stages(writer, pipeline, offset=0, **extra):
+    """
+    Показатели этапов конвейера; этапы ветвей RoutedWorker выводятся с названием ветви в метке model
+    :param offset: позиция первого этапа конвейера
+    """
+    for position, (worker, q_size, dropped) in enumerate(zip(pipeline.workers, pipeline.q_sizes(), pipeline.dropped()),
+                                                         offset):
+        branches = getattr(worker, 'branches', None)
+        if branches is not None:
+            for name, branch in branches.items():
+                render_stages(writer, branch, position, **dict(extra, model=name))
+            scheduler = getattr(worker, 'scheduler', None)
+            if scheduler is not None:
+                for name, busy, waited in zip(branches, scheduler.busy[:], scheduler.waited[:]):
+                    writer.value('model_busy_seconds_total', 'counter', 'Time a model spends applying batches', busy,
+                                 model=name)
+                    writer.value('model_wait_seconds_total', 'counter',
+                                 'Time a model waits for the scheduler to grant a slot', waited, model=name)
+            continue
+        labels = dict(extra, stage=type(worker).__name__, position=position)
+        writer.value('queue_messages', 'gauge', 'Messages waiting in the input queue of a stage',
+                     sum(q_size) if isinstance(q_size, list) else q_size, **labels)
+        writer.value('dropped_tasks_total', 'counter', 'Expired tasks dropped by a stage', dropped, **labels)
+        for name, histogram in worker.metrics.histograms().items():
+            writer.histogram(name, DESCRIPTIONS[name], histogram, **labels)
+        batch_metrics = getattr(worker, 'batch_metrics', None)
+        if batch_metrics is not None:
+            for name, histogram in batch_metrics.histograms().items():
+                writer.histogram(name, DESCRIPTIONS[name], histogram, **labels)
+            for reason, count in zip(BatchMetrics.REASONS, batch_metrics.flushes[:]):
+                writer.value('batch_flushes_total', 'counter', 'Batches sent, by flush reason', count,
+                             reason=reason, **labels)
+
+
+def render_metrics(processor):
+    """
+    Показатели обработчика запросов в формате Prometheus
+    """
+    writer = MetricsWriter()
+    render_stages(writer, processor.pipeline)
+
+    for cls, histogram in processor.class_metrics.latency.items():
+        writer.histogram('request_latency_seconds', DESCRIPTIONS['request_latency_seconds'], histogram, priority=cls)
+    writer.value('pending_tasks', 'gauge', 'Tasks submitted and not yet resolved', len(processor.tasks))
+    writer.value('deduplicated_total', 'counter', 'Queries attached to an identical in-flight task',
+                 processor.deduplicated)
+    admission = processor.admission.stats()
+    writer.value('admission_units', 'gauge', 'Cost of the tasks admitted and not yet resolved', admission['units'])
+    writer.value('admission_rejected_total', 'counter', 'Queries rejected by admission control', admission['rejected'])
+    writer.value('admission_drain_rate', 'gauge', 'Cost of the tasks completed per second', admission['drain_rate'])
+    if processor.cache is not None:
+        for name, value in processor.cache.stats().items():
+            if name in ('entries', 'bytes'):
+                writer.value('cache_' + name, 'gauge', 'Result cache ' + name, value)
+            else:
+                writer.value('cache_{}_total'.format(name), 'counter', 'Result cache ' + name, value)
+    return writer.text()
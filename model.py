@@ -2,12 +2,66 @@ class BaseModel:
     """
     Интерфейс модели
     """
-    def process(self, batch: list):
+
+    # Если True, модель получает группу в виде матрицы np.int32 (batch, max_len), дополненной значением -1,
+    # а также векторы длин и маску внимания
+    supports_arrays = False
+
+    # Идентификатор токена конца последовательности: результат обрезается перед ним, None - только по дополнению
+    eos_id = None
+
+    # Если True, process возвращает пару (результаты, длины результатов), и результаты обрезаются по этим длинам
+    returns_lengths = False
+
+    # Если True, модель поддерживает пошаговое декодирование: init_state, decode_step, finish и partial.
+    # Тогда группа декодируемых последовательностей может меняться между шагами, а результат - передаваться частями
+    supports_steps = False
+
+    def process(self, batch, lengths=None, mask=None):
         """
         Обработать группу запросов
         :param batch: группа запросов для обработки
-        :return: результат применения модели
+        :param lengths: длины запросов, передаются только при supports_arrays
+        :param mask: маска (batch, max_len) реальных токенов, передаётся только при supports_arrays
+        :return: результат применения модели: матрица или список последовательностей токенов; значения после
+            конца последовательности - отрицательные (дополнение) или eos_id
+        """
+
+        raise NotImplementedError()
+
+    def init_state(self, batch):
+        """
+        Начать декодирование последовательностей
+        :param batch: список последовательностей токенов
+        :return: список состояний декодирования, по одному на последовательность
+        """
+
+        raise NotImplementedError()
+
+    def decode_step(self, states):
+        """
+        Выполнить один шаг декодирования для группы последовательностей
+        :param states: состояния декодируемых последовательностей, изменяются на месте;
+            состав группы может меняться между вызовами
+        :return: для каждого состояния - завершено ли декодирование
+        """
+
+        raise NotImplementedError()
+
+    def finish(self, state):
+        """
+        Результат завершённого декодирования
+        :param state: состояние последовательности, для которой decode_step сообщил о завершении
+        :return: результат применения модели к последовательности
         """
 
         raise NotImplementedError()
 
+    def partial(self, state):
+        """
+        Токены, полученные к текущему шагу декодирования
+        :param state: состояние незавершённой последовательности
+        :return: последовательность токенов, продолжаемая следующими шагами
+        """
+
+        raise NotImplementedError()
@@ -1,4 +1,8 @@
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Array, Value
+from threading import Thread, Event
+from queue import Empty, SimpleQueue
+from metrics import WorkerMetrics, MeteredQueue, unwrap
+from time import time
 
 
 class MissingInputException(Exception):
@@ -8,15 +12,34 @@ class MissingInputException(Exception):
     pass
 
 
+def as_tasks(message):
+    """
+    Список задач сообщения: сообщение - задача или список задач
+    """
+    return message if isinstance(message, list) else [message]
+
+
 class Worker:
     """
-    Этап обработки
+    Этап обработки.
+    Этап выполняется в отдельном процессе или, в режиме конвейера THREADS, в потоке основного процесса
     """
+    # этап нагружает процессор и в режиме THREADS остаётся в отдельном процессе
+    cpu_heavy = False
+
     def __init__(self):
         self.process = Process(target=self.worker)
         self.process.daemon = True
+        self.thread = None
+        self.stop_event = Event()
+        self.metrics = WorkerMetrics()
+        # источник текущего времени для решений этапа; заменяется при моделировании
+        self.clock = time
         self._input = None
-        self._output = Queue()
+        self._output = None
+        self.input = None
+        self.output = Queue()
+        self.dropped = Value('L', 0)
 
     def before_start(self):
         """
@@ -29,8 +52,35 @@ class Worker:
         Запускает основоной цикл
         """
         self.before_start()
-        while True:
+        self.loop()
+
+    def loop(self):
+        """
+        Выполняет задания, пока этап работает
+        """
+        while self.running():
+            started = time()
+            self.metrics.begin_job()
             self.job()
+            self.metrics.end_job(time() - started)
+
+    def running(self):
+        """
+        Продолжать ли выполнять задания
+        """
+        return not self.stop_event.is_set()
+
+    def ready(self):
+        """
+        Готов ли этап обрабатывать задачи
+        """
+        return True
+
+    def wait_loaded(self):
+        """
+        Ожидает, пока запущенный этап подготовится к обработке, например загрузит модель
+        """
+        pass
 
     def job(self):
         """
@@ -38,39 +88,99 @@ class Worker:
         """
         raise NotImplementedError()
 
-    def start(self):
+    def start(self, threaded=False):
         """
         Запуск этапа
+        :param threaded: выполнять этап в потоке текущего процесса
         """
         assert self._input is not None, MissingInputException
-        self.process.start()
+        if threaded:
+            self.thread = Thread(target=self.worker)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self.process.start()
 
     def stop(self):
         """
-        Остановка этапа обработки
+        Остановка этапа обработки.
+        Поток этапа завершается после текущего задания; ожидающий входных данных поток остаётся до выхода
+        из программы
+        """
+        self.stop_event.set()
+        if self.thread is None:
+            self.process.terminate()
+
+    def q_size(self):
+        """
+        Количество сообщений, ожидающих этап
+        """
+        return self._input.qsize()
+
+    def get_tasks(self, max_tasks=1, wait=0):
+        """
+        Ожидает первое сообщение и забирает следующие, пока задач меньше max_tasks
+        :param wait: сколько секунд после первого сообщения ждать следующих
+        :return: список задач
+        """
+        tasks = as_tasks(self.input.get())
+        deadline = time() + wait
+        while len(tasks) < max_tasks:
+            remaining = deadline - time()
+            try:
+                message = self.input.get(block=remaining > 0, timeout=remaining if remaining > 0 else None)
+            except Empty:
+                break
+            tasks.extend(as_tasks(message))
+        return tasks
+
+    def drop_expired(self, tasks):
+        """
+        Отбрасывает задачи, срок ответа на которые истёк
+        :return: оставшиеся задачи
+        """
+        now = self.clock()
+        alive = [task for task in tasks if task.deadline is None or task.deadline > now]
+        if len(alive) < len(tasks):
+            with self.dropped.get_lock():
+                self.dropped.value += len(tasks) - len(alive)
+        return alive
+
+    def dropped_count(self):
+        """
+        Количество отброшенных этапом задач
         """
-        self.process.terminate()
+        return self.dropped.value
 
     @property
     def input(self):
         """
-        Входная очередь задач
+        Входная очередь задач, учитывающая полученные этапом сообщения
         """
-        return self._input
+        return self._metered_input
 
     @input.setter
     def input(self, value):
         """
         Задаёт выодную очередь задач
         """
-        self._input = value
+        self._input = unwrap(value)
+        self._metered_input = MeteredQueue(self._input, self.metrics)
 
     @property
     def output(self):
         """
-        Выходная очередь задач
+        Выходная очередь задач, отмечающая время отправки задач
         """
-        return self._output
+        return self._metered_output
+
+    @output.setter
+    def output(self, value):
+        """
+        Задаёт выходную очередь задач
+        """
+        self._output = unwrap(value)
+        self._metered_output = MeteredQueue(self._output, self.metrics, incoming=False)
 
 
 class CustomWorker(Worker):
@@ -88,23 +198,331 @@ class CustomWorker(Worker):
         self._job(self)
 
 
+class DispatchQueue:
+    """
+    Очередь, отправляющая каждое сообщение наименее загруженной реплике этапа.
+    Нагрузка реплики - суммарная стоимость отправленных ей и ещё не обработанных сообщений
+    """
+    def __init__(self, n_replicas, cost=None):
+        """
+        :param cost: функция стоимости сообщения, по умолчанию каждое сообщение стоит 1
+        """
+        self.queues = [Queue() for _ in range(n_replicas)]
+        self.loads = Array('d', n_replicas)
+        self.cost = cost
+
+    def put(self, message, block=True, timeout=None):
+        """
+        Отправляет сообщение наименее загруженной реплике
+        """
+        cost = 1 if self.cost is None else self.cost(message)
+        with self.loads.get_lock():
+            idx = min(range(len(self.queues)), key=self.loads.__getitem__)
+            self.loads[idx] += cost
+        self.queues[idx].put((cost, message), block, timeout)
+
+    def replica_input(self, idx):
+        """
+        Входная очередь реплики idx
+        """
+        return ReplicaInput(self, idx)
+
+    def qsize(self):
+        """
+        Суммарное количество сообщений в очередях реплик
+        """
+        return sum(self.qsizes())
+
+    def qsizes(self):
+        """
+        Количество сообщений в очереди каждой реплики
+        """
+        return [queue.qsize() for queue in self.queues]
+
+
+class ReplicaInput:
+    """
+    Входная очередь реплики. Сообщение считается обработанным, когда реплика запрашивает следующее
+    """
+    def __init__(self, dispatcher, idx):
+        self.dispatcher = dispatcher
+        self.idx = idx
+        self.in_progress = 0
+
+    def get(self, block=True, timeout=None):
+        """
+        Получает следующее сообщение
+        """
+        self.release()
+        self.in_progress, message = self.dispatcher.queues[self.idx].get(block, timeout)
+        return message
+
+    def release(self):
+        """
+        Снимает нагрузку обработанного сообщения
+        """
+        if self.in_progress:
+            with self.dispatcher.loads.get_lock():
+                self.dispatcher.loads[self.idx] -= self.in_progress
+            self.in_progress = 0
+
+    def qsize(self):
+        return self.dispatcher.queues[self.idx].qsize()
+
+
+class ReplicatedWorker(Worker):
+    """
+    Этап обработки, выполняемый несколькими репликами в отдельных процессах.
+    Предыдущий этап пишет в DispatchQueue, а все реплики пишут в общую выходную очередь
+    """
+    # реплики всегда выполняются в отдельных процессах
+    cpu_heavy = True
+
+    def __init__(self, replicas, cost=None):
+        """
+        :param replicas: экземпляры этапа
+        :param cost: функция стоимости сообщения для выбора реплики
+        """
+        self.replicas = replicas
+        super(ReplicatedWorker, self).__init__()
+        self.dispatcher = DispatchQueue(len(replicas), cost)
+        for idx, replica in enumerate(replicas):
+            # показатели реплик учитываются вместе
+            replica.metrics = self.metrics
+            replica.input = self.dispatcher.replica_input(idx)
+            replica.output = self._output
+
+    def start(self, threaded=False):
+        """
+        Запуск реплик
+        """
+        for replica in self.replicas:
+            replica.start()
+
+    def stop(self):
+        """
+        Остановка реплик
+        """
+        for replica in self.replicas:
+            replica.stop()
+
+    def q_size(self):
+        """
+        Количество сообщений, ожидающих каждую реплику
+        """
+        return self.dispatcher.qsizes()
+
+    def dropped_count(self):
+        """
+        Количество отброшенных репликами задач
+        """
+        return sum(replica.dropped_count() for replica in self.replicas)
+
+    def ready(self):
+        """
+        Готовы ли все реплики
+        """
+        return all(replica.ready() for replica in self.replicas)
+
+    def wait_loaded(self):
+        """
+        Ожидает подготовки всех реплик
+        """
+        for replica in self.replicas:
+            replica.wait_loaded()
+
+    def reload(self, *args, **kwargs):
+        """
+        Перезагружает реплики по одной, чтобы остальные продолжали обработку
+        """
+        for replica in self.replicas:
+            replica.reload(*args, **kwargs)
+
+    @property
+    def output(self):
+        """
+        Выходная очередь задач
+        """
+        return self._output
+
+    @output.setter
+    def output(self, value):
+        """
+        Задаёт выходную очередь всех реплик
+        """
+        self._output = unwrap(value)
+        for replica in self.replicas:
+            replica.output = value
+
+
+class RoutingQueue:
+    """
+    Очередь, отправляющая каждую задачу во входную очередь ветви, выбранной по ключу задачи
+    """
+    def __init__(self, queues, key):
+        """
+        :param queues: ключ ветви -> входная очередь ветви
+        :param key: функция, возвращающая ключ ветви задачи
+        """
+        self.queues = queues
+        self.key = key
+
+    def put(self, message, block=True, timeout=None):
+        """
+        Отправляет задачи сообщения; задачи одной ветви отправляются одним сообщением
+        """
+        routed = {}
+        for task in as_tasks(message):
+            routed.setdefault(self.key(task), []).append(task)
+        for key, tasks in routed.items():
+            self.queues[key].put(tasks if len(tasks) > 1 or isinstance(message, list) else tasks[0], block, timeout)
+
+    def qsize(self):
+        return sum(queue.qsize() for queue in self.queues.values())
+
+
+class RoutedWorker(Worker):
+    """
+    Этап обработки, состоящий из независимых ветвей - конвейеров этапов.
+    Предыдущий этап пишет в RoutingQueue, которая направляет задачу в ветвь по её ключу,
+    а последние этапы всех ветвей пишут в общую выходную очередь
+    """
+    # последние этапы ветвей выполняются в отдельных процессах
+    cpu_heavy = True
+
+    def __init__(self, branches, key):
+        """
+        :param branches: ключ ветви -> Pipeline ветви
+        :param key: функция, возвращающая ключ ветви задачи
+        """
+        self.branches = branches
+        super(RoutedWorker, self).__init__()
+        self.dispatcher = RoutingQueue({name: branch.input for name, branch in branches.items()}, key)
+
+    def start(self, threaded=False):
+        """
+        Запуск ветвей
+        """
+        for branch in self.branches.values():
+            branch.start()
+
+    def stop(self):
+        """
+        Остановка ветвей
+        """
+        for branch in self.branches.values():
+            branch.stop()
+
+    def q_size(self):
+        """
+        Количество сообщений, ожидающих первые этапы ветвей
+        """
+        return sum(branch.workers[0].q_size() for branch in self.branches.values())
+
+    def dropped_count(self):
+        """
+        Количество отброшенных этапами ветвей задач
+        """
+        return sum(sum(branch.dropped()) for branch in self.branches.values())
+
+    def ready(self):
+        """
+        Готовы ли все ветви
+        """
+        return all(branch.ready() for branch in self.branches.values())
+
+    def wait_loaded(self):
+        """
+        Ожидает подготовки этапов всех ветвей
+        """
+        for branch in self.branches.values():
+            branch.wait_loaded()
+
+    def stage_names(self):
+        """
+        Названия этапов ветвей по позициям; разные этапы на одной позиции перечисляются через /
+        """
+        names = []
+        for branch in self.branches.values():
+            for idx, worker in enumerate(branch.workers):
+                name = type(worker).__name__
+                if idx == len(names):
+                    names.append(name)
+                elif name not in names[idx].split('/'):
+                    names[idx] += '/' + name
+        return names
+
+    def set_position(self, position):
+        """
+        Задаёт места отметок времени этапов ветвей в трассировке задачи
+        """
+        self.metrics.position = position
+        for branch in self.branches.values():
+            for idx, worker in enumerate(branch.workers):
+                worker.metrics.position = position + idx
+
+    @property
+    def output(self):
+        """
+        Выходная очередь задач
+        """
+        return self._output
+
+    @output.setter
+    def output(self, value):
+        """
+        Задаёт выходную очередь последних этапов всех ветвей
+        """
+        self._output = unwrap(value)
+        for branch in self.branches.values():
+            replaced = unwrap(branch.workers[-1].output)
+            branch.workers[-1].output = value
+            branch.output = branch.workers[-1].output
+            # транспорт, созданный ветвью для выхода последнего этапа, больше не используется
+            for queue in [queue for queue in branch.transports if unwrap(queue) is replaced]:
+                queue.close()
+                branch.transports.remove(queue)
+
+
 class Pipeline:
     """
-    Связывает этапы обработки
+    Связывает этапы обработки.
+
+    В режиме PROCESSES каждый этап выполняется в отдельном процессе. В режиме THREADS только этапы
+    с cpu_heavy выполняются в отдельных процессах, а остальные - в потоках основного процесса,
+    соединённых queue.SimpleQueue без сериализации задач; поток и процесс соединяются транспортом конвейера
     """
-    def __init__(self, *workers):
-        self.output = self.input = Queue()
+    PROCESSES = 'processes'
+    THREADS = 'threads'
+
+    def __init__(self, *workers, transport=None, mode=PROCESSES):
+        """
+        :param transport: фабрика очередей между процессами этапов, по умолчанию multiprocessing.Queue
+        :param mode: PROCESSES или THREADS
+        """
+        assert mode in (self.PROCESSES, self.THREADS), 'unknown pipeline mode'
+        self.mode = mode
         self.started = False
         self.workers = []
+        self.transport = transport
+        self.transports = []
+        self.output = self.input = MeteredQueue(Queue())
         for worker in workers:
             self.add_worker(worker)
 
+    def threaded(self, worker):
+        """
+        Выполняется ли этап в потоке основного процесса
+        """
+        return self.mode == self.THREADS and not worker.cpu_heavy
+
     def start(self):
         """
-        Запускает этапы обработки
+        Запускает этапы обработки.
+        Процессы создаются до запуска потоков этапов
         """
-        for worker in self.workers:
-            worker.start()
+        for worker in sorted(self.workers, key=self.threaded):
+            worker.start(threaded=self.threaded(worker))
         self.started = True
 
     def stop(self):
@@ -113,17 +531,65 @@ class Pipeline:
         """
         for worker in self.workers:
             worker.stop()
+        for queue in self.transports:
+            queue.close()
+        self.transports.clear()
         self.started = False
 
-    def add_worker(self, worker):
+    def add_worker(self, worker, transport=None):
         """
         Добавляет этап обработки
+        :param transport: фабрика выходной очереди этапа, по умолчанию используется транспорт конвейера
         """
+        transport = transport or self.transport
+        if not self.workers and self.threaded(worker):
+            self.output = self.input = MeteredQueue(SimpleQueue())
+        if self.threaded(worker):
+            # очередь потока заменяется межпроцессной, если следующий этап выполняется в процессе
+            worker.output = SimpleQueue()
+        elif transport is not None and not isinstance(worker, (ReplicatedWorker, RoutedWorker)):
+            # у реплик общая выходная очередь, а транспорт рассчитан на одного отправителя
+            worker.output = transport()
+            if hasattr(worker.output, 'close'):
+                self.transports.append(worker.output)
+
+        if self.workers and self.threaded(self.workers[-1]) and not self.threaded(worker) and \
+                not isinstance(worker, (ReplicatedWorker, RoutedWorker)):
+            # поток отправляет задачи процессу через транспорт конвейера или multiprocessing.Queue
+            self.workers[-1].output = self.transport() if self.transport is not None else Queue()
+            if hasattr(self.workers[-1].output, 'close'):
+                self.transports.append(self.workers[-1].output)
+            self.output = self.workers[-1].output
+
+        if isinstance(worker, (ReplicatedWorker, RoutedWorker)):
+            # предыдущий этап, в том числе поток, отправляет сообщения сразу в очередь нужной реплики или ветви
+            if self.workers:
+                self.workers[-1].output = worker.dispatcher
+            else:
+                self.input = worker.dispatcher
+            self.output = worker.dispatcher
+
         worker.input = self.output
         self.output = worker.output
 
+        if isinstance(worker, RoutedWorker):
+            worker.set_position(len(self.stage_names()))
+        else:
+            worker.metrics.position = len(self.stage_names())
         self.workers.append(worker)
 
+    def stage_names(self):
+        """
+        Названия этапов в порядке мест их отметок времени в трассировке задачи
+        """
+        names = []
+        for worker in self.workers:
+            if isinstance(worker, RoutedWorker):
+                names.extend(worker.stage_names())
+            else:
+                names.append(type(worker).__name__)
+        return names
+
     def pop_worker(self):
         """
         Удаляет последний этап обработки
@@ -136,4 +602,23 @@ class Pipeline:
         """
         Возвращает количество запросов, ожидающих в очереди между каждым из этапов
         """
-        return [worker.input.qsize() for worker in self.workers]
+        return [worker.q_size() for worker in self.workers]
+
+    def dropped(self):
+        """
+        Возвращает количество задач с истёкшим сроком, отброшенных каждым из этапов
+        """
+        return [worker.dropped_count() for worker in self.workers]
+
+    def ready(self):
+        """
+        Запущены ли этапы и готовы ли они обрабатывать задачи
+        """
+        return self.started and all(worker.ready() for worker in self.workers)
+
+    def wait_loaded(self):
+        """
+        Ожидает подготовки запущенных этапов; этапы готовятся параллельно
+        """
+        for worker in self.workers:
+            worker.wait_loaded()
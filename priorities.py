@@ -0,0 +1,67 @@
+class PriorityClasses:
+    """
+    Классы приоритета запросов и их веса.
+
+    Класс запроса задаётся явно или определяется по ключу клиента; запросы без класса и с неизвестным
+    классом относятся к классу по умолчанию. Названия классов и ключи клиентов не зависят от регистра
+    """
+    def __init__(self, weights=None, default='default', tenants=None):
+        """
+        :param weights: класс -> вес, доля обработки, получаемая классом при конкуренции
+        :param default: класс по умолчанию
+        :param tenants: ключ клиента -> класс
+        """
+        self.weights = {cls.lower(): weight for cls, weight in (weights or {}).items()}
+        self.default = default.lower()
+        self.weights.setdefault(self.default, 1)
+        self.tenants = {tenant.lower(): cls.lower() for tenant, cls in (tenants or {}).items()}
+
+    def resolve(self, priority=None, tenant=None):
+        """
+        Класс запроса
+        :param priority: класс, указанный в запросе
+        :param tenant: ключ клиента
+        """
+        if priority and priority.lower() in self.weights:
+            return priority.lower()
+        return self.tenants.get(tenant.lower() if tenant else tenant, self.default)
+
+    def weight(self, cls):
+        return self.weights.get(cls, 1)
+
+
+class FairShare:
+    """
+    Взвешенное справедливое обслуживание классов.
+
+    Каждому классу соответствует виртуальное время, которое увеличивается на стоимость обслуженной работы,
+    делённую на вес класса; следующим обслуживается класс с наименьшим виртуальным временем.
+    Класс, у которого появилась работа, не получает преимущества за время простоя
+    """
+    def __init__(self, weights=None):
+        """
+        :param weights: класс -> вес, вес неизвестных классов - 1
+        """
+        self.weights = weights or {}
+        self.virtual = {}
+
+    def activate(self, cls, active):
+        """
+        Учитывает появление работы у класса
+        :param active: классы, у которых уже есть работа
+        """
+        floor = min((self.virtual.get(other, 0) for other in active if other != cls), default=None)
+        if floor is not None:
+            self.virtual[cls] = max(self.virtual.get(cls, 0), floor)
+
+    def pick(self, classes):
+        """
+        Класс, обслуживаемый следующим
+        """
+        return min(classes, key=lambda cls: self.virtual.get(cls, 0))
+
+    def charge(self, cls, cost):
+        """
+        Учитывает обслуживание работы стоимости cost
+        """
+        self.virtual[cls] = self.virtual.get(cls, 0) + cost / self.weights.get(cls, 1)
@@ -1,12 +1,21 @@
-from threading import Thread, Event
-from concurrent.futures import Future
+from threading import Thread, Event, Lock
+from concurrent.futures import Future, as_completed
+import asyncio
 from time import time
-from pipeline import Pipeline
-from workers.model import ModelApplier
+from operator import attrgetter
+from pipeline import Pipeline, ReplicatedWorker, RoutedWorker, as_tasks
+from workers.model import ModelApplier, ModelLoadingError, batch_cells
+from workers.continuous import ContinuousModelApplier
 from workers.tokenization import Tokenizer, Detokenizer
-from workers.utils import Flattener
+from text_encoders import CharEncoder
 from exceptions import MessagedException
+from metrics import render_metrics, ClassMetrics
+from admission import AdmissionControl
+from priorities import PriorityClasses
+from scheduler import ModelScheduler
+from streaming import StreamChannel, AsyncStreamChannel, split_chunks
 import sys
+import os
 
 
 class ProcessingTask:
@@ -15,33 +24,129 @@ class ProcessingTask:
     """
     max_id = 0
 
-    def __init__(self, data):
+    def __init__(self, data, group=None, group_size=1, priority=None, tenant=None):
+        """
+        :param group: идентификатор группы запросов, поступивших вместе
+        :param group_size: количество запросов в группе
+        :param priority: класс приоритета
+        :param tenant: ключ клиента
+        """
         self.data = data
         ProcessingTask.max_id += 1
         self.id = ProcessingTask.max_id
         self.time_created = time()
+        self.group = group
+        self.group_size = group_size
+        self.priority = priority
+        self.tenant = tenant
+        # название модели, обрабатывающей задачу, если обработчик содержит несколько моделей
+        self.model = None
+        # передавать ли результат частями по мере декодирования
+        self.stream = False
+        # абсолютное время, после которого результат никому не нужен
+        self.deadline = None
+        # отметки времени этапов, если задача выбрана для трассировки
+        self.trace = None
 
 
 class ProcessingQueueOverflowException(MessagedException):
     """
     Raised when the processing pipeline is full
     """
+    def __init__(self, message, retry_after=None, *args):
+        """
+        :param retry_after: recommended delay before retrying, in seconds
+        """
+        self.retry_after = retry_after
+        super(ProcessingQueueOverflowException, self).__init__(message, *args)
+
+
+class UnknownModelException(MessagedException):
+    """
+    Raised when a query names a model the processor does not host
+    """
     pass
 
 
+class LoopFuture:
+    """
+    Передаёт результат, полученный в потоке queue_worker, в asyncio.Future цикла событий
+    """
+    def __init__(self, loop, future):
+        self.loop = loop
+        self.future = future
+
+    def set_result(self, result):
+        """
+        Устанавливает результат из стороннего потока
+        """
+        self.loop.call_soon_threadsafe(self._set_result, result)
+
+    def _set_result(self, result):
+        if not self.future.done():
+            self.future.set_result(result)
+
+
+class PendingTask:
+    """
+    Задача в обработке и объекты, ожидающие её результата
+    """
+    __slots__ = ('key', 'waiters', 'deadline', 'length', 'priority')
+
+    def __init__(self, key, waiters, deadline, length, priority=None):
+        """
+        :param length: длина запроса в токенах, по которой задача учтена в допуске запросов
+        :param priority: класс приоритета задачи
+        """
+        self.key = key
+        self.waiters = waiters
+        self.deadline = deadline
+        self.length = length
+        self.priority = priority
+
+
 class BaseProcessor:
     """
     Базовый обработчик запросов
     """
-    def __init__(self, *workers, queue_size=900):
-        self.pipeline = Pipeline(Tokenizer(), *workers, Detokenizer())
+    # идентификатор модели, входящий в ключи запросов
+    model_id = None
+
+    def __init__(self, *workers, queue_size=900, transport=None, cache=None, encoder=None, mode=Pipeline.PROCESSES,
+                 tracer=None, admission=None, priorities=None):
+        """
+        :param queue_size: максимальное количество задач в обработке, если не задан admission
+        :param cache: кэш результатов ResultCache, None - без кэширования
+        :param encoder: кодировщик строк в токены (text_encoders), None - посимвольный
+        :param mode: режим выполнения этапов конвейера, Pipeline.PROCESSES или Pipeline.THREADS
+        :param tracer: выборочная трассировка задач Tracer, None - без трассировки
+        :param admission: допуск запросов по стоимости AdmissionControl
+        :param priorities: классы приоритета PriorityClasses, None - все запросы одного класса
+        """
+        self.encoder = encoder or CharEncoder()
+        self.pipeline = Pipeline(Tokenizer(self.encoder), *workers, Detokenizer(self.encoder), transport=transport,
+                                 mode=mode)
+        # идентификатор задачи -> PendingTask
         self.tasks = {}
+        # ключ запроса -> идентификатор выполняющейся задачи
+        self.in_flight = {}
+        self.lock = Lock()
+        # перезагрузки моделей выполняются по одной
+        self.reload_lock = Lock()
+        self.deduplicated = 0
+        self.cache = cache
+        self.tracer = tracer
 
         self.stop_event = None
         self.queue_thread = Thread(target=self.queue_worker)
         self.queue_thread.daemon = True
 
         self.queue_size = queue_size
+        if admission is None:
+            admission = AdmissionControl(max_tasks=queue_size)
+        self.admission = admission
+        self.priorities = priorities or PriorityClasses()
+        self.class_metrics = ClassMetrics(self.priorities.weights)
 
     def start(self):
         """
@@ -58,42 +163,535 @@ class BaseProcessor:
         """
         self.stop_event.set()
         self.pipeline.stop()
+        if self.cache is not None:
+            self.cache.close()
+
+    def ready(self):
+        """
+        Готов ли обработчик: этапы запущены, модели загружены и прогреты
+        """
+        return self.pipeline.ready()
+
+    def wait_loaded(self):
+        """
+        Ожидает загрузки и прогрева моделей запущенного обработчика
+        :raise ModelLoadingError: модель не загружена
+        """
+        self.pipeline.wait_loaded()
+
+    def reload(self, model=None, model_path=None):
+        """
+        Перезагружает модель без остановки обработки
+        :param model: название модели, None - модель по умолчанию
+        :param model_path: путь к новому файлу модели, None - повторно загрузить текущий
+        """
+        raise ModelLoadingError('The processor has no model to reload')
 
-    def process_query(self, query, timeout=None):
+    def query_key(self, query, model=None):
+        """
+        Ключ запроса для объединения одинаковых запросов и кэша результатов
+        :param model: название модели, уже проверенное resolve_model
+        """
+        return self.model_id, query
+
+    def resolve_model(self, model=None):
+        """
+        Название модели, обрабатывающей запрос; обработчик с одной моделью не различает моделей
+        """
+        return None
+
+    def submit(self, query, waiter, timeout=None, priority=None, tenant=None, model=None):
+        """
+        Ставит запрос в очередь обработки
+        :param waiter: объект, в который будет передан результат через set_result
+        :param timeout: время ожидания результата; по его истечении задача отбрасывается этапами обработки
+        :param priority: класс приоритета, указанный в запросе
+        :param tenant: ключ клиента, по которому определяется класс приоритета, если он не указан
+        :param model: название модели, None - модель по умолчанию
+        :return: идентификатор задачи, результат которой ожидается
+        """
+        return self.submit_many([query], [waiter], timeout, priority, tenant, model=model)[0]
+
+    def can_attach(self, pending, now, timeout, priority=None):
+        """
+        Может ли запрос с временем ожидания timeout и классом priority дождаться результата выполняющейся задачи
+        """
+        # задача менее приоритетного класса может задержать запрос
+        if self.priorities.weight(pending.priority) < self.priorities.weight(priority):
+            return False
+        if pending.deadline is None:
+            return True
+        # задача с более ранним сроком может быть отброшена этапами раньше, чем истечёт время ожидания запроса
+        return timeout is not None and pending.deadline >= now + timeout
+
+    def submit_many(self, queries, waiters, timeout=None, priority=None, tenant=None, stream=False, model=None):
+        """
+        Ставит группу запросов в очередь обработки за один шаг.
+        Запрос, совпадающий с уже выполняющимся, не попадает в конвейер, а ожидает результат той задачи.
+        Новые задачи группы получают общее время создания и отметку группы для этапа группировки
+        :param waiters: объекты, в которые будут переданы результаты через set_result
+        :param timeout: время ожидания результата; по его истечении задачи отбрасываются этапами обработки
+        :param priority: класс приоритета, указанный в запросе
+        :param tenant: ключ клиента, по которому определяется класс приоритета, если он не указан
+        :param stream: передавать результаты частями через waiter.push; такие запросы не объединяются
+            с одинаковыми, так как части уже выполняющейся задачи были бы потеряны
+        :param model: название модели, None - модель по умолчанию
+        :return: идентификаторы задач, результат которых ожидает каждый запрос
+        """
+        task_ids = []
+        tasks = []
+        priority = self.priorities.resolve(priority, tenant)
+        model = self.resolve_model(model)
+        now = time()
+        deadline = None if timeout is None else now + timeout
+        # стоимость запроса в допуске считается по количеству токенов, как и на этапах группировки
+        unique = list(dict.fromkeys(queries))
+        lengths = dict(zip(unique, self.encoder.count_tokens(unique)))
+        with self.lock:
+            keys = [self.query_key(query, model) for query in queries]
+            # запросы, для которых создаются новые задачи: ключ -> запрос
+            new = {}
+            for query, key in zip(queries, keys):
+                task_id = self.in_flight.get(key)
+                if key not in new and (task_id is None or stream or
+                                       not self.can_attach(self.tasks[task_id], now, timeout, priority)):
+                    new[key] = query
+            # задачи, созданные для этой группы: ключ -> идентификатор задачи
+            created = {}
+            retry_after = self.admission.acquire([lengths[query] for query in new.values()]) if new else None
+            if retry_after is not None:
+                print("Queue overflow", file=sys.stderr)
+                raise ProcessingQueueOverflowException("Queue is full, try requesting later", retry_after)
+
+            for query, key, waiter in zip(queries, keys, waiters):
+                if key in new:
+                    task = ProcessingTask(new.pop(key), priority=priority, tenant=tenant)
+                    task.time_created = now
+                    task.deadline = deadline
+                    task.stream = stream
+                    task.model = model
+                    if self.tracer is not None:
+                        self.tracer.start(task, len(self.pipeline.stage_names()))
+                    task_id = created[key] = task.id
+                    if not stream:
+                        self.in_flight[key] = task_id
+                    self.tasks[task_id] = PendingTask(key, [waiter], deadline, lengths[query], priority)
+                    tasks.append(task)
+                else:
+                    task_id = created.get(key) or self.in_flight[key]
+                    self.tasks[task_id].waiters.append(waiter)
+                    self.deduplicated += 1
+                task_ids.append(task_id)
+
+        if len(tasks) > 1:
+            for task in tasks:
+                task.group = tasks[0].id
+                task.group_size = len(tasks)
+
+        if len(tasks) == 1:
+            self.pipeline.input.put(tasks[0])
+        elif tasks:
+            # группа передаётся одним сообщением
+            self.pipeline.input.put(tasks)
+        return task_ids
+
+    def detach(self, task_id, waiter):
+        """
+        Перестаёт ожидать результат задачи; задача, которую больше никто не ожидает, забывается
+        """
+        with self.lock:
+            pending = self.tasks.get(task_id)
+            if pending is None:
+                return
+            if waiter in pending.waiters:
+                pending.waiters.remove(waiter)
+            if not pending.waiters:
+                self._forget(task_id, completed=False)
+
+    def _forget(self, task_id, completed=True):
+        pending = self.tasks.pop(task_id)
+        if self.in_flight.get(pending.key) == task_id:
+            self.in_flight.pop(pending.key)
+        self.admission.release(pending.length, completed)
+        return pending
+
+    def lookup(self, queries, timeout=None, priority=None, tenant=None, model=None):
+        """
+        Ищет результаты запросов в кэше; промахи ставятся в очередь обработки одной группой
+        :return: (concurrent.futures.Future для каждого запроса,
+            пары (идентификатор задачи, ожидающий объект) для каждого запроса; у найденных в кэше - None)
+        """
+        futures = []
+        misses = []
+        model = self.resolve_model(model)
+        for query in queries:
+            future = Future()
+            value = self.cache.get(self.query_key(query, model))
+            if value is None:
+                misses.append((query, future))
+            else:
+                future.set_result(value)
+            futures.append(future)
+
+        task_ids = {}
+        if misses:
+            ids = self.submit_many([query for query, _ in misses], [future for _, future in misses], timeout,
+                                   priority, tenant, model=model)
+            for (query, future), task_id in zip(misses, ids):
+                task_ids[future] = task_id
+                future.add_done_callback(lambda done, key=self.query_key(query, model): self.cache.put(key, done.result()))
+        return futures, [(task_ids.get(future), future) for future in futures]
+
+    def process_query(self, query, timeout=None, priority=None, tenant=None, model=None):
         """
         Обрабатывает запрос на вывод из модели
         :return: Обработанный запрос
         """
-        if len(self.tasks) >= self.queue_size:
-            print("Queue overflow", file=sys.stderr)
-            raise ProcessingQueueOverflowException("Queue is full, try requesting later")
-        task = ProcessingTask(query)
-        print("A new task: ", task.data, " queue size: ", len(self.tasks), 'component queues', self.pipeline.q_sizes())
-        future = Future()
-        self.tasks[task.id] = future
+        if self.cache is not None:
+            futures, waiting = self.lookup([query], timeout, priority, tenant, model=model)
+            try:
+                return futures[0].result(timeout)
+            except TimeoutError as e:
+                self._detach_all(futures, waiting)
+                raise e
 
-        self.pipeline.input.put(task)
+        future = Future()
+        task_id = self.submit(query, future, timeout, priority, tenant, model=model)
         try:
             return future.result(timeout)
         except TimeoutError as e:
-            self.tasks.pop(task.id)
+            self.detach(task_id, future)
+            raise e
+
+    async def process_query_async(self, query, timeout=None, priority=None, tenant=None, model=None):
+        """
+        Обрабатывает запрос на вывод из модели, не блокируя цикл событий
+        :return: Обработанный запрос
+        """
+        if self.cache is not None:
+            futures, waiting = self.lookup([query], timeout, priority, tenant, model=model)
+            try:
+                return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(futures[0])), timeout)
+            except asyncio.TimeoutError as e:
+                self._detach_all(futures, waiting)
+                raise e
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = LoopFuture(loop, future)
+        task_id = self.submit(query, waiter, timeout, priority, tenant, model=model)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError as e:
+            self.detach(task_id, waiter)
             raise e
 
+    def stream_query(self, query, timeout=None, priority=None, tenant=None, model=None):
+        """
+        Ставит запрос в очередь обработки с передачей результата частями по мере декодирования.
+        Модели без пошагового декодирования передают результат одной частью
+        :return: итератор частей результата; по истечении timeout выбрасывает TimeoutError
+        """
+        channel = StreamChannel()
+        task_id = self.submit_many([query], [channel], timeout, priority, tenant, stream=True, model=model)[0]
+        return self._iterate_stream(channel, task_id, timeout)
+
+    def _iterate_stream(self, channel, task_id, timeout):
+        try:
+            yield from channel.chunks(timeout)
+        finally:
+            self.detach(task_id, channel)
+
+    def stream_query_async(self, query, timeout=None, priority=None, tenant=None, model=None):
+        """
+        Ставит запрос в очередь обработки с передачей результата частями из цикла событий
+        :return: асинхронный итератор частей результата; по истечении timeout выбрасывает asyncio.TimeoutError
+        """
+        channel = AsyncStreamChannel(asyncio.get_running_loop())
+        task_id = self.submit_many([query], [channel], timeout, priority, tenant, stream=True, model=model)[0]
+        return self._iterate_stream_async(channel, task_id, timeout)
+
+    async def _iterate_stream_async(self, channel, task_id, timeout):
+        try:
+            async for chunk in channel.chunks(timeout):
+                yield chunk
+        finally:
+            self.detach(task_id, channel)
+
+    def process_queries(self, queries, timeout=None, priority=None, tenant=None, model=None):
+        """
+        Ставит группу запросов в очередь обработки
+        :return: итератор пар (номер запроса, результат) в порядке готовности;
+            по истечении timeout выбрасывает TimeoutError
+        """
+        if self.cache is not None:
+            futures, waiting = self.lookup(queries, timeout, priority, tenant, model=model)
+            return self._iterate_results(futures, waiting, timeout)
+
+        futures = [Future() for _ in queries]
+        task_ids = self.submit_many(queries, futures, timeout, priority, tenant, model=model)
+        return self._iterate_results(futures, list(zip(task_ids, futures)), timeout)
+
+    @staticmethod
+    def _index_futures(futures):
+        """
+        Номера запросов для каждого Future; одинаковые запросы могут ожидать один Future
+        """
+        index = {}
+        for i, future in enumerate(futures):
+            index.setdefault(future, []).append(i)
+        return index
+
+    def _iterate_results(self, futures, waiting, timeout):
+        index = self._index_futures(futures)
+        try:
+            for future in as_completed(index, timeout):
+                for i in index[future]:
+                    yield i, future.result()
+        finally:
+            self._detach_all(futures, waiting)
+
+    def process_queries_async(self, queries, timeout=None, priority=None, tenant=None, model=None):
+        """
+        Ставит группу запросов в очередь обработки из цикла событий
+        :return: асинхронный итератор пар (номер запроса, результат) в порядке готовности;
+            по истечении timeout выбрасывает asyncio.TimeoutError
+        """
+        loop = asyncio.get_running_loop()
+        if self.cache is not None:
+            futures, waiting = self.lookup(queries, timeout, priority, tenant, model=model)
+            wrapped = {}
+            for future in futures:
+                if future not in wrapped:
+                    wrapped[future] = asyncio.wrap_future(future)
+            return self._iterate_results_async(loop, [wrapped[future] for future in futures], waiting, timeout)
+
+        futures = [loop.create_future() for _ in queries]
+        waiters = [LoopFuture(loop, future) for future in futures]
+        task_ids = self.submit_many(queries, waiters, timeout, priority, tenant, model=model)
+        return self._iterate_results_async(loop, futures, list(zip(task_ids, waiters)), timeout)
+
+    async def _iterate_results_async(self, loop, futures, waiting, timeout):
+        index = self._index_futures(futures)
+        deadline = None if timeout is None else loop.time() + timeout
+        pending = set(index)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=None if deadline is None else max(deadline - loop.time(), 0),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for future in done:
+                    for i in index[future]:
+                        yield i, future.result()
+        finally:
+            self._detach_all(futures, waiting)
+
+    def _detach_all(self, futures, waiting):
+        """
+        Перестаёт ожидать незавершённые задачи группы
+        :param waiting: пары (идентификатор задачи, ожидающий объект) для каждого запроса
+        """
+        for future, (task_id, waiter) in zip(futures, waiting):
+            if not future.done():
+                self.detach(task_id, waiter)
+
+    def dropped(self):
+        """
+        Количество задач с истёкшим сроком, отброшенных каждым из этапов обработки
+        """
+        return self.pipeline.dropped()
+
+    def metrics(self):
+        """
+        Показатели этапов обработки, кэша и очереди задач в формате Prometheus
+        """
+        return render_metrics(self)
+
     def queue_worker(self):
         """
-        Поток получения запросов из self.pipeline
+        Поток получения запросов из self.pipeline; результат передаётся всем ожидающим его запросам
         """
         while not self.stop_event.is_set():
-            result = self.pipeline.output.get()
-            if result.id in self.tasks:
-                self.tasks[result.id].set_result(result.data)
-                self.tasks.pop(result.id)
+            chunks, results = split_chunks(as_tasks(self.pipeline.output.get()))
+            with self.lock:
+                streamed = [(self.tasks[chunk.id].waiters, chunk.data) for chunk in chunks if chunk.id in self.tasks]
+                resolved = [(self._forget(result.id), result.data) for result in results if result.id in self.tasks]
+            for waiters, text in streamed:
+                for waiter in waiters:
+                    waiter.push(text)
+            for pending, data in resolved:
+                for waiter in pending.waiters:
+                    waiter.set_result(data)
+            now = time()
+            for result in results:
+                self.class_metrics.observe(result.priority, now - result.time_created)
+            if self.tracer is not None:
+                for result in results:
+                    if result.trace is not None:
+                        self.tracer.finish(result, self.pipeline.stage_names())
+
+
+def model_stage(model_path, workers=(), replicas=1, continuous=False, max_slots=64, max_cells=None, warmup=None):
+    """
+    Этап применения модели; каждая реплика загружает модель в своём процессе
+    :param workers: этапы перед моделью; оценка времени работы модели берётся у адаптивного генератора групп
+    :param replicas: количество процессов, применяющих модель
+    :param continuous: декодировать пошагово, меняя состав группы между шагами (ContinuousModelApplier)
+    :param max_slots: максимальное количество одновременно декодируемых последовательностей при continuous
+    :param max_cells: ограничение размера декодируемой группы при continuous, None - без ограничения
+    :param warmup: прогрев модели Warmup перед началом обработки, None - без прогрева
+    """
+    if continuous:
+        model_appliers = [ContinuousModelApplier(model_path, max_slots=max_slots, max_cells=max_cells, warmup=warmup)
+                          for _ in range(replicas)]
+    else:
+        # оценка времени работы модели для адаптивной группировки
+        latency_estimator = next((worker.latency_estimator for worker in workers
+                                  if getattr(worker, 'latency_estimator', None) is not None), None)
+        model_appliers = [ModelApplier(model_path, latency_estimator=latency_estimator, warmup=warmup)
+                          for _ in range(replicas)]
+    if replicas > 1:
+        return ReplicatedWorker(model_appliers, cost=batch_cells)
+    return model_appliers[0]
+
+
+def model_id(model_path):
+    """
+    Идентификатор файла модели, входящий в ключи запросов
+    """
+    return '{}@{}'.format(os.path.abspath(model_path), os.path.getmtime(model_path))
 
 
 class BaseModelProcessor(BaseProcessor):
     """
     Обработчик запросов, использующий модель
     """
-    def __init__(self, *workers, model_path):
-        super(BaseModelProcessor, self).__init__(*workers, ModelApplier(model_path), Flattener())
+    def __init__(self, *workers, model_path, replicas=1, continuous=False, max_slots=64, max_cells=None, warmup=None,
+                 **kwargs):
+        """
+        :param replicas: количество процессов, применяющих модель
+        :param continuous: декодировать пошагово, меняя состав группы между шагами (ContinuousModelApplier)
+        :param max_slots: максимальное количество одновременно декодируемых последовательностей при continuous
+        :param max_cells: ограничение размера декодируемой группы при continuous, None - без ограничения
+        :param warmup: прогрев модели Warmup перед началом обработки, None - без прогрева
+        """
+        self.model_stage = model_stage(model_path, workers, replicas, continuous, max_slots, max_cells, warmup)
+        # группа после модели не разбивается: детокенизация и передача результатов выполняются для группы целиком
+        super(BaseModelProcessor, self).__init__(*workers, self.model_stage, **kwargs)
+        self.model_path = model_path
+        self.model_id = model_id(model_path)
+
+    def reload(self, model=None, model_path=None):
+        """
+        Перезагружает модель без остановки обработки; реплики перезагружаются по одной
+        :param model_path: путь к новому файлу модели, None - повторно загрузить текущий
+        :raise ModelLoadingError: модель не загружена; обработку продолжает прежняя модель
+        """
+        with self.reload_lock:
+            model_path = model_path or self.model_path
+            self.model_stage.reload(model_path)
+            self.model_path = model_path
+            # результаты новой модели не смешиваются с результатами прежней в кэше
+            self.model_id = model_id(model_path)
+
+
+class HostedModel:
+    """
+    Описание модели обработчика MultiModelProcessor: этапы перед моделью и параметры этапа модели
+    """
+    def __init__(self, *workers, model_path, replicas=1, continuous=False, max_slots=64, max_cells=None,
+                 warmup=None):
+        """
+        :param workers: этапы перед моделью, обычно генератор групп
+        :param replicas: количество процессов, применяющих модель
+        :param continuous: декодировать пошагово (ContinuousModelApplier)
+        :param max_slots: максимальное количество одновременно декодируемых последовательностей при continuous
+        :param max_cells: ограничение размера декодируемой группы при continuous, None - без ограничения
+        :param warmup: прогрев модели Warmup перед началом обработки, None - без прогрева
+        """
+        self.workers = workers
+        self.model_path = model_path
+        self.replicas = replicas
+        self.continuous = continuous
+        self.max_slots = max_slots
+        self.max_cells = max_cells
+        self.warmup = warmup
 
+    def stage(self):
+        return model_stage(self.model_path, self.workers, self.replicas, self.continuous, self.max_slots,
+                           self.max_cells, self.warmup)
+
+
+class MultiModelProcessor(BaseProcessor):
+    """
+    Обработчик запросов, использующий несколько моделей.
+
+    Токенизация, детокенизация и очередь задач общие, а у каждой модели свой конвейер из этапов перед моделью
+    и этапа модели (RoutedWorker); задача попадает в конвейер модели, указанной в запросе.
+    Процессы моделей применяют группы по очереди через общий ModelScheduler, который отдаёт освободившееся
+    место наиболее нагруженной модели
+    """
+    def __init__(self, models, default_model=None, concurrency=None, transport=None, mode=Pipeline.PROCESSES,
+                 **kwargs):
+        """
+        :param models: название модели -> HostedModel
+        :param default_model: модель запросов без названия модели, по умолчанию первая
+        :param concurrency: количество групп, одновременно применяемых всеми процессами моделей, обычно не больше
+            количества ядер; None - без ограничения и без общего планировщика
+        """
+        assert models, UnknownModelException('No models to host')
+        self.default_model = default_model or next(iter(models))
+        assert self.default_model in models, UnknownModelException('Unknown default model ' + self.default_model)
+        branches = {}
+        appliers = {}
+        self.model_stages = {}
+        for name, hosted in models.items():
+            stage = self.model_stages[name] = hosted.stage()
+            appliers[name] = stage.replicas if isinstance(stage, ReplicatedWorker) else [stage]
+            branches[name] = Pipeline(*hosted.workers, stage, transport=transport, mode=mode)
+        router = RoutedWorker(branches, key=attrgetter('model'))
+        router.scheduler = None
+        if concurrency is not None:
+            router.scheduler = ModelScheduler(len(models), concurrency)
+            for idx, name in enumerate(models):
+                for applier in appliers[name]:
+                    applier.scheduler = router.scheduler
+                    applier.model_index = idx
+        super(MultiModelProcessor, self).__init__(router, transport=transport, mode=mode, **kwargs)
+        self.model_paths = {name: hosted.model_path for name, hosted in models.items()}
+        self.model_ids = {name: model_id(path) for name, path in self.model_paths.items()}
+
+    def models(self):
+        """
+        Названия моделей обработчика
+        """
+        return list(self.model_ids)
+
+    def resolve_model(self, model=None):
+        """
+        Название модели, обрабатывающей запрос
+        """
+        if model is None:
+            return self.default_model
+        if model not in self.model_ids:
+            raise UnknownModelException('Unknown model ' + model)
+        return model
+
+    def query_key(self, query, model=None):
+        return self.model_ids[model], query
+
+    def reload(self, model=None, model_path=None):
+        """
+        Перезагружает модель без остановки обработки; реплики модели перезагружаются по одной
+        :param model: название модели, None - модель по умолчанию
+        :param model_path: путь к новому файлу модели, None - повторно загрузить текущий
+        :raise ModelLoadingError: модель не загружена; обработку продолжает прежняя модель
+        """
+        model = self.resolve_model(model)
+        with self.reload_lock:
+            model_path = model_path or self.model_paths[model]
+            self.model_stages[model].reload(model_path)
+            self.model_paths[model] = model_path
+            self.model_ids[model] = model_id(model_path)
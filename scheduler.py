@@ -0,0 +1,72 @@
+from multiprocessing import Condition, Array, Value
+from time import time
+
+
+class ModelScheduler:
+    """
+    Распределение процессорного времени между моделями.
+
+    Группу может применять одновременно не больше slots процессов моделей. Когда места заняты, освободившееся
+    место получает модель с наибольшей нагрузкой: размер ожидающей группы, умноженный на количество
+    сообщений в очереди модели и на время ожидания, чтобы слабо нагруженные модели не ждали бесконечно.
+    Состояние хранится в разделяемой памяти, поэтому процессы моделей договариваются без отдельного этапа
+    """
+    def __init__(self, n_models, slots=1, aging=1.0):
+        """
+        :param n_models: количество моделей
+        :param slots: количество одновременно применяемых групп
+        :param aging: за сколько секунд ожидания нагрузка ожидающей модели удваивается
+        """
+        self.aging = aging
+        self.condition = Condition()
+        self.free = Value('i', slots, lock=False)
+        # количество ожидающих места процессов каждой модели, их суммарная нагрузка и начало ожидания
+        self.waiting = Array('i', n_models, lock=False)
+        self.loads = Array('d', n_models, lock=False)
+        self.since = Array('d', n_models, lock=False)
+        # время применения моделей и время ожидания места
+        self.busy = Array('d', n_models, lock=False)
+        self.waited = Array('d', n_models, lock=False)
+
+    def _next(self, now):
+        """
+        Модель, получающая следующее место
+        """
+        waiting = [idx for idx in range(len(self.loads)) if self.waiting[idx] > 0]
+        return max(waiting, key=lambda idx: self.loads[idx] * (1 + (now - self.since[idx]) / self.aging))
+
+    def acquire(self, idx, load):
+        """
+        Ожидает места для применения модели idx
+        :param load: нагрузка модели
+        """
+        load = max(load, 1e-9)
+        with self.condition:
+            started = time()
+            self.waiting[idx] += 1
+            self.loads[idx] += load
+            self.since[idx] = self.since[idx] or started
+            # пришедшая модель может быть нагружена больше уже ожидающих
+            self.condition.notify_all()
+            while self.free.value <= 0 or self._next(time()) != idx:
+                self.condition.wait()
+            self.free.value -= 1
+            self.waiting[idx] -= 1
+            self.loads[idx] -= load
+            if not self.waiting[idx]:
+                self.loads[idx] = 0
+                self.since[idx] = 0
+            self.waited[idx] += time() - started
+            if self.free.value > 0 and any(self.waiting):
+                # следующая по нагрузке модель может занять оставшееся место
+                self.condition.notify_all()
+
+    def release(self, idx, elapsed):
+        """
+        Освобождает место модели idx
+        :param elapsed: время применения модели
+        """
+        with self.condition:
+            self.free.value += 1
+            self.busy[idx] += elapsed
+            self.condition.notify_all()
@@ -1,6 +1,8 @@
-from processor import BaseProcessor
-from flask import Flask, request
+from processor import BaseProcessor, ProcessingQueueOverflowException, UnknownModelException
+from flask import Flask, Response, request
 from exceptions import MessagedException
+from workers.model import ModelLoadingError
+import json
 
 
 class InvalidRequestSizeException(MessagedException):
@@ -10,16 +12,87 @@ class InvalidRequestSizeException(MessagedException):
     pass
 
 
+def parse_bulk_queries(body, mimetype, max_query_len, max_bulk_size):
+    """
+    Разбирает тело запроса с группой запросов: JSON-массив или NDJSON.
+    Элемент - строка запроса или объект с полем query
+    """
+    if mimetype == 'application/x-ndjson':
+        items = [json.loads(line) for line in body.splitlines() if line.strip()]
+    else:
+        items = json.loads(body)
+    assert isinstance(items, list) and 0 < len(items) <= max_bulk_size, InvalidRequestSizeException
+
+    queries = [item.get('query', '') if isinstance(item, dict) else item for item in items]
+    for query in queries:
+        assert isinstance(query, str) and max_query_len >= len(query) > 0, InvalidRequestSizeException
+    return queries
+
+
+def overload_headers(e: ProcessingQueueOverflowException):
+    """
+    Заголовки ответа 503 на отклонённый запрос
+    """
+    if e.retry_after is None:
+        return {}
+    return {'Retry-After': str(e.retry_after)}
+
+
+def request_class(headers, args):
+    """
+    Класс приоритета и ключ клиента запроса: из заголовков X-Priority и X-Tenant или параметров priority и tenant
+    :return: (класс приоритета, ключ клиента), отсутствующие значения - None
+    """
+    return (headers.get('X-Priority') or args.get('priority') or None,
+            headers.get('X-Tenant') or args.get('tenant') or None)
+
+
+def request_model(headers, args):
+    """
+    Название модели запроса: из заголовка X-Model или параметра model, None - модель по умолчанию
+    """
+    return headers.get('X-Model') or args.get('model') or None
+
+
+def wants_events(accept):
+    """
+    Принимает ли клиент ответ в формате server-sent events
+    """
+    return 'text/event-stream' in (accept or '')
+
+
+def stream_event(data, event=None):
+    """
+    Событие server-sent events; текст передаётся строкой JSON, чтобы переводы строк не разрывали событие
+    """
+    lines = '' if event is None else 'event: {}\n'.format(event)
+    return lines + 'data: {}\n\n'.format(json.dumps(data, ensure_ascii=False))
+
+
+def bulk_line(index, result=None, error=None):
+    """
+    Строка ответа NDJSON для одного запроса группы
+    """
+    line = {'index': index}
+    if error is None:
+        line['result'] = result
+    else:
+        line['error'] = error
+    return json.dumps(line, ensure_ascii=False) + '\n'
+
+
 class Server:
     """
     Класс, занимающийся принятием и отправкой http запросов
     """
-    def __init__(self, processor: BaseProcessor, host='localhost', port=2532, timeout=5, max_query_len=50):
+    def __init__(self, processor: BaseProcessor, host='localhost', port=2532, timeout=5, max_query_len=50,
+                 max_bulk_size=500):
         self.app = Flask('balancer')
         self.timeout = timeout
         self.host = host
         self.port = port
         self.max_query_len = max_query_len
+        self.max_bulk_size = max_bulk_size
         self.register_callbacks()
         self.processor = processor
 
@@ -28,6 +101,49 @@ class Server:
         Привязывает обработчик http запросов к пути запроса
         """
         self.app.route('/', methods=['GET'])(self.get_query)
+        self.app.route('/bulk', methods=['POST'])(self.post_queries)
+        self.app.route('/stream', methods=['GET'])(self.get_stream)
+        self.app.route('/metrics', methods=['GET'])(self.get_metrics)
+        self.app.route('/ready', methods=['GET'])(self.get_ready)
+        self.app.route('/reload', methods=['POST'])(self.post_reload)
+        self.app.route('/debug/traces', methods=['GET'])(self.get_traces)
+        self.app.route('/debug/trace_events', methods=['GET'])(self.get_trace_events)
+        self.app.register_error_handler(ProcessingQueueOverflowException, self.overloaded)
+        self.app.register_error_handler(UnknownModelException, self.unknown_model)
+        self.app.register_error_handler(ModelLoadingError, self.reload_failed)
+
+    def overloaded(self, e):
+        """
+        Ответ на запрос, не допущенный в обработку: клиенту сообщается, когда повторить запрос
+        """
+        return Response(e.message, status=503, headers=overload_headers(e))
+
+    def unknown_model(self, e):
+        """
+        Ответ на запрос к модели, которой нет в обработчике
+        """
+        return Response(e.message, status=404)
+
+    def reload_failed(self, e):
+        """
+        Ответ на неудачную перезагрузку модели; запросы продолжает обрабатывать прежняя модель
+        """
+        return Response(e.message, status=500)
+
+    def get_ready(self):
+        """
+        Проверка готовности: 200, когда модели загружены и прогреты, иначе 503
+        """
+        if self.processor.ready():
+            return 'ready'
+        return Response('not ready', status=503)
+
+    def post_reload(self):
+        """
+        Перезагружает модель из её файла без остановки обработки; отвечает после перехода на новую модель
+        """
+        self.processor.reload(request_model(request.headers, request.args))
+        return 'reloaded'
 
     def get_query(self):
         """
@@ -36,15 +152,101 @@ class Server:
         query = request.args.get('query', '')
         assert self.max_query_len >= len(query) > 0, InvalidRequestSizeException
 
-        result = self.processor.process_query(query, self.timeout)
+        priority, tenant = request_class(request.headers, request.args)
+        model = request_model(request.headers, request.args)
+        result = self.processor.process_query(query, self.timeout, priority, tenant, model)
 
         return result
 
+    def get_stream(self):
+        """
+        Обработчик запроса с передачей результата частями по мере декодирования:
+        server-sent events, если клиент их принимает, иначе текст с chunked transfer encoding
+        """
+        query = request.args.get('query', '')
+        assert self.max_query_len >= len(query) > 0, InvalidRequestSizeException
+
+        priority, tenant = request_class(request.headers, request.args)
+        model = request_model(request.headers, request.args)
+        chunks = self.processor.stream_query(query, self.timeout, priority, tenant, model)
+
+        if not wants_events(request.headers.get('Accept')):
+            def text():
+                try:
+                    yield from chunks
+                except TimeoutError:
+                    pass
+
+            return Response(text(), mimetype='text/plain')
+
+        def events():
+            try:
+                for chunk in chunks:
+                    yield stream_event(chunk)
+                yield stream_event('', 'end')
+            except TimeoutError:
+                yield stream_event('timeout', 'error')
+
+        return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    def post_queries(self):
+        """
+        Обработчик группы запросов; результаты отправляются строками NDJSON по мере готовности
+        """
+        queries = parse_bulk_queries(request.get_data(as_text=True), request.mimetype,
+                                     self.max_query_len, self.max_bulk_size)
+
+        priority, tenant = request_class(request.headers, request.args)
+        model = request_model(request.headers, request.args)
+        results = self.processor.process_queries(queries, self.timeout, priority, tenant, model)
+
+        def stream():
+            done = set()
+            try:
+                for index, result in results:
+                    done.add(index)
+                    yield bulk_line(index, result)
+            except TimeoutError:
+                for index in range(len(queries)):
+                    if index not in done:
+                        yield bulk_line(index, error='timeout')
+
+        return Response(stream(), mimetype='application/x-ndjson')
+
+    def get_metrics(self):
+        """
+        Показатели обработки запросов в формате Prometheus
+        """
+        return Response(self.processor.metrics(), mimetype='text/plain; version=0.0.4')
+
+    def get_traces(self):
+        """
+        Самые долгие из недавних трассировок запросов, количество задаётся параметром n
+        """
+        if self.processor.tracer is None:
+            return Response('tracing is disabled', status=404)
+        n = request.args.get('n', 10, type=int)
+        return Response(json.dumps(self.processor.tracer.slowest(n)), mimetype='application/json')
+
+    def get_trace_events(self):
+        """
+        Недавние трассировки запросов в формате Chrome trace events
+        """
+        if self.processor.tracer is None:
+            return Response('tracing is disabled', status=404)
+        return Response(json.dumps(self.processor.tracer.chrome_trace()), mimetype='application/json')
+
     def run(self):
         """
         Запускает сервер
         """
         self.processor.start()
+        try:
+            # сервер не принимает запросы, если модель не удалось загрузить
+            self.processor.wait_loaded()
+        except ModelLoadingError:
+            self.processor.stop()
+            raise
 
         self.app.run(host=self.host, port=self.port, threaded=True)
 
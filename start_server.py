@@ -14,9 +14,18 @@ from server import Server
 from processor import *
 import os
 import configparser
+from functools import partial
 from workers.batch_generation import TimeoutCostBatchGenerator, TimeoutBatchGenerator, NaiveBatchGenerator
+from workers.adaptive import AdaptiveBatchGenerator
 import sys
 from exceptions import MessagedException
+from transport import TRANSPORTS
+from cache import ResultCache
+from text_encoders import ENCODERS
+from tracing import Tracer
+from admission import AdmissionControl
+from priorities import PriorityClasses
+from workers.model import Warmup
 
 
 def create_config(path):
@@ -26,16 +35,71 @@ def create_config(path):
     config = configparser.ConfigParser()
     config.add_section('Settings')
     config.set('Settings', 'model_path', '')
+    config.set('Settings', 'model_replicas', '1')
     config.set('Settings', 'host', 'localhost')
     config.set('Settings', 'request_timeout', '10')
     config.set('Settings', 'max_query_len', '50')
+    config.set('Settings', 'max_bulk_size', '500')
     config.set('Settings', 'port', '2352')
+    config.set('Settings', 'transport', 'queue')
+    # последовательности не короче этой длины передаются транспортом shared_memory через разделяемую память,
+    # более короткие - через очередь, которая для них быстрее; буфер используется, только если значение
+    # меньше max_query_len
+    config.set('Settings', 'shared_memory_min_length', '512')
+    config.set('Settings', 'execution_mode', 'processes')
+    config.set('Settings', 'server', 'flask')
+    config.set('Settings', 'default_priority', 'default')
 
+    config.add_section('Cache')
+    config.set('Cache', 'enabled', 'false')
+    config.set('Cache', 'max_entries', '10000')
+    config.set('Cache', 'max_bytes', str(64 << 20))
+    config.set('Cache', 'ttl', '0')
+    config.set('Cache', 'spill_path', '')
+
+    config.add_section('PriorityClasses')
+    config.set('PriorityClasses', 'default', '1')
+
+    config.add_section('Tenants')
+
+    config.add_section('Admission')
+    config.set('Admission', 'max_tasks', '900')
+    config.set('Admission', 'budget', '0')
+    config.set('Admission', 'decode_cost', '1')
+    config.set('Admission', 'bucket_share', '0.5')
+    config.set('Admission', 'window', '10')
+    config.set('Admission', 'max_retry_after', '60')
+
+    config.add_section('Tracing')
+    config.set('Tracing', 'sample_rate', '0')
+    config.set('Tracing', 'capacity', '1000')
+
+    config.add_section('Tokenizer')
+    config.set('Tokenizer', 'type', 'char')
+    config.set('Tokenizer', 'vocab_path', '')
+    config.set('Tokenizer', 'merges_path', '')
+    config.set('Tokenizer', 'cache_size', '100000')
+
+    config.add_section('Warmup')
+    config.set('Warmup', 'lengths', '8, 32')
+    config.set('Warmup', 'batch_size', '8')
+
+    config.add_section('ContinuousBatching')
+    config.set('ContinuousBatching', 'enabled', 'false')
+    config.set('ContinuousBatching', 'max_slots', '64')
+    config.set('ContinuousBatching', 'max_cells', '0')
+
+    # несколько моделей: секция Models с названиями моделей (names), моделью по умолчанию (default)
+    # и concurrency - сколько групп все процессы моделей применяют одновременно; когда места заняты,
+    # следующее получает наиболее нагруженная модель. Распределение включается явно значением меньше
+    # количества процессов моделей; по умолчанию 0 - без ограничения. Секции Model:<название> содержат
+    # model_path, model_replicas и настройки BatchGeneration и ContinuousBatching (continuous) для отдельной модели
     config.add_section('BatchGeneration')
     config.set('BatchGeneration', 'strategy', 'CostBased')
     config.set('BatchGeneration', 'batch_size', '64')
     config.set('BatchGeneration', 'batch_wait_timeout', '4')
     config.set('BatchGeneration', 'parallel_size', '1000')
+    config.set('BatchGeneration', 'latency_slo', '1')
 
     with open(path, 'w') as config_file:
         config.write(config_file)
@@ -72,58 +136,224 @@ try:
 
     config = process_config(config_path)
 
-    def get_int(section, name):
+    def get_value(section, name, fallback=None):
+        if fallback is None:
+            return config.get(section, name)
+        return config.get(section, name, fallback=str(fallback))
+
+    def get_int(section, name, fallback=None):
         try:
-            return int(config.get(section, name))
+            return int(get_value(section, name, fallback))
         except ValueError:
             raise MessagedException('{}/{} must be integer'.format(section, name))
 
-    def get_float(section, name):
+    def get_float(section, name, fallback=None):
         try:
-            return float(config.get(section, name))
+            return float(get_value(section, name, fallback))
         except ValueError:
             raise MessagedException('{}/{} must be a real value'.format(section, name))
 
-    model_path = config.get('Settings', 'model_path')
-    if not os.path.isabs(model_path):
-        model_path = os.path.join(config_dir, model_path)
     host = config.get('Settings', 'host')
     port = get_int('Settings', 'port')
     assert port > 0, MessagedException("Port must be a positive integer")
     max_query_len = get_int('Settings', 'max_query_len')
     assert max_query_len > 0, MessagedException("max_query_len must be a positive integer")
+    max_bulk_size = get_int('Settings', 'max_bulk_size', 500)
+    assert max_bulk_size > 0, MessagedException("max_bulk_size must be a positive integer")
     request_timeout = get_float('Settings', 'request_timeout')
     assert request_timeout > 0, MessagedException("request timeout must be positive")
-    batch_generator_name = config.get('BatchGeneration', 'strategy')
+    server_name = config.get('Settings', 'server', fallback='flask')
+    if server_name == 'flask':
+        server_class = Server
+    elif server_name == 'asyncio':
+        from async_server import AsyncServer
+        server_class = AsyncServer
+    else:
+        raise MessagedException('unknown server')
+    transport_name = config.get('Settings', 'transport', fallback='queue')
+    assert transport_name in TRANSPORTS, MessagedException('unknown transport')
+    transport = TRANSPORTS[transport_name]
+    if transport_name == 'shared_memory':
+        shared_memory_min_length = get_int('Settings', 'shared_memory_min_length', 512)
+        assert shared_memory_min_length > 0, \
+            MessagedException("shared_memory_min_length must be a positive integer")
+        transport = partial(transport, min_length=shared_memory_min_length)
+    execution_mode = config.get('Settings', 'execution_mode', fallback=Pipeline.PROCESSES)
+    assert execution_mode in (Pipeline.PROCESSES, Pipeline.THREADS), MessagedException('unknown execution_mode')
+    cache = None
+    if config.getboolean('Cache', 'enabled', fallback=False):
+        cache_ttl = get_float('Cache', 'ttl', 0)
+        assert cache_ttl >= 0, MessagedException("Cache/ttl must be non-negative")
+        spill_path = config.get('Cache', 'spill_path', fallback='')
+        if spill_path and not os.path.isabs(spill_path):
+            spill_path = os.path.join(config_dir, spill_path)
+        cache = ResultCache(max_entries=get_int('Cache', 'max_entries', 10000),
+                            max_bytes=get_int('Cache', 'max_bytes', 64 << 20),
+                            ttl=cache_ttl or None,
+                            spill_path=spill_path or None)
 
-    if batch_generator_name == 'CostBased':
-        batch_size = get_int('BatchGeneration', 'batch_size')
-        assert batch_size > 0, MessagedException("batch_size must be positive")
+    def get_path(section, name):
+        path = config.get(section, name, fallback='')
+        if path and not os.path.isabs(path):
+            path = os.path.join(config_dir, path)
+        return path
 
-        timeout = get_float('BatchGeneration', 'batch_wait_timeout')
-        assert timeout > 0, MessagedException("batch_wait_timeout must be positive")
+    tracer = None
+    trace_sample_rate = get_float('Tracing', 'sample_rate', 0)
+    assert 0 <= trace_sample_rate <= 1, MessagedException("Tracing/sample_rate must be between 0 and 1")
+    if trace_sample_rate > 0:
+        trace_capacity = get_int('Tracing', 'capacity', 1000)
+        assert trace_capacity > 0, MessagedException("Tracing/capacity must be a positive integer")
+        tracer = Tracer(trace_sample_rate, trace_capacity)
 
-        parallel_size = get_float('BatchGeneration', 'parallel_size')
-        assert parallel_size > 0, MessagedException("Parallel size must be positive")
-        batch_generator = TimeoutCostBatchGenerator(batch_size, timeout, parallel_size)
-    elif batch_generator_name == 'Simple':
-        batch_size = get_int('BatchGeneration', 'batch_size')
-        assert batch_size > 0, MessagedException("batch_size must be positive")
+    priority_weights = {}
+    if config.has_section('PriorityClasses'):
+        for name in config.options('PriorityClasses'):
+            priority_weights[name] = get_float('PriorityClasses', name)
+            assert priority_weights[name] > 0, MessagedException("priority class weights must be positive")
+    tenants = dict(config.items('Tenants')) if config.has_section('Tenants') else {}
+    default_priority = config.get('Settings', 'default_priority', fallback='default')
+    priorities = PriorityClasses(priority_weights, default_priority, tenants)
+    assert all(cls in priorities.weights for cls in priorities.tenants.values()), \
+        MessagedException('unknown priority class in Tenants')
 
-        timeout = get_float('BatchGeneration', 'batch_wait_timeout')
-        assert timeout > 0, MessagedException("batch_wait_timeout must be positive")
+    max_tasks = get_int('Admission', 'max_tasks', 900)
+    assert max_tasks > 0, MessagedException("Admission/max_tasks must be a positive integer")
+    budget = get_float('Admission', 'budget', 0)
+    assert budget >= 0, MessagedException("Admission/budget must be non-negative")
+    decode_cost = get_float('Admission', 'decode_cost', 1)
+    assert decode_cost > 0, MessagedException("Admission/decode_cost must be positive")
+    bucket_share = get_float('Admission', 'bucket_share', 0.5)
+    assert 0 < bucket_share <= 1, MessagedException("Admission/bucket_share must be between 0 and 1")
+    drain_window = get_float('Admission', 'window', 10)
+    assert drain_window > 0, MessagedException("Admission/window must be positive")
+    max_retry_after = get_int('Admission', 'max_retry_after', 60)
+    assert max_retry_after > 0, MessagedException("Admission/max_retry_after must be a positive integer")
+    admission = AdmissionControl(budget=budget or None, max_tasks=max_tasks, decode_cost=decode_cost,
+                                 bucket_share=bucket_share, window=drain_window, max_retry_after=max_retry_after)
 
-        batch_generator = TimeoutBatchGenerator(batch_size, timeout)
-    elif batch_generator_name == 'Naive':
-        batch_generator = NaiveBatchGenerator()
+    encoder_name = config.get('Tokenizer', 'type', fallback='char')
+    assert encoder_name in ENCODERS, MessagedException('unknown tokenizer type')
+    encoder_cache_size = get_int('Tokenizer', 'cache_size', 100000)
+    assert encoder_cache_size > 0, MessagedException("Tokenizer/cache_size must be a positive integer")
+    if encoder_name == 'bpe':
+        encoder = ENCODERS[encoder_name](get_path('Tokenizer', 'vocab_path'), get_path('Tokenizer', 'merges_path'),
+                                         cache_size=encoder_cache_size)
+    elif encoder_name == 'wordpiece':
+        encoder = ENCODERS[encoder_name](get_path('Tokenizer', 'vocab_path'), cache_size=encoder_cache_size)
     else:
+        encoder = ENCODERS[encoder_name]()
+
+    warmup = None
+    warmup_lengths = config.get('Warmup', 'lengths', fallback='')
+    if warmup_lengths.strip():
+        try:
+            warmup_lengths = [int(length) for length in warmup_lengths.split(',')]
+        except ValueError:
+            raise MessagedException('Warmup/lengths must be a comma-separated list of integers')
+        assert all(length > 0 for length in warmup_lengths), MessagedException("Warmup/lengths must be positive")
+        warmup_batch_size = get_int('Warmup', 'batch_size', 8)
+        assert warmup_batch_size > 0, MessagedException("Warmup/batch_size must be a positive integer")
+        warmup = Warmup(warmup_lengths, warmup_batch_size)
+
+    def option_section(section, name, default_section):
+        """
+        Секция, из которой берётся настройка: секция модели, если настройка задана в ней, иначе default_section
+        """
+        return section if config.has_option(section, name) else default_section
+
+    def create_batch_generator(section='BatchGeneration'):
+        """
+        Генератор групп по настройкам секции; отсутствующие в ней настройки берутся из BatchGeneration
+        """
+        def option(name):
+            return option_section(section, name, 'BatchGeneration'), name
+
+        batch_generator_name = get_value(*option('strategy'))
+
+        if batch_generator_name == 'CostBased':
+            batch_size = get_int(*option('batch_size'))
+            assert batch_size > 0, MessagedException("batch_size must be positive")
+
+            timeout = get_float(*option('batch_wait_timeout'))
+            assert timeout > 0, MessagedException("batch_wait_timeout must be positive")
+
+            parallel_size = get_float(*option('parallel_size'))
+            assert parallel_size > 0, MessagedException("Parallel size must be positive")
+            return TimeoutCostBatchGenerator(batch_size, timeout, parallel_size, weights=priorities.weights)
+        elif batch_generator_name == 'Adaptive':
+            batch_size = get_int(*option('batch_size'))
+            assert batch_size > 0, MessagedException("batch_size must be positive")
+
+            timeout = get_float(*option('batch_wait_timeout'))
+            assert timeout > 0, MessagedException("batch_wait_timeout must be positive")
+
+            parallel_size = get_float(*option('parallel_size'))
+            assert parallel_size > 0, MessagedException("Parallel size must be positive")
+
+            latency_slo = get_float(*option('latency_slo'), 1)
+            assert latency_slo > 0, MessagedException("latency_slo must be positive")
+            return AdaptiveBatchGenerator(batch_size, timeout, parallel_size, latency_slo, weights=priorities.weights)
+        elif batch_generator_name == 'Simple':
+            batch_size = get_int(*option('batch_size'))
+            assert batch_size > 0, MessagedException("batch_size must be positive")
+
+            timeout = get_float(*option('batch_wait_timeout'))
+            assert timeout > 0, MessagedException("batch_wait_timeout must be positive")
+
+            return TimeoutBatchGenerator(batch_size, timeout, weights=priorities.weights)
+        elif batch_generator_name == 'Naive':
+            return NaiveBatchGenerator()
         raise MessagedException('unknown batch generation strategy')
 
-    Server(BaseModelProcessor(batch_generator, model_path=model_path),
-           host=host,
-           port=port,
-           timeout=request_timeout,
-           max_query_len=max_query_len).run()
+    def model_options(section='Settings'):
+        """
+        Параметры этапа модели по настройкам секции; настройки пошагового декодирования,
+        отсутствующие в ней, берутся из ContinuousBatching
+        """
+        path = get_path(section, 'model_path')
+        assert path, MessagedException("{}/model_path must be specified".format(section))
+        replicas = get_int(option_section(section, 'model_replicas', 'Settings'), 'model_replicas', 1)
+        assert replicas > 0, MessagedException("model_replicas must be a positive integer")
+        if config.has_option(section, 'continuous'):
+            continuous = config.getboolean(section, 'continuous')
+        else:
+            continuous = config.getboolean('ContinuousBatching', 'enabled', fallback=False)
+        max_slots = get_int(option_section(section, 'max_slots', 'ContinuousBatching'), 'max_slots', 64)
+        assert max_slots > 0, MessagedException("max_slots must be a positive integer")
+        max_cells = get_int(option_section(section, 'max_cells', 'ContinuousBatching'), 'max_cells', 0)
+        assert max_cells >= 0, MessagedException("max_cells must be non-negative")
+        return {'model_path': path, 'replicas': replicas, 'continuous': continuous, 'max_slots': max_slots,
+                'max_cells': max_cells or None, 'warmup': warmup}
+
+    processor_options = {'transport': transport, 'cache': cache, 'encoder': encoder,
+                         'mode': execution_mode, 'tracer': tracer, 'admission': admission, 'priorities': priorities}
+    if config.has_section('Models'):
+        model_names = [name.strip() for name in config.get('Models', 'names', fallback='').split(',') if name.strip()]
+        assert model_names, MessagedException("Models/names must list at least one model")
+        models = {}
+        for name in model_names:
+            section = 'Model:' + name
+            assert config.has_section(section), MessagedException("No section {} for the model".format(section))
+            models[name] = HostedModel(create_batch_generator(section), **model_options(section))
+        default_model = config.get('Models', 'default', fallback=model_names[0])
+        assert default_model in models, MessagedException("Models/default must be one of Models/names")
+        # по умолчанию каждый процесс модели применяет группы независимо от остальных; ограничение не меньше
+        # количества процессов моделей ни на что не влияет, и распределитель не создаётся
+        concurrency = get_int('Models', 'concurrency', 0)
+        assert concurrency >= 0, MessagedException("Models/concurrency must be non-negative")
+        if concurrency >= sum(hosted.replicas for hosted in models.values()):
+            concurrency = 0
+        processor = MultiModelProcessor(models, default_model, concurrency or None, **processor_options)
+    else:
+        processor = BaseModelProcessor(create_batch_generator(), **model_options(), **processor_options)
+
+    server_class(processor,
+                 host=host,
+                 port=port,
+                 timeout=request_timeout,
+                 max_query_len=max_query_len,
+                 max_bulk_size=max_bulk_size).run()
 except MessagedException as e:
     print('Error:', e.message)
 except Exception as e:
@@ -0,0 +1,157 @@
+from queue import SimpleQueue, Empty
+from time import time
+import asyncio
+
+
+class StreamChunk:
+    """
+    Часть результата задачи, полученная до завершения её обработки.
+    Проходит этапы после модели вместе с задачами; data - новые токены, после детокенизации - новый текст
+    """
+    def __init__(self, task, data):
+        self.id = task.id
+        self.data = data
+        self.time_created = task.time_created
+        self.deadline = task.deadline
+        self.priority = task.priority
+        self.trace = None
+
+
+def split_chunks(tasks):
+    """
+    Разделяет сообщение на части результатов и задачи
+    :return: (части, задачи)
+    """
+    chunks = [task for task in tasks if isinstance(task, StreamChunk)]
+    if not chunks:
+        return chunks, tasks
+    return chunks, [task for task in tasks if not isinstance(task, StreamChunk)]
+
+
+class IncrementalDecoder:
+    """
+    Детокенизация результатов по частям.
+
+    Для каждой задачи хранятся полученные токены и длина уже отправленного текста; после получения части
+    декодируется вся последовательность, а отправляется только новый текст, поэтому кодировщику не нужно
+    уметь декодировать отдельные части
+    """
+    def __init__(self, encoder):
+        self.encoder = encoder
+        # идентификатор задачи -> (токены, длина отправленного текста)
+        self.streams = {}
+        # идентификатор задачи -> срок задачи
+        self.deadlines = {}
+
+    def decode(self, chunks):
+        """
+        Заменяет токены частей новым текстом
+        """
+        if not chunks:
+            return
+        for chunk in chunks:
+            tokens, sent = self.streams.setdefault(chunk.id, ([], 0))
+            tokens.extend(chunk.data)
+            self.deadlines[chunk.id] = chunk.deadline
+        # одна задача может встретиться в сообщении несколько раз, текст выдаётся последней из её частей
+        last = {chunk.id: chunk for chunk in chunks}
+        ids = list(last)
+        texts = self.encoder.decode_batch([self.streams[task_id][0] for task_id in ids])
+        for task_id, text in zip(ids, texts):
+            tokens, sent = self.streams[task_id]
+            self.streams[task_id] = tokens, len(text)
+            last[task_id].data = text[sent:]
+        for chunk in chunks:
+            if last[chunk.id] is not chunk:
+                chunk.data = ''
+
+    def finish(self, tasks):
+        """
+        Забывает состояние завершённых задач
+        """
+        if self.streams:
+            for task in tasks:
+                self.streams.pop(task.id, None)
+                self.deadlines.pop(task.id, None)
+
+    def expire(self, now):
+        """
+        Забывает состояние задач с истёкшим сроком: их окончательный результат отброшен этапами обработки
+        """
+        expired = [task_id for task_id, deadline in self.deadlines.items() if deadline is not None and deadline <= now]
+        for task_id in expired:
+            self.streams.pop(task_id)
+            self.deadlines.pop(task_id)
+
+
+class StreamChannel:
+    """
+    Канал частей результата задачи: части передаются через push, окончательный результат - через set_result.
+    Итерация по каналу возвращает текст по мере поступления
+    """
+    END = None
+
+    def __init__(self):
+        self.queue = SimpleQueue()
+        self.sent = 0
+
+    def push(self, text):
+        """
+        Передаёт часть результата из стороннего потока
+        """
+        if text:
+            self.sent += len(text)
+            self._put(text)
+
+    def set_result(self, result):
+        """
+        Передаёт окончательный результат: отправляется его часть, не переданная ранее
+        """
+        if len(result) > self.sent:
+            self._put(result[self.sent:])
+        self.sent = len(result)
+        self._put(self.END)
+
+    def _put(self, item):
+        self.queue.put(item)
+
+    def chunks(self, timeout=None):
+        """
+        Части результата по мере поступления
+        :param timeout: время ожидания всего результата; по его истечении выбрасывается TimeoutError
+        """
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            try:
+                item = self.queue.get(timeout=None if deadline is None else max(deadline - time(), 0))
+            except Empty:
+                raise TimeoutError()
+            if item is self.END:
+                return
+            yield item
+
+
+class AsyncStreamChannel(StreamChannel):
+    """
+    Канал частей результата для цикла событий asyncio
+    """
+    def __init__(self, loop):
+        super(AsyncStreamChannel, self).__init__()
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def _put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    async def chunks(self, timeout=None):
+        """
+        Части результата по мере поступления
+        :param timeout: время ожидания всего результата; по его истечении выбрасывается asyncio.TimeoutError
+        """
+        deadline = None if timeout is None else self.loop.time() + timeout
+        while True:
+            item = await asyncio.wait_for(self.queue.get(),
+                                          None if deadline is None else max(deadline - self.loop.time(), 0))
+            if item is self.END:
+                return
+            yield item
@@ -8,6 +8,8 @@ class DummyTestModel:
 
     """
 
+    supports_arrays = True
+
     def __init__(self, alpha=0.01, parallel_size=1000, default_delay=0.05):
         """
         Init the dummy model
@@ -19,22 +21,108 @@ class DummyTestModel:
         self.parallel_size = parallel_size
         self.default_delay = default_delay
 
-    def process(self, batch):
+    def process(self, batch, lengths=None, mask=None):
         """
         batch of data
-        :param batch:
+        :param batch: padded sequences, a list of lists or a (batch, max_len) array
+        :param lengths: lengths of the sequences, unused
+        :param mask: mask of the real tokens, unused
         :return: the same data as in batch
         """
 
-        time = self.alpha
         lens = [len(seq) for seq in batch]
 
         max_len = max(lens)
 
-        total_data = len(batch) * max_len
+        sleep(self.cost(len(batch), max_len))
+        return batch
+
+    def cost(self, batch_size, max_len):
+        """
+        Time consumed by process for a batch
+        :param batch_size: number of sequences in the batch
+        :param max_len: length of the padded sequences
+        :return: time in seconds
+        """
+
+        time = self.alpha
+
+        total_data = batch_size * max_len
 
         time *= max_len * ceil(total_data / self.parallel_size)
         time += self.default_delay
 
-        sleep(time)
-        return batch
\ No newline at end of file
+        return time
+
+
+class DummyStepState:
+    """
+    Decoding state of one sequence of DummyStepModel
+    """
+
+    __slots__ = ('source', 'output')
+
+    def __init__(self, source):
+        self.source = list(source)
+        self.output = []
+
+
+class DummyStepModel(DummyTestModel):
+    """
+    A step-wise variant of DummyTestModel: every decode step emits one token of each sequence
+    and sleeps as one of the max_len steps of DummyTestModel.process
+
+    """
+
+    supports_steps = True
+
+    def init_state(self, batch):
+        """
+        Start decoding of the sequences
+        :param batch: list of sequences
+        :return: list of decoding states
+        """
+
+        sleep(self.default_delay)
+        return [DummyStepState(seq) for seq in batch]
+
+    def decode_step(self, states):
+        """
+        Decode one token of each sequence
+        :param states: states of the sequences, updated in place
+        :return: whether each sequence is finished
+        """
+
+        max_len = max(len(state.source) for state in states)
+        sleep(self.step_cost(len(states), max_len))
+
+        finished = []
+        for state in states:
+            if len(state.output) < len(state.source):
+                state.output.append(state.source[len(state.output)])
+            finished.append(len(state.output) >= len(state.source))
+        return finished
+
+    def finish(self, state):
+        """
+        :return: the decoded sequence, the same data as the source one
+        """
+
+        return state.output
+
+    def partial(self, state):
+        """
+        :return: the tokens decoded so far
+        """
+
+        return state.output
+
+    def step_cost(self, batch_size, max_len):
+        """
+        Time consumed by one decode step
+        :param batch_size: number of sequences decoded together
+        :param max_len: length of the longest of them
+        :return: time in seconds
+        """
+
+        return self.alpha * ceil(batch_size * max_len / self.parallel_size)
@@ -3,6 +3,7 @@ import asyncio
 import async_timeout
 import random
 import os
+import json
 import sys
 import configparser
 import matplotlib.pyplot as plt
@@ -76,17 +77,17 @@ tests_folder = tests_folder if tests_folder.startswith('/') else os.path.join(*_
 
 test_folder = os.path.join(tests_folder, test_name)
 
-percentiles = eval(config.get('Settings', 'percentiles'))
+percentiles = json.loads(config.get('Settings', 'percentiles'))
 assert type(percentiles) == list
 
-query_len_probas = eval(config.get('Settings', 'query_len_probas'))
+query_len_probas = json.loads(config.get('Settings', 'query_len_probas'))
 assert type(query_len_probas) == list
 assert len(query_len_probas) == max_query_len
 
 query_len_probas = np.array(query_len_probas)
 
-plot_styles = eval(config.get('Settings', 'plot_styles'))
-assert type(percentiles) == list
+plot_styles = json.loads(config.get('Settings', 'plot_styles'))
+assert type(plot_styles) == list
 
 x_min = float(config.get('Settings', 'plot_xmin'))
 y_min = float(config.get('Settings', 'plot_ymin'))
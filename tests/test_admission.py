@@ -0,0 +1,17 @@
+from concurrent.futures import Future
+
+from admission import AdmissionControl
+from pipeline import Pipeline, CustomWorker
+from processor import BaseProcessor
+from text_encoders import WordPieceEncoder
+
+
+def test_cost_is_counted_in_tokens(tmp_path):
+    vocab = tmp_path / 'vocab.txt'
+    vocab.write_text('[UNK]\nhello\nworld\n##s\n', encoding='utf-8')
+    admission = AdmissionControl(budget=100)
+    processor = BaseProcessor(CustomWorker(lambda worker: worker.output.put(worker.input.get())),
+                              encoder=WordPieceEncoder(str(vocab)), admission=admission, mode=Pipeline.THREADS)
+    # 12 символов, 3 токена
+    processor.submit_many(['hello worlds'], [Future()], timeout=10)
+    assert admission.in_use == 3
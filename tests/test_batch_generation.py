@@ -0,0 +1,49 @@
+from queue import Queue, Empty
+from time import time
+
+import pytest
+
+from processor import ProcessingTask
+from workers.batch_generation import TimeoutBatchGenerator, TimeoutCostBatchGenerator
+
+
+def bulk(n, group='bulk'):
+    """
+    Запросы, поступившие одним сообщением
+    """
+    return [ProcessingTask([1] * 10, group=group, group_size=n) for _ in range(n)]
+
+
+def received(generator, count, wait):
+    """
+    Собирает группы, пока не получено count запросов или не прошло wait секунд
+    :return: время получения count запросов от начала ожидания, None - запросы не получены
+    """
+    started = time()
+    total = 0
+    while total < count:
+        remaining = started + wait - time()
+        if remaining <= 0:
+            return None
+        try:
+            total += len(generator.output.get(timeout=remaining))
+        except Empty:
+            return None
+    return time() - started
+
+
+@pytest.mark.parametrize('generator', [
+    TimeoutBatchGenerator(batch_size=64, timeout=2),
+    TimeoutCostBatchGenerator(batch_size=64, timeout=2, parallel_size=640),
+], ids=['simple', 'cost'])
+def test_bulk_fills_several_batches_without_waiting(generator):
+    generator.input = Queue()
+    generator.output = Queue()
+    generator.start(threaded=True)
+    try:
+        generator.input.put(bulk(200))
+        # три полные группы отправляются сразу, а не по одной за время ожидания
+        elapsed = received(generator, 3 * 64, wait=generator.timeout)
+        assert elapsed is not None and elapsed < generator.timeout / 4
+    finally:
+        generator.stop()
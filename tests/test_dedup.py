@@ -0,0 +1,22 @@
+from pipeline import Pipeline, CustomWorker
+from processor import BaseProcessor, PendingTask
+
+
+def make_processor():
+    return BaseProcessor(CustomWorker(lambda worker: worker.output.put(worker.input.get())), mode=Pipeline.THREADS)
+
+
+def test_attaches_to_task_living_at_least_as_long():
+    processor = make_processor()
+    now = 100.0
+    assert processor.can_attach(PendingTask('key', [], None, 1), now, 5)
+    assert processor.can_attach(PendingTask('key', [], now + 5, 1), now, 5)
+    assert processor.can_attach(PendingTask('key', [], now + 10, 1), now, 5)
+
+
+def test_does_not_attach_to_task_expiring_earlier():
+    processor = make_processor()
+    now = 100.0
+    # задача будет отброшена раньше, чем истечёт время ожидания нового запроса
+    assert not processor.can_attach(PendingTask('key', [], now + 4, 1), now, 5)
+    assert not processor.can_attach(PendingTask('key', [], now + 10, 1), now, None)
@@ -0,0 +1,55 @@
+from threading import Thread, Event
+from time import sleep
+
+from scheduler import ModelScheduler
+
+
+def acquire_in_thread(scheduler, idx, load, order=None):
+    """
+    Запускает ожидание места моделью idx в отдельном потоке
+    :return: событие, устанавливаемое после получения места
+    """
+    acquired = Event()
+
+    def wait():
+        scheduler.acquire(idx, load)
+        if order is not None:
+            order.append(idx)
+        acquired.set()
+
+    Thread(target=wait, daemon=True).start()
+    return acquired
+
+
+def test_busy_slots_throttle_other_models():
+    scheduler = ModelScheduler(2, slots=1)
+    scheduler.acquire(0, 10)
+    acquired = acquire_in_thread(scheduler, 1, 10)
+    # единственное место занято моделью 0
+    assert not acquired.wait(0.3)
+    scheduler.release(0, 0.3)
+    assert acquired.wait(5)
+    assert scheduler.waited[1] >= 0.3
+    scheduler.release(1, 0)
+
+
+def test_free_slots_do_not_throttle():
+    scheduler = ModelScheduler(2, slots=2)
+    scheduler.acquire(0, 10)
+    assert acquire_in_thread(scheduler, 1, 10).wait(5)
+
+
+def test_most_loaded_model_gets_freed_slot():
+    scheduler = ModelScheduler(3, slots=1)
+    scheduler.acquire(0, 10)
+    order = []
+    light = acquire_in_thread(scheduler, 1, 1, order)
+    sleep(0.1)
+    heavy = acquire_in_thread(scheduler, 2, 1000, order)
+    sleep(0.1)
+    scheduler.release(0, 0.2)
+    assert heavy.wait(5)
+    assert not light.is_set()
+    scheduler.release(2, 0)
+    assert light.wait(5)
+    assert order == [2, 1]
@@ -0,0 +1,264 @@
+import json
+import re
+import numpy as np
+from exceptions import MessagedException
+
+
+class VocabularyLoadingError(MessagedException):
+    """
+    Raised when vocabulary or merges file can not be read
+    """
+    pass
+
+
+class BaseTextEncoder:
+    """
+    Интерфейс преобразования строк в последовательности токенов и обратно.
+    Этапы токенизации и детокенизации передают кодировщику сразу все задачи сообщения
+    """
+    def encode_batch(self, texts):
+        """
+        Кодирует строки
+        :return: список последовательностей идентификаторов токенов
+        """
+        raise NotImplementedError()
+
+    def count_tokens(self, texts):
+        """
+        Количество токенов каждой строки; используется для оценки стоимости запроса до токенизации
+        :return: список длин
+        """
+        return [len(sequence) for sequence in self.encode_batch(texts)]
+
+    def decode_batch(self, sequences):
+        """
+        Декодирует последовательности токенов; отрицательные значения (дополнение) пропускаются
+        :return: список строк
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def split_decoded(pieces, sequences):
+        """
+        Разбивает общий массив токенов на последовательности и склеивает строки каждой из них
+        :param pieces: функция, получающая массив идентификаторов без дополнения и возвращающая
+            строку или список строк токенов
+        :return: строки последовательностей, склеенные из строк токенов
+        """
+        codes = np.concatenate([np.asarray(seq, dtype=np.int32).ravel() for seq in sequences])
+        ends = np.cumsum([len(seq) for seq in sequences])
+        kept = codes >= 0
+        # границы последовательностей после удаления дополнения
+        kept_ends = np.concatenate(([0], np.cumsum(kept)))[ends].tolist()
+        decoded = pieces(codes[kept])
+        texts = []
+        start = 0
+        for end in kept_ends:
+            chunk = decoded[start:end]
+            texts.append(chunk if isinstance(chunk, str) else ''.join(chunk))
+            start = end
+        return texts
+
+
+class CharEncoder(BaseTextEncoder):
+    """
+    Посимвольное кодирование: идентификатор токена - код символа Unicode
+    """
+    def encode_batch(self, texts):
+        codes = np.frombuffer(''.join(texts).encode('utf-32-le', errors='surrogatepass'), dtype='<i4').tolist()
+        sequences = []
+        start = 0
+        for text in texts:
+            sequences.append(codes[start:start + len(text)])
+            start += len(text)
+        return sequences
+
+    def count_tokens(self, texts):
+        return [len(text) for text in texts]
+
+    def decode_batch(self, sequences):
+        return self.split_decoded(
+            lambda codes: codes.astype('<i4').tobytes().decode('utf-32-le', errors='surrogatepass'), sequences)
+
+
+class SubwordEncoder(BaseTextEncoder):
+    """
+    Основа кодировщиков со словарём подслов.
+    Строка разбивается на слова, каждое слово кодируется отдельно, а результаты для часто встречающихся
+    слов запоминаются
+    """
+    def __init__(self, vocab, cache_size=100000):
+        """
+        :param vocab: словарь токен -> идентификатор
+        :param cache_size: максимальное количество запомненных слов
+        """
+        self.vocab = vocab
+        self.tokens = np.empty(max(vocab.values(), default=-1) + 1, dtype=object)
+        self.tokens[:] = ''
+        for token, idx in vocab.items():
+            self.tokens[idx] = self.token_text(token)
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def token_text(self, token):
+        """
+        Текст, которым токен заменяется при декодировании
+        """
+        return token
+
+    def split_words(self, text):
+        """
+        Разбивает строку на слова
+        """
+        raise NotImplementedError()
+
+    def encode_word(self, word):
+        """
+        Кодирует одно слово
+        """
+        raise NotImplementedError()
+
+    def encode_batch(self, texts):
+        sequences = []
+        cache = self.cache
+        for text in texts:
+            ids = []
+            for word in self.split_words(text):
+                word_ids = cache.get(word)
+                if word_ids is None:
+                    word_ids = self.encode_word(word)
+                    if len(cache) >= self.cache_size:
+                        # вытесняется слово, запомненное раньше всех; кодировщик может одновременно
+                        # использоваться обработчиком запросов и этапом токенизации
+                        cache.pop(next(iter(cache), None), None)
+                    cache[word] = word_ids
+                ids.extend(word_ids)
+            sequences.append(ids)
+        return sequences
+
+    def decode_batch(self, sequences):
+        return self.split_decoded(lambda codes: self.tokens[codes].tolist(), sequences)
+
+
+class BPEEncoder(SubwordEncoder):
+    """
+    Кодирование BPE по таблице рангов слияний.
+    Слово вместе с предшествующими пробелами начинается как последовательность символов, после чего
+    многократно сливается пара соседних частей с наименьшим рангом.
+    Токены словаря - строки Unicode; символ Ġ, как в словарях GPT-2, обозначает пробел
+    """
+    WORD_PATTERN = re.compile(r'\s*\S+|\s+')
+
+    def __init__(self, vocab_path, merges_path, unk_token='<unk>', cache_size=100000):
+        """
+        :param vocab_path: JSON-файл со словарём токен -> идентификатор
+        :param merges_path: файл слияний, по одной паре частей через пробел в строке, в порядке применения
+        :param unk_token: токен для символов, отсутствующих в словаре
+        """
+        try:
+            with open(vocab_path, encoding='utf-8') as f:
+                vocab = json.load(f)
+            with open(merges_path, encoding='utf-8') as f:
+                merges = [line.rstrip('\n').split(' ') for line in f
+                          if line.strip() and not line.startswith('#version')]
+        except (OSError, ValueError) as e:
+            raise VocabularyLoadingError('Unable to read BPE vocabulary: {}'.format(e))
+        vocab = {token.replace('Ġ', ' '): idx for token, idx in vocab.items()}
+        super(BPEEncoder, self).__init__(vocab, cache_size)
+        self.ranks = {(left.replace('Ġ', ' '), right.replace('Ġ', ' ')): rank
+                      for rank, (left, right) in enumerate(pair for pair in merges if len(pair) == 2)}
+        self.unk_id = vocab.get(unk_token)
+
+    def split_words(self, text):
+        return self.WORD_PATTERN.findall(text)
+
+    def encode_word(self, word):
+        parts = list(word)
+        ranks = self.ranks
+        while len(parts) > 1:
+            rank, idx = min((ranks.get(pair, float('inf')), idx) for idx, pair in enumerate(zip(parts, parts[1:])))
+            if rank == float('inf'):
+                break
+            parts[idx:idx + 2] = [parts[idx] + parts[idx + 1]]
+        ids = []
+        for part in parts:
+            idx = self.vocab.get(part, self.unk_id)
+            if idx is None:
+                # в словаре нет ни части, ни токена для неизвестных символов
+                ids.extend(self.vocab.get(ch, -1) for ch in part)
+            else:
+                ids.append(idx)
+        return [idx for idx in ids if idx >= 0]
+
+
+class WordPieceEncoder(SubwordEncoder):
+    """
+    Кодирование WordPiece: каждое слово разбивается жадно на самые длинные части словаря.
+    Части ищутся по префиксному дереву, построенному при запуске
+    """
+    def __init__(self, vocab_path, unk_token='[UNK]', prefix='##', cache_size=100000):
+        """
+        :param vocab_path: файл словаря, по одному токену в строке; идентификатор токена - номер строки
+        :param unk_token: токен для слов, которые нельзя разбить на части словаря
+        :param prefix: префикс токенов, продолжающих слово
+        """
+        try:
+            with open(vocab_path, encoding='utf-8') as f:
+                vocab = {line.rstrip('\n'): idx for idx, line in enumerate(f)}
+        except OSError as e:
+            raise VocabularyLoadingError('Unable to read WordPiece vocabulary: {}'.format(e))
+        self.prefix = prefix
+        super(WordPieceEncoder, self).__init__(vocab, cache_size)
+        self.unk_id = vocab.get(unk_token)
+        # префиксные деревья начальных частей слова и продолжений: символ -> узел, None -> идентификатор токена
+        self.word_trie = {}
+        self.suffix_trie = {}
+        for token, idx in vocab.items():
+            if token.startswith(prefix) and len(token) > len(prefix):
+                self._insert(self.suffix_trie, token[len(prefix):], idx)
+            else:
+                self._insert(self.word_trie, token, idx)
+
+    @staticmethod
+    def _insert(trie, token, idx):
+        node = trie
+        for ch in token:
+            node = node.setdefault(ch, {})
+        node[None] = idx
+
+    def token_text(self, token):
+        # продолжение слова приклеивается к предыдущему токену, остальные токены отделяются пробелом
+        return token[len(self.prefix):] if token.startswith(self.prefix) else ' ' + token
+
+    def split_words(self, text):
+        return text.split()
+
+    def encode_word(self, word):
+        ids = []
+        start = 0
+        trie = self.word_trie
+        while start < len(word):
+            node = trie
+            match_idx = match_end = None
+            for pos in range(start, len(word)):
+                node = node.get(word[pos])
+                if node is None:
+                    break
+                if None in node:
+                    match_idx, match_end = node[None], pos + 1
+            if match_idx is None:
+                return [] if self.unk_id is None else [self.unk_id]
+            ids.append(match_idx)
+            start = match_end
+            trie = self.suffix_trie
+        return ids
+
+    def decode_batch(self, sequences):
+        return [text[1:] if text.startswith(' ') else text for text in super(WordPieceEncoder, self).decode_batch(sequences)]
+
+
+ENCODERS = {
+    'char': CharEncoder,
+    'bpe': BPEEncoder,
+    'wordpiece': WordPieceEncoder,
+}
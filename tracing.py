@@ -0,0 +1,115 @@
+from array import array
+from collections import deque
+from threading import Lock
+from time import time
+import random
+
+
+class Trace:
+    """
+    Завершённая трассировка задачи
+    """
+    __slots__ = ('task_id', 'time_created', 'time_finished', 'stamps')
+
+    def __init__(self, task_id, time_created, time_finished, stamps):
+        """
+        :param stamps: время входа и выхода для каждого этапа подряд, 0 - этап задачу не отметил
+        """
+        self.task_id = task_id
+        self.time_created = time_created
+        self.time_finished = time_finished
+        self.stamps = stamps
+
+    @property
+    def latency(self):
+        return self.time_finished - self.time_created
+
+    def spans(self, stage_names):
+        """
+        Интервалы трассировки: ожидание во входной очереди каждого этапа и обработка этапом
+        :return: список (название, начало, конец)
+        """
+        spans = []
+        previous = self.time_created
+        for idx, name in enumerate(stage_names):
+            enter, leave = self.stamps[2 * idx], self.stamps[2 * idx + 1]
+            if enter:
+                spans.append((name + ' queue', previous, enter))
+                previous = enter
+            if enter and leave:
+                spans.append((name, enter, leave))
+                previous = leave
+        spans.append(('result', previous, self.time_finished))
+        return spans
+
+
+class Tracer:
+    """
+    Выборочная трассировка задач.
+
+    Выбранной задаче назначается массив из двух отметок времени на этап, куда этапы записывают время
+    получения и отправки задачи. Завершённые трассировки хранятся в кольцевом буфере
+    """
+    def __init__(self, sample_rate=0.01, capacity=1000):
+        """
+        :param sample_rate: доля трассируемых задач
+        :param capacity: количество хранимых завершённых трассировок
+        """
+        self.sample_rate = sample_rate
+        self.traces = deque(maxlen=capacity)
+        self.lock = Lock()
+        self.stage_names = []
+
+    def start(self, task, n_stages):
+        """
+        Включает трассировку задачи с вероятностью sample_rate
+        """
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            task.trace = array('d', bytes(16 * n_stages))
+
+    def finish(self, task, stage_names):
+        """
+        Сохраняет трассировку завершённой задачи
+        """
+        trace = Trace(task.id, task.time_created, time(), task.trace)
+        with self.lock:
+            self.stage_names = stage_names
+            self.traces.append(trace)
+
+    def recent(self):
+        with self.lock:
+            return list(self.traces), self.stage_names
+
+    def slowest(self, n=10):
+        """
+        n самых долгих из сохранённых трассировок
+        :return: список словарей с длительностью каждого интервала в секундах
+        """
+        traces, stage_names = self.recent()
+        traces.sort(key=lambda trace: trace.latency, reverse=True)
+        return [{
+            'task_id': trace.task_id,
+            'time_created': trace.time_created,
+            'latency': trace.latency,
+            'spans': [{'name': name, 'duration': end - start} for name, start, end in trace.spans(stage_names)],
+        } for trace in traces[:n]]
+
+    def chrome_trace(self):
+        """
+        Сохранённые трассировки в формате Chrome trace events (chrome://tracing, Perfetto);
+        каждая задача отображается отдельной строкой
+        """
+        traces, stage_names = self.recent()
+        events = []
+        for trace in traces:
+            for name, start, end in trace.spans(stage_names):
+                events.append({
+                    'name': name,
+                    'cat': 'queue' if name.endswith(' queue') else 'stage',
+                    'ph': 'X',
+                    'ts': start * 1e6,
+                    'dur': max(end - start, 0) * 1e6,
+                    'pid': 1,
+                    'tid': trace.task_id,
+                })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
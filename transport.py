@@ -0,0 +1,185 @@
+from multiprocessing import Queue
+from multiprocessing.shared_memory import SharedMemory
+from collections import OrderedDict
+from array import array
+import numpy as np
+
+
+class SharedSlice:
+    """
+    Описание последовательности токенов, записанной в кольцевой буфер
+    """
+    __slots__ = ('offset', 'length')
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+
+    def __getstate__(self):
+        return self.offset, self.length
+
+    def __setstate__(self, state):
+        self.offset, self.length = state
+
+
+class SharedTokens:
+    """
+    Последовательность токенов, лежащая в кольцевом буфере получателя.
+
+    Данные не копируются при получении; место в буфере освобождается, когда объект удаляется
+    (например, после пересылки на следующий этап или замены task.data результатом).
+    """
+    __slots__ = ('_queue', 'offset', 'length', 'view')
+
+    def __init__(self, queue, offset, length):
+        self._queue = queue
+        self.offset = offset
+        self.length = length
+        start = offset % queue.capacity
+        self.view = queue._tokens[start:start + length]
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.view)
+
+    def __getitem__(self, item):
+        return self.view[item]
+
+    def tolist(self):
+        """
+        Копирует последовательность в список
+        """
+        return self.view.tolist()
+
+    def __array__(self, dtype=None, copy=None):
+        return np.frombuffer(self.view, dtype=np.int32).astype(dtype or np.int32, copy=False)
+
+    def __reduce__(self):
+        return list, (self.tolist(),)
+
+    def __del__(self):
+        self.view.release()
+        if not self._queue.closed:
+            self._queue._release(self.offset)
+
+
+class SharedMemoryQueue:
+    """
+    Очередь между двумя этапами обработки, передающая токены через кольцевой буфер в разделяемой памяти.
+
+    Последовательности токенов записываются в буфер в виде int32, а через очередь проходят только
+    задачи с описаниями SharedSlice. Получатель видит данные как SharedTokens без копирования; при пересылке
+    SharedTokens в следующую такую очередь выполняется только копирование памяти между буферами.
+    Очередь рассчитана на одного отправителя и одного получателя.
+    Если в буфере нет места или последовательность короче min_length, данные передаются через очередь как обычно.
+    """
+    HEADER_SIZE = 16
+    # данные задач копируются при вызове put, поэтому отправитель может передавать массивы
+    # из переиспользуемого буфера
+    copies_on_put = True
+
+    def __init__(self, capacity=1 << 20, min_length=512):
+        """
+        :param capacity: размер кольцевого буфера в токенах
+        :param min_length: минимальная длина последовательности, передаваемой через буфер; более короткие
+            последовательности быстрее передаются через очередь (см. benchmarks/transport_benchmark.py)
+        """
+        self.capacity = capacity
+        self.min_length = min_length
+        self._queue = Queue()
+        self._shm = SharedMemory(create=True, size=self.HEADER_SIZE + capacity * 4)
+        # [0] - граница освобождённого места, [1] - позиция записи; позиции только возрастают
+        self._positions = self._shm.buf[:self.HEADER_SIZE].cast('Q')
+        self._tokens = self._shm.buf[self.HEADER_SIZE:].cast('i')
+        # занятые получателем участки в порядке записи: начало -> [конец, освобождён ли]
+        self._received = OrderedDict()
+        self.closed = False
+
+    def _write(self, data):
+        """
+        Записывает последовательность в буфер
+        :return: описание записанной последовательности или None, если места нет
+        """
+        length = len(data)
+        offset = self._positions[1]
+        if offset % self.capacity + length > self.capacity:
+            # последовательность не помещается до конца буфера, запись с начала
+            offset += self.capacity - offset % self.capacity
+        if offset + length - self._positions[0] > self.capacity:
+            return None
+
+        start = offset % self.capacity
+        if isinstance(data, SharedTokens):
+            self._tokens[start:start + length] = data.view
+        elif isinstance(data, np.ndarray):
+            self._tokens[start:start + length] = np.ascontiguousarray(data, dtype=np.int32)
+        else:
+            self._tokens[start:start + length] = array('i', data)
+        self._positions[1] = offset + length
+        return SharedSlice(offset, length)
+
+    def _release(self, offset):
+        """
+        Освобождает участок буфера; граница сдвигается только через непрерывно освобождённые участки
+        """
+        self._received[offset][1] = True
+        while self._received:
+            first = next(iter(self._received.values()))
+            if not first[1]:
+                break
+            self._positions[0] = first[0]
+            self._received.popitem(last=False)
+
+    def put(self, message, block=True, timeout=None):
+        """
+        Отправляет задачу или группу задач
+        """
+        for task in message if isinstance(message, list) else (message,):
+            if isinstance(task.data, SharedTokens) or (
+                    isinstance(task.data, (list, np.ndarray)) and len(task.data) >= self.min_length):
+                shared_slice = self._write(task.data)
+                if shared_slice is not None:
+                    task.data = shared_slice
+            if isinstance(task.data, np.ndarray):
+                # очередь сериализует сообщение позже, массив может быть изменён отправителем
+                task.data = task.data.tolist()
+        self._queue.put(message, block, timeout)
+
+    def get(self, block=True, timeout=None):
+        """
+        Получает задачу или группу задач
+        """
+        message = self._queue.get(block, timeout)
+        for task in message if isinstance(message, list) else (message,):
+            if isinstance(task.data, SharedSlice):
+                self._received[task.data.offset] = [task.data.offset + task.data.length, False]
+                task.data = SharedTokens(self, task.data.offset, task.data.length)
+        return message
+
+    def qsize(self):
+        """
+        Возвращает количество сообщений в очереди
+        """
+        return self._queue.qsize()
+
+    def close(self):
+        """
+        Освобождает разделяемую память.
+        Если ещё существуют SharedTokens, память освобождается после их удаления
+        """
+        self.closed = True
+        self._shm.unlink()
+        self._positions.release()
+        self._tokens.release()
+        try:
+            self._shm.close()
+        except BufferError:
+            pass
+
+
+TRANSPORTS = {
+    'queue': Queue,
+    'shared_memory': SharedMemoryQueue,
+}
@@ -0,0 +1,146 @@
+from multiprocessing import Array
+from math import sqrt
+from workers.batch_generation import TimeoutCostBatchGenerator
+
+
+class LatencyEstimator:
+    """
+    Оценка времени работы модели как линейной функции размера группы (запросы * максимальная длина).
+
+    Хранит в разделяемой памяти взвешенные суммы для метода наименьших квадратов с экспоненциальным забыванием,
+    поэтому наблюдения записываются этапом модели, а читаются этапом группировки.
+    """
+    WEIGHT, SUM_X, SUM_Y, SUM_XX, SUM_XY, SUM_RR = range(6)
+
+    def __init__(self, decay=0.98):
+        """
+        :param decay: множитель забывания старых наблюдений
+        """
+        self.decay = decay
+        self.sums = Array('d', 6)
+
+    def observe(self, cells, seconds):
+        """
+        Учитывает время обработки группы размера cells
+        """
+        with self.sums.get_lock():
+            if self.sums[self.WEIGHT] > 0:
+                residual = seconds - self._predict(cells)
+                self.sums[self.SUM_RR] = self.sums[self.SUM_RR] * self.decay + residual * residual
+            for idx, value in ((self.WEIGHT, 1), (self.SUM_X, cells), (self.SUM_Y, seconds),
+                               (self.SUM_XX, cells * cells), (self.SUM_XY, cells * seconds)):
+                self.sums[idx] = self.sums[idx] * self.decay + value
+
+    def ready(self):
+        """
+        Достаточно ли наблюдений для оценки
+        """
+        return self.sums[self.WEIGHT] >= 3
+
+    def _predict(self, cells):
+        weight, sum_x, sum_y, sum_xx, sum_xy, _ = self.sums[:]
+        variance = sum_xx * weight - sum_x * sum_x
+        if variance <= 1e-12 * max(sum_xx * weight, 1):
+            return sum_y / weight
+        slope = max((sum_xy * weight - sum_x * sum_y) / variance, 0)
+        intercept = (sum_y - slope * sum_x) / weight
+        return max(intercept, 0) + slope * cells
+
+    def predict(self, cells, quantile_z=0):
+        """
+        Оценка времени обработки группы размера cells
+        :param quantile_z: запас в стандартных отклонениях ошибки оценки (2.33 - 99-й перцентиль)
+        """
+        with self.sums.get_lock():
+            deviation = sqrt(self.sums[self.SUM_RR] / self.sums[self.WEIGHT])
+            return self._predict(cells) + quantile_z * deviation
+
+
+class AdaptiveBatchGenerator(TimeoutCostBatchGenerator):
+    """
+    Этап группировки запросов, подстраивающий размер группы и время ожидания под поток запросов.
+
+    По интенсивности поступления запросов и оценке времени работы модели выбирается наименьший размер группы,
+    при котором модель успевает обрабатывать поток с запасом, а 99-й перцентиль задержки не превышает
+    latency_slo. Если модель не успевает, запросы накапливаются до latency_slo, чтобы группы были плотнее.
+    """
+    def __init__(self, batch_size=64, timeout=4, parallel_size=1000, latency_slo=1.0, min_timeout=0.001,
+                 headroom=1.2, smoothing=0.05, weights=None):
+        """
+        :param batch_size: максимальный размер группы
+        :param timeout: максимальное время ожидания, используется до накопления статистики
+        :param latency_slo: целевой 99-й перцентиль задержки в секундах
+        :param min_timeout: минимальное время ожидания
+        :param headroom: во сколько раз пропускная способность должна превышать интенсивность потока
+        :param smoothing: коэффициент экспоненциального сглаживания статистики потока
+        :param weights: класс приоритета -> вес
+        """
+        super(AdaptiveBatchGenerator, self).__init__(batch_size, timeout, parallel_size, flush_margin=0,
+                                                     weights=weights)
+        self.max_batch_size = batch_size
+        self.max_timeout = timeout
+        self.latency_slo = latency_slo
+        self.min_timeout = min_timeout
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.latency_estimator = LatencyEstimator()
+
+        self.last_arrival = None
+        self.mean_gap = None
+        self.mean_max_len = None
+
+    def receive(self, task):
+        """
+        Добавляет запрос и учитывает интенсивность поступления запросов
+        """
+        super(AdaptiveBatchGenerator, self).receive(task)
+        now = self.clock()
+        if self.last_arrival is not None:
+            gap = now - self.last_arrival
+            self.mean_gap = gap if self.mean_gap is None else self.mean_gap + self.smoothing * (gap - self.mean_gap)
+        self.last_arrival = now
+
+    def send(self, batch, reason):
+        """
+        Отправляет группу и пересчитывает параметры группировки
+        """
+        max_len = max(len(task.data) for task in batch)
+        self.mean_max_len = max_len if self.mean_max_len is None else \
+            self.mean_max_len + self.smoothing * (max_len - self.mean_max_len)
+        super(AdaptiveBatchGenerator, self).send(batch, reason)
+        self.tune()
+
+    def tune(self):
+        """
+        Выбирает размер группы и время ожидания
+        """
+        if self.mean_gap is None or self.mean_max_len is None or not self.latency_estimator.ready():
+            return
+        arrival_rate = 1 / max(self.mean_gap, 1e-6)
+
+        # группа, превышающая parallel_size, всё равно будет разбита этапом группировки
+        max_size = max(1, min(self.max_batch_size, int(self.parallel_size // self.mean_max_len)))
+
+        best_size, best_throughput, chosen = 1, 0, None
+        for size in range(1, max_size + 1):
+            cells = size * self.mean_max_len
+            fill_time = (size - 1) / arrival_rate
+            # запрос может дождаться окончания обработки предыдущей группы
+            if fill_time + 2 * self.latency_estimator.predict(cells, quantile_z=2.33) > self.latency_slo:
+                continue
+            throughput = size / max(self.latency_estimator.predict(cells), 1e-6)
+            if throughput > best_throughput:
+                best_size, best_throughput = size, throughput
+            if throughput >= arrival_rate * self.headroom:
+                chosen = size
+                break
+
+        processing = self.latency_estimator.predict(best_size * self.mean_max_len, quantile_z=2.33)
+        if chosen is None:
+            # модель не успевает: накопленные запросы позволяют собрать группы с меньшим дополнением
+            self.batch_size = self.max_batch_size
+            wait = self.latency_slo - 2 * processing
+        else:
+            self.batch_size = chosen
+            wait = min((chosen - 1) / arrival_rate, self.latency_slo - 2 * processing)
+        self.timeout = min(max(wait, self.min_timeout), self.max_timeout)
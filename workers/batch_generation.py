@@ -1,26 +1,36 @@
-from pipeline import Worker
-from time import time
-from sortedcontainers import SortedListWithKey
-from math import floor
+from pipeline import Worker, as_tasks
 from queue import Empty
+from workers.length_buckets import ClassBuckets
+from metrics import BatchMetrics
+from priorities import FairShare
 
 
 class TimeoutBatchGenerator(Worker):
     """
     Простой этап группировки запросов
     """
-    def __init__(self, batch_size=32, timeout=4):
+    def __init__(self, batch_size=32, timeout=4, flush_margin=0.25, weights=None):
+        """
+        :param timeout: максимальное время ожидания запроса до отправки
+        :param flush_margin: доля timeout, оставляемая на обработку: группа отправляется, когда
+            самый старый запрос ждёт (1 - flush_margin) * timeout
+        :param weights: класс приоритета -> вес при взвешенном справедливом обслуживании классов
+        """
         super(TimeoutBatchGenerator, self).__init__()
         self.batch_size = batch_size
         self.timeout = timeout
-        self.oldest = time()
+        self.flush_margin = flush_margin
+        self.share = FairShare(weights)
+        self.backlogged = set()
+        self.oldest = self.clock()
         self.batch = []
+        self.batch_metrics = BatchMetrics()
 
     def before_start(self):
         """
         Инициализирует этап обработки
         """
-        self.oldest = time()
+        self.oldest = self.clock()
         self.batch.clear()
 
     def job(self):
@@ -28,36 +38,99 @@ class TimeoutBatchGenerator(Worker):
         Выполняет группировку запросов
         """
         compute_right_now = False
-        timeout = (self.timeout - (time() - self.oldest)) - self.timeout / 4  # TODO: fix the constant
+        reason = BatchMetrics.FULL
+        timeout = (self.timeout - (self.clock() - self.oldest)) - self.timeout * self.flush_margin
 
         if timeout > 0 or len(self.batch) == 0:
             try:
-                task = self.input.get(timeout=timeout if len(self.batch) > 0 else None)
-                if task.time_created < self.oldest or len(self.batch) == 0:
-                    self.oldest = task.time_created
-                self.batch.append(task)
+                for task in as_tasks(self.input.get(timeout=timeout if len(self.batch) > 0 else None)):
+                    if task.time_created < self.oldest or len(self.batch) == 0:
+                        self.oldest = task.time_created
+                    self.batch.append(task)
             except Empty:
                 compute_right_now = True
+                reason = BatchMetrics.TIMEOUT
         else:
             compute_right_now = True
+            reason = BatchMetrics.FORCED
         if len(self.batch) >= self.batch_size or compute_right_now:
-            self.output.put(self.batch[:])
-            self.before_start()
+            self.flush(reason)
+            # остаток большого сообщения может заполнить ещё несколько групп, они не ждут следующего запроса
+            while len(self.batch) >= self.batch_size:
+                self.flush(BatchMetrics.FULL)
+
+    def flush(self, reason):
+        """
+        Отправляет группу из накопленных задач
+        :param reason: причина отправки
+        """
+        # сообщение из нескольких задач может переполнить группу, остаток ждёт следующей
+        batch, rest = self.take()
+        self.send(batch, reason)
+        self.before_start()
+        for task in rest:
+            if task.time_created < self.oldest or len(self.batch) == 0:
+                self.oldest = task.time_created
+            self.batch.append(task)
+
+    def take(self):
+        """
+        Разделяет накопленные задачи на группу и остаток. Если задач больше, чем помещается в группу,
+        и они относятся к разным классам приоритета, задачи выбираются взвешенным справедливым обслуживанием
+        """
+        classes = {}
+        for task in self.batch:
+            classes.setdefault(task.priority, []).append(task)
+        for cls in classes:
+            if cls not in self.backlogged:
+                self.share.activate(cls, self.backlogged)
+
+        if len(self.batch) <= self.batch_size or len(classes) == 1:
+            batch, rest = self.batch[:self.batch_size], self.batch[self.batch_size:]
+            for task in batch:
+                self.share.charge(task.priority, len(task.data))
+        else:
+            taken = set()
+            while len(taken) < self.batch_size:
+                cls = self.share.pick(classes)
+                task = classes[cls].pop(0)
+                if not classes[cls]:
+                    del classes[cls]
+                self.share.charge(cls, len(task.data))
+                taken.add(task.id)
+            batch = [task for task in self.batch if task.id in taken]
+            rest = [task for task in self.batch if task.id not in taken]
+        # классы, запросы которых остались ждать следующей группы
+        self.backlogged = {task.priority for task in rest}
+        return batch, rest
+
+    def send(self, batch, reason):
+        """
+        Отправляет группу на следующий этап, отбрасывая задачи с истёкшим сроком
+        :param reason: причина отправки, BatchMetrics.FULL, TIMEOUT или FORCED
+        """
+        batch = self.drop_expired(batch)
+        if batch:
+            self.batch_metrics.observe(batch, reason)
+            self.output.put(batch)
 
 
 class TimeoutCostBatchGenerator(TimeoutBatchGenerator):
     """
     Эффективный этап группировки запросов
     """
-    def __init__(self, batch_size=64, timeout=4, parallel_size=1000):
-        super(TimeoutCostBatchGenerator, self).__init__(batch_size, timeout)
+    def __init__(self, batch_size=64, timeout=4, parallel_size=1000, flush_margin=0.1, weights=None):
+        """
+        :param weights: класс приоритета -> вес; группа собирается из запросов одного класса
+        """
+        super(TimeoutCostBatchGenerator, self).__init__(batch_size, timeout, flush_margin, weights)
 
         self.parallel_size = parallel_size
 
-        self.batch_by_time = SortedListWithKey(key=self.get_time)
-        self.batch_by_len = SortedListWithKey(key=lambda _task: len(_task.data))
-        self.total_len = 0
-        self.best_batches = {}
+        self.buckets = ClassBuckets(parallel_size, weights)
+        # группы запросов, поступивших вместе, ещё не полностью полученные:
+        # группа -> [получено запросов, размер группы, время создания, ждать ли остальные запросы]
+        self.groups = {}
 
     @staticmethod
     def get_time(task):
@@ -66,144 +139,116 @@ class TimeoutCostBatchGenerator(TimeoutBatchGenerator):
         """
         return task.time_created
 
+    def receive(self, task):
+        """
+        Добавляет полученный запрос
+        """
+        self.buckets.add(task)
+        self.track_group(task)
+
+    def track_group(self, task):
+        """
+        Учитывает получение запроса из группы
+        """
+        group_size = getattr(task, 'group_size', 1)
+        if group_size > 1:
+            entry = self.groups.setdefault(task.group, [0, group_size, self.get_time(task), True])
+            entry[0] += 1
+            if entry[0] >= entry[1]:
+                del self.groups[task.group]
+
+    def close_groups(self, tasks=None):
+        """
+        Перестаёт ждать остальные запросы групп; группы остаются учтёнными, чтобы их следующие запросы
+        не ожидались снова
+        :param tasks: отправленные запросы, группы которых закрываются; None - все группы
+        """
+        if tasks is None:
+            for entry in self.groups.values():
+                entry[3] = False
+            return
+        for task in tasks:
+            entry = self.groups.get(getattr(task, 'group', None))
+            if entry is not None:
+                entry[3] = False
+
+    def waiting_groups(self):
+        """
+        Есть ли группы, остальные запросы которых стоит ждать. Группы старше timeout забываются:
+        их запросы могли быть отброшены предыдущими этапами, а запоздавшие запросы отправятся по времени
+        """
+        now = self.clock()
+        for group, entry in list(self.groups.items()):
+            if now - entry[2] > self.timeout:
+                del self.groups[group]
+        return any(entry[3] for entry in self.groups.values())
+
+    def send(self, batch, reason):
+        """
+        Отправляет группу на следующий этап; остальные запросы групп отправленных запросов не ожидаются
+        """
+        self.close_groups(batch)
+        super(TimeoutCostBatchGenerator, self).send(batch, reason)
+
     def job(self):
         """
         Группирует запросы
         """
-        if len(self.batch_by_time) > 0:
-            oldest = self.get_time(self.batch_by_time[0])
+        if len(self.buckets) > 0:
+            oldest = self.get_time(self.buckets.oldest())
         else:
-            oldest = time()
+            oldest = self.clock()
 
         compute_right_now = False
-        timeout = (self.timeout - (time() - oldest)) - self.timeout / 10  # TODO: fix the constant
+        reason = BatchMetrics.FULL
+        timeout = (self.timeout - (self.clock() - oldest)) - self.timeout * self.flush_margin
 
-        if timeout > 0 or self.output.qsize() > 1 or len(self.batch_by_len) < self.batch_size / 4:
+        if timeout > 0 or self.output.qsize() > 1 or len(self.buckets) < self.batch_size / 4:
             try:
-                task = self.input.get(timeout=timeout if len(self.batch_by_len) > 0 else None)
-                self.total_len += len(task.data)
-                self.batch_by_len.add(task)
-                self.batch_by_time.add(task)
+                for task in as_tasks(self.input.get(timeout=max(timeout, 0) if len(self.buckets) > 0 else None)):
+                    self.receive(task)
             except Empty:
                 compute_right_now = True
+                reason = BatchMetrics.TIMEOUT
         else:
             compute_right_now = True
-
-        # print(len(self.batch_by_len))
-        if len(self.batch_by_len) >= self.batch_size or compute_right_now:
-            oldest_task = self.batch_by_time[0]
-
-            best_cost = float('inf')
-
-            best_left = 0
-            best_right = 1
-
-            idx_left = 0
-
-            oldest_idx = float('inf')
-            if timeout < 0:
-                oldest_idx = idx_left = self.batch_by_len.index(oldest_task)
-
-            while idx_left < len(self.batch_by_len):
-                task = self.batch_by_len[idx_left]
-                new_idx_left, new_idx_right, new_cost = self.get_best_batch(task)
-                if oldest_idx < new_idx_left:
-                    break
-                if new_cost < best_cost:
-                    best_cost = new_cost
-                    best_left = new_idx_left
-                    best_right = new_idx_right
-                idx_left = max(new_idx_right, self.batch_by_len.bisect_right(task))
-
-            batch = self.batch_by_len[best_left:best_right]
-            self.output.put(batch)
-            for task in batch:
-                self.total_len -= len(task.data)
-                self.batch_by_time.remove(task)
-                self.batch_by_len.remove(task)
-
-    def get_best_batch(self, task):
-        """
-        Возвращает наиболее эффективную группу, содержащую данный запрос
-        """
-        idx = self.batch_by_len.index(task)
-        idx_left = self.batch_by_len.bisect_left(task)
-        idx_right = self.batch_by_len.bisect_right(task)
-
-        qlen = len(task.data)
-
-        if (idx - idx_left + 1) * qlen > self.parallel_size:
-            idx_left = idx - floor(self.parallel_size / qlen) + 1
-
-        if (idx_right - idx_left + 1) * qlen > self.parallel_size:
-            idx_right = idx_left + floor(self.parallel_size / qlen)
-        if idx_right == idx_left:
-            idx_right += 1
-
-        return self.expand_batch(idx_left, idx_right)
-
-    def expand_batch(self, idx_left, idx_right):
+            reason = BatchMetrics.FORCED
+
+        if compute_right_now:
+            self.close_groups()
+
+        # пока группа не получена целиком, группа не отправляется по заполнению, чтобы запросы группы
+        # могли попасть в один батч
+        if (len(self.buckets) >= self.batch_size and not self.waiting_groups()) or compute_right_now:
+            self.drop_stale()
+            if len(self.buckets) > 0:
+                self.send(self.buckets.pop_best(self.buckets.oldest() if timeout < 0 else None), reason)
+            # полученные разом запросы могут заполнить несколько групп, они не ждут следующего запроса
+            while len(self.buckets) >= self.batch_size and not self.waiting_groups():
+                self.send(self.buckets.pop_best(), BatchMetrics.FULL)
+
+    def drop_stale(self):
         """
-        Дополняет группу, заданную границами в сортированном по длине массиве запросов, до максимальной эффективной
+        Отбрасывает ожидающие запросы с истёкшим сроком, чтобы они не занимали место в группе
         """
-        total_added_cost = 0
-
-        qlen = len(self.batch_by_len[idx_right - 1].data)
-
-        if not ((idx_right - idx_left + 1) * qlen < self.parallel_size and (
-                idx_left > 0 or idx_right < len(self.batch_by_len))):
-            return idx_left, idx_right, 0
-
-        batch_len = idx_right - idx_left
-
-        free_space = self.parallel_size - batch_len * qlen
-
-        l_zeros = float('Inf')
-        l_idx = -1
-        if idx_left > 0:
-            left_task = self.batch_by_len[idx_left - 1]
-            l_len = len(left_task.data)
-            l_diff = qlen - l_len
-            l_idx = self.batch_by_len.bisect_key_left(l_len)
-            n_take = min(idx_left - l_idx, floor(free_space / qlen))
-            if n_take > 0:
-                l_zeros = l_diff * n_take
-
-        r_zeros = float('Inf')
-        r_idx = -1
-        r_len = qlen
-        if idx_right < len(self.batch_by_len):
-            right_task = self.batch_by_len[idx_right]
-
-            r_len = len(right_task.data)
-            r_diff = r_len - qlen
-            r_idx = self.batch_by_len.bisect_key_right(r_len)
-            n_take = min(r_idx - idx_right,
-                         floor((free_space - batch_len) / qlen))
-            if n_take > 0:
-                r_zeros = batch_len * r_diff
-
-        if r_zeros == float('inf') and l_zeros == float('inf'):
-            return idx_left, idx_right, 0
-
-        if l_zeros <= r_zeros:
-            idx_left = l_idx
-            total_added_cost += l_zeros
-        else:
-            idx_right = r_idx
-            total_added_cost += r_zeros
-
-        idx_left, idx_right, additional_cost = self.expand_batch(idx_left, idx_right)
-
-        return idx_left, idx_right, total_added_cost + additional_cost
+        dropped = self.buckets.drop_expired(self.clock())
+        if dropped:
+            with self.dropped.get_lock():
+                self.dropped.value += dropped
 
 
 class NaiveBatchGenerator(Worker):
     """
     Этап наивной группировки запросов
     """
+    def __init__(self):
+        super(NaiveBatchGenerator, self).__init__()
+        self.batch_metrics = BatchMetrics()
+
     def job(self):
         """
         Выполняет этап наивной группировки запросов
         """
-        self.output.put([self.input.get()])
+        for task in self.drop_expired(as_tasks(self.input.get())):
+            self.batch_metrics.observe([task], BatchMetrics.FULL)
+            self.output.put([task])
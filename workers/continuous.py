@@ -0,0 +1,182 @@
+from queue import Empty
+from time import time
+import numpy as np
+from pipeline import as_tasks
+from workers.model import ModelApplier, ModelLoadingError
+from streaming import StreamChunk
+
+
+class ContinuousModelApplier(ModelApplier):
+    """
+    Этап применения модели с группировкой на уровне шагов декодирования.
+
+    Модель декодирует группу по одному шагу (BaseModel.supports_steps). Между шагами завершённые
+    последовательности сразу отправляются дальше, а освободившиеся места занимают ожидающие задачи,
+    поэтому группа не ждёт самую длинную последовательность, а новые задачи - окончания всей группы.
+    Для задач с stream новые токены отправляются частями (StreamChunk) до завершения декодирования
+    """
+    def __init__(self, model_path, model=None, max_slots=64, max_cells=None, stream_interval=1, warmup=None):
+        """
+        :param max_slots: максимальное количество одновременно декодируемых последовательностей
+        :param max_cells: ограничение количества последовательностей, умноженного на максимальную длину
+            среди них, None - без ограничения
+        :param stream_interval: через сколько шагов декодирования отправлять части результатов
+        :param warmup: прогрев модели Warmup перед началом обработки, None - без прогрева
+        """
+        super(ContinuousModelApplier, self).__init__(model_path, model, warmup=warmup)
+        if model is not None:
+            self.check_model(model)
+        self.max_slots = max_slots
+        self.max_cells = max_cells
+        self.stream_interval = stream_interval
+        self.steps = 0
+        # идентификатор задачи с stream -> количество отправленных токенов
+        self.streamed = {}
+        # задачи, ожидающие свободного места
+        self.pending = []
+        # декодируемые задачи и состояния модели для них
+        self.active = []
+        self.states = []
+
+    def check_model(self, model):
+        """
+        Проверяет, поддерживает ли модель пошаговое декодирование
+        """
+        if not getattr(model, 'supports_steps', False):
+            raise ModelLoadingError('The model does not support step-wise decoding')
+
+    def before_start(self):
+        """
+        Загружает модель и инициализирует этап обработки
+        """
+        super(ContinuousModelApplier, self).before_start()
+        self.pending.clear()
+        self.active.clear()
+        self.states.clear()
+        self.streamed.clear()
+
+    def warm_up(self):
+        """
+        Декодирует синтетические группы до завершения
+        """
+        for batch in self.warmup.batches():
+            states = self.model.init_state([task.data for task in batch])
+            while states:
+                finished = self.model.decode_step(states)
+                for state, is_finished in zip(states, finished):
+                    if is_finished:
+                        self.trim_row(self.model.finish(state))
+                states = [state for state, is_finished in zip(states, finished) if not is_finished]
+
+    def drained(self):
+        """
+        Завершено ли декодирование полученных процессом задач
+        """
+        return not self.active and not self.pending
+
+    def receive(self):
+        """
+        Забирает поступившие задачи, пока декодируемых и ожидающих задач меньше max_slots; если декодировать
+        нечего, ожидает первую. Остальные задачи остаются в очереди, поэтому нагрузка реплики в DispatchQueue
+        учитывает её невыполненные задачи. Заменённый новым процессом этап задачи не забирает,
+        а завершает уже полученные
+        """
+        if self.draining():
+            return
+        block = not self.active and not self.pending
+        while len(self.active) + len(self.pending) < self.max_slots:
+            try:
+                message = self.input.get(block=block, timeout=self.drain_check_interval if block else None)
+            except Empty:
+                return
+            self.pending.extend(as_tasks(message))
+            block = False
+
+    def fits(self, task):
+        """
+        Помещается ли задача в группу декодируемых
+        """
+        if len(self.active) >= self.max_slots:
+            return False
+        if self.max_cells is None or not self.active:
+            return True
+        max_len = max(len(task.data), max(len(active.data) for active in self.active))
+        return (len(self.active) + 1) * max_len <= self.max_cells
+
+    def admit(self):
+        """
+        Занимает свободные места ожидающими задачами в порядке сроков
+        """
+        self.pending = self.drop_expired(self.pending)
+        self.pending.sort(key=lambda task: (task.deadline is None, task.deadline or 0, task.time_created))
+        admitted = []
+        while self.pending and self.fits(self.pending[0]):
+            task = self.pending.pop(0)
+            self.active.append(task)
+            admitted.append(task)
+        if admitted:
+            self.states.extend(self.model.init_state([task.data for task in admitted]))
+
+    def evict(self, finished):
+        """
+        Освобождает места завершённых и просроченных задач
+        :param finished: завершена ли последовательность, для каждой декодируемой задачи
+        :return: завершённые задачи с результатами
+        """
+        now = self.clock()
+        done = []
+        active, states = [], []
+        expired = 0
+        for task, state, is_finished in zip(self.active, self.states, finished):
+            if is_finished:
+                task.data = self.trim_row(self.model.finish(state))
+                done.append(task)
+                self.streamed.pop(task.id, None)
+            elif task.deadline is not None and task.deadline <= now:
+                expired += 1
+                self.streamed.pop(task.id, None)
+            else:
+                active.append(task)
+                states.append(state)
+        if expired:
+            with self.dropped.get_lock():
+                self.dropped.value += expired
+        self.active, self.states = active, states
+        return done
+
+    def job(self):
+        """
+        Выполняет один шаг декодирования
+        """
+        self.receive()
+        self.admit()
+        if not self.active:
+            return
+        if self.scheduler is not None:
+            self.scheduler.acquire(self.model_index, sum(len(task.data) for task in self.active) + len(self.pending))
+        started = time()
+        try:
+            finished = self.model.decode_step(self.states)
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.release(self.model_index, time() - started)
+        done = self.evict(finished)
+        self.steps += 1
+        chunks = self.stream_chunks() if self.steps % self.stream_interval == 0 else []
+        if chunks or done:
+            self.output.put(chunks + done)
+
+    def stream_chunks(self):
+        """
+        Части результатов с токенами, полученными после предыдущей отправки
+        """
+        chunks = []
+        for task, state in zip(self.active, self.states):
+            if task.stream:
+                tokens = self.model.partial(state)
+                sent = self.streamed.get(task.id, 0)
+                if len(tokens) > sent:
+                    new = tokens[sent:]
+                    chunks.append(StreamChunk(task, new.tolist() if isinstance(new, np.ndarray) else list(new)))
+                    self.streamed[task.id] = len(tokens)
+        return chunks
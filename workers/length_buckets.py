@@ -0,0 +1,278 @@
+from collections import deque
+from bisect import bisect_left
+from math import floor
+from sortedcontainers import SortedList
+from priorities import FairShare
+
+
+class BatchCandidate:
+    """
+    Кандидат на отправку: запросы с длинами из отрезка [lengths[low], lengths[high]]
+    """
+    __slots__ = ('low', 'high', 'low_take', 'size', 'padding', 'maximal')
+
+    def __init__(self, low, high, low_take, size, padding, maximal):
+        self.low = low
+        self.high = high
+        self.low_take = low_take
+        self.size = size
+        self.padding = padding
+        self.maximal = maximal
+
+    def key(self):
+        """
+        Ключ сравнения кандидатов: сначала максимальные группы, затем меньшее число нулей, затем больший размер
+        """
+        return not self.maximal, self.padding, -self.size
+
+
+class LengthBuckets:
+    """
+    Хранилище запросов, сгруппированных по длине.
+
+    Для каждой различной длины хранится очередь запросов в порядке поступления, а по префиксным суммам
+    количеств и длин для каждой длины находится лучшая группа, в которой эта длина максимальна.
+    Кандидаты пересчитываются лениво, только после изменения содержимого, за O(D log D),
+    где D - количество различных длин.
+    """
+    def __init__(self, parallel_size=1000):
+        self.parallel_size = parallel_size
+        self.buckets = {}
+        self.lengths = SortedList()
+        self.count = 0
+        self.total_len = 0
+        self._candidates = None
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def get_len(task):
+        """
+        Возвращает длину запроса
+        """
+        return len(task.data)
+
+    def add(self, task):
+        """
+        Добавляет запрос
+        """
+        qlen = self.get_len(task)
+        bucket = self.buckets.get(qlen)
+        if bucket is None:
+            bucket = self.buckets[qlen] = deque()
+            self.lengths.add(qlen)
+        bucket.append(task)
+        self.count += 1
+        self.total_len += qlen
+        self._candidates = None
+
+    def remove(self, task):
+        """
+        Удаляет запрос
+        """
+        qlen = self.get_len(task)
+        bucket = self.buckets[qlen]
+        bucket.remove(task)
+        if len(bucket) == 0:
+            del self.buckets[qlen]
+            self.lengths.remove(qlen)
+        self.count -= 1
+        self.total_len -= qlen
+        self._candidates = None
+
+    def drop_expired(self, now):
+        """
+        Удаляет запросы с истёкшим сроком из начала каждой очереди.
+        Сроки в очереди почти упорядочены, поэтому просматриваются только первые запросы
+        :return: количество удалённых запросов
+        """
+        dropped = 0
+        for qlen in list(self.lengths):
+            bucket = self.buckets[qlen]
+            while bucket and bucket[0].deadline is not None and bucket[0].deadline <= now:
+                bucket.popleft()
+                dropped += 1
+                self.count -= 1
+                self.total_len -= qlen
+            if len(bucket) == 0:
+                del self.buckets[qlen]
+                self.lengths.remove(qlen)
+        if dropped:
+            self._candidates = None
+        return dropped
+
+    def earliest_deadline(self, candidate):
+        """
+        Самый ранний срок среди первых запросов очередей группы
+        """
+        return min((self.buckets[self.lengths[idx]][0].deadline or float('inf')
+                    for idx in range(candidate.low, candidate.high + 1)), default=float('inf'))
+
+    def oldest(self):
+        """
+        Возвращает самый старый запрос
+        """
+        return min((self.buckets[qlen][0] for qlen in self.lengths), key=lambda task: task.time_created)
+
+    def candidates(self):
+        """
+        Возвращает для каждой длины лучшую группу, в которой эта длина максимальна
+        """
+        if self._candidates is None:
+            self._candidates = self._compute_candidates()
+        return self._candidates
+
+    def _compute_candidates(self):
+        lengths = self.lengths
+        counts = [len(self.buckets[qlen]) for qlen in lengths]
+
+        prefix_count = [0]
+        prefix_len = [0]
+        for qlen, count in zip(lengths, counts):
+            prefix_count.append(prefix_count[-1] + count)
+            prefix_len.append(prefix_len[-1] + count * qlen)
+
+        candidates = []
+        for high, max_len in enumerate(lengths):
+            capacity = max(1, floor(self.parallel_size / max(max_len, 1)))
+            low = bisect_left(prefix_count, prefix_count[high + 1] - capacity, 0, high + 1)
+            size = prefix_count[high + 1] - prefix_count[low]
+            total_len = prefix_len[high + 1] - prefix_len[low]
+
+            if low > 0 and size < capacity:
+                # следующая по длине очередь целиком не помещается, берутся её самые старые запросы
+                low -= 1
+                low_take = capacity - size
+                size = capacity
+                total_len += low_take * lengths[low]
+            else:
+                low_take = counts[low]
+
+            maximal = size == capacity or (
+                    size == prefix_count[high + 1] and (
+                        high + 1 == len(lengths) or (size + 1) * lengths[high + 1] > self.parallel_size))
+
+            candidates.append(BatchCandidate(low, high, low_take, size, size * max_len - total_len, maximal))
+        return candidates
+
+    def best(self, include=None):
+        """
+        Возвращает наиболее эффективную группу
+        :param include: запрос, который обязательно должен попасть в группу
+        """
+        candidates = self.candidates()
+        if include is not None:
+            idx = self.lengths.index(self.get_len(include))
+            candidates = [candidate for candidate in candidates[idx:] if candidate.low < idx or (
+                    candidate.low == idx and self.buckets[self.lengths[idx]].index(include) < candidate.low_take)]
+        best_key = min(candidate.key() for candidate in candidates)
+        tied = [candidate for candidate in candidates if candidate.key() == best_key]
+        # среди одинаково эффективных групп выбирается группа с самым ранним сроком
+        return min(tied, key=self.earliest_deadline) if len(tied) > 1 else tied[0]
+
+    def pop(self, candidate):
+        """
+        Извлекает запросы группы в порядке возрастания длины
+        """
+        batch = []
+        for idx in range(candidate.low, candidate.high + 1):
+            qlen = self.lengths[idx]
+            bucket = self.buckets[qlen]
+            n_take = candidate.low_take if idx == candidate.low else len(bucket)
+            for _ in range(n_take):
+                batch.append(bucket.popleft())
+            self.count -= n_take
+            self.total_len -= n_take * qlen
+
+        for qlen in self.lengths[candidate.low:candidate.high + 1]:
+            if len(self.buckets[qlen]) == 0:
+                del self.buckets[qlen]
+                self.lengths.remove(qlen)
+        self._candidates = None
+        return batch
+
+    def pop_best(self, include=None):
+        """
+        Извлекает наиболее эффективную группу
+        """
+        return self.pop(self.best(include))
+
+
+class ClassBuckets:
+    """
+    Хранилище запросов, разделённых по классам приоритета, с тем же интерфейсом, что и LengthBuckets.
+
+    Запросы каждого класса хранятся в отдельном LengthBuckets, и группа собирается из запросов одного класса.
+    Класс следующей группы выбирается взвешенным справедливым обслуживанием по количеству ячеек группы
+    """
+    def __init__(self, parallel_size=1000, weights=None):
+        """
+        :param weights: класс приоритета -> вес
+        """
+        self.parallel_size = parallel_size
+        self.share = FairShare(weights)
+        self.classes = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def get_class(task):
+        return task.priority
+
+    def add(self, task):
+        """
+        Добавляет запрос
+        """
+        cls = self.get_class(task)
+        buckets = self.classes.get(cls)
+        if buckets is None:
+            self.share.activate(cls, self.classes)
+            buckets = self.classes[cls] = LengthBuckets(self.parallel_size)
+        buckets.add(task)
+        self.count += 1
+
+    def _discard_empty(self, cls):
+        if len(self.classes[cls]) == 0:
+            del self.classes[cls]
+
+    def remove(self, task):
+        """
+        Удаляет запрос
+        """
+        cls = self.get_class(task)
+        self.classes[cls].remove(task)
+        self.count -= 1
+        self._discard_empty(cls)
+
+    def drop_expired(self, now):
+        """
+        Удаляет запросы с истёкшим сроком
+        :return: количество удалённых запросов
+        """
+        dropped = 0
+        for cls in list(self.classes):
+            dropped += self.classes[cls].drop_expired(now)
+            self._discard_empty(cls)
+        self.count -= dropped
+        return dropped
+
+    def oldest(self):
+        """
+        Возвращает самый старый запрос
+        """
+        return min((buckets.oldest() for buckets in self.classes.values()), key=lambda task: task.time_created)
+
+    def pop_best(self, include=None):
+        """
+        Извлекает наиболее эффективную группу класса, очередь которого подошла
+        :param include: запрос, который обязательно должен попасть в группу; группа собирается из его класса
+        """
+        cls = self.share.pick(self.classes) if include is None else self.get_class(include)
+        batch = self.classes[cls].pop_best(include)
+        self.count -= len(batch)
+        self._discard_empty(cls)
+        self.share.charge(cls, len(batch) * max(len(task.data) for task in batch))
+        return batch
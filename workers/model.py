@@ -1,5 +1,13 @@
 from pipeline import Worker
+from multiprocessing import Process, Value, Array, Lock
+from queue import Empty
 import pickle as pkl
+import numpy as np
+import os
+import signal
+import sys
+import traceback
+from time import time, sleep
 from exceptions import MessagedException
 
 
@@ -10,15 +18,105 @@ class ModelLoadingError(MessagedException):
     pass
 
 
+def batch_cells(batch):
+    """
+    Размер группы после дополнения: количество запросов, умноженное на максимальную длину
+    """
+    return len(batch) * max(len(task.data) for task in batch)
+
+
+class WarmupTask:
+    """
+    Синтетическая задача прогрева модели
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class Warmup:
+    """
+    Прогрев модели после загрузки: применение к синтетическим группам характерных длин,
+    чтобы первые запросы не ждали выделения памяти и ленивой инициализации модели
+    """
+    def __init__(self, lengths=(), batch_size=1, token=0):
+        """
+        :param lengths: длины запросов синтетических групп, по группе на длину
+        :param batch_size: количество запросов в группе
+        :param token: токен, из которого состоят синтетические запросы
+        """
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.token = token
+
+    def batches(self):
+        """
+        Синтетические группы задач
+        """
+        for length in self.lengths:
+            yield [WarmupTask([self.token] * length) for _ in range(self.batch_size)]
+
+
 class ModelApplier(Worker):
     """
     Этап применения модели
     """
-    def __init__(self, model_path):
+    cpu_heavy = True
+    pad_value = -1
+    # как часто ожидающий входных данных этап проверяет, не заменён ли он новым процессом, в секундах
+    drain_check_interval = 0.5
+
+    # состояния процесса этапа
+    LOADING = 0
+    WARMING = 1
+    SERVING = 2
+    FAILED = 3
+
+    def __init__(self, model_path, model=None, latency_estimator=None, warmup=None):
+        """
+        :param model_path: путь к файлу модели; модель загружается в процессе этапа при его запуске
+        :param model: уже загруженная модель, используемая вместо файла до перезагрузки этапа
+        :param latency_estimator: LatencyEstimator, получающий время обработки каждой группы
+        :param warmup: прогрев модели Warmup перед началом обработки, None - без прогрева
+        """
         super(ModelApplier, self).__init__()
-        with open(model_path, 'rb') as f:
+        if model is None and not os.path.isfile(model_path):
+            raise ModelLoadingError('Model file {} does not exist'.format(model_path))
+        self.model_path = model_path
+        self._buffer = None
+        # переиспользуемый буфер обрезанных результатов
+        self._arena = None
+        self.model = model
+        self.latency_estimator = latency_estimator
+        self.warmup = warmup
+        # общий для нескольких моделей ModelScheduler и номер модели в нём, None - без ограничения
+        self.scheduler = None
+        self.model_index = 0
+
+        # при перезагрузке новый процесс этапа загружает модель, пока старый продолжает обработку.
+        # Номер поколения процесса задаётся до его запуска; current - поколение, которое должно обрабатывать
+        # задачи: старый процесс, увидев новое значение, завершает начатое и освобождает serving
+        self.generation = 0
+        self.current = Value('i', 0)
+        self.serving = Lock()
+        # состояние последнего запущенного процесса этапа
+        self.status = Value('i', self.LOADING)
+        # причина неудачной загрузки модели последним запущенным процессом
+        self.error = Array('c', 512)
+        # обрабатывает ли задачи процесс с загруженной и прогретой моделью
+        self.warmed = Value('b', False)
+        # процесс, запускающий процессы этапа; процесс, запущенный при перезагрузке, наследует открытые им
+        # сокеты и не должен оставаться после его завершения
+        self.parent_pid = os.getpid()
+
+    def load_model(self):
+        """
+        Загружает модель из model_path
+        """
+        with open(self.model_path, 'rb') as f:
             try:
-                self.model = pkl.load(f)
+                return pkl.load(f)
             except ModuleNotFoundError as e:
                 raise ModelLoadingError(
                     'Unable to deserialize(unpickle) this model in current environment. Try adding path to {} into PYTHONPATH variable'.format(
@@ -26,19 +124,261 @@ class ModelApplier(Worker):
             except pkl.UnpicklingError:
                 raise ModelLoadingError('Invalid format of the model')
 
+    def check_model(self, model):
+        """
+        Проверяет, подходит ли модель этапу
+        """
+        pass
+
+    def before_start(self):
+        """
+        Загружает и прогревает модель в процессе этапа
+        """
+        if self.model is None:
+            self.model = self.load_model()
+        self.check_model(self.model)
+        if self.warmup is not None:
+            self.status.value = self.WARMING
+            self.warm_up()
+
+    def warm_up(self):
+        """
+        Применяет модель к синтетическим группам
+        """
+        for batch in self.warmup.batches():
+            results = self.apply_arrays(batch) if getattr(self.model, 'supports_arrays', False) \
+                else self.apply_lists(batch)
+            self.trim(*results) if getattr(self.model, 'returns_lengths', False) else self.trim(results)
+
+    def worker(self):
+        """
+        Загружает модель и, дождавшись завершения заменяемого процесса этапа, запускает основной цикл
+        """
+        try:
+            self.before_start()
+        except BaseException as e:
+            message = e.message if isinstance(e, MessagedException) else '{}("{}")'.format(type(e).__name__, e)
+            self.error.value = message.encode('utf-8', errors='replace')[:len(self.error) - 1]
+            self.status.value = self.FAILED
+            traceback.print_exc(file=sys.stderr)
+            return
+        self.current.value = self.generation
+        with self.serving:
+            self.status.value = self.SERVING
+            self.warmed.value = True
+            self.loop()
+            # нагрузка последнего сообщения реплики снимается, так как следующих запросов не будет
+            release = getattr(self._input, 'release', None)
+            if release is not None:
+                release()
+
+    def reloaded_worker(self):
+        """
+        Основной цикл процесса, запущенного при перезагрузке. Процесс создаётся из работающего сервера,
+        поэтому обработчики сигналов сервера заменяются стандартными, чтобы этап останавливался через terminate
+        """
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        self.worker()
+
+    def draining(self):
+        """
+        Заменён ли процесс этапа новым
+        """
+        return self.current.value != self.generation
+
+    def drained(self):
+        """
+        Завершена ли обработка полученных процессом задач
+        """
+        return True
+
+    def running(self):
+        if os.getppid() != self.parent_pid:
+            return False
+        return super(ModelApplier, self).running() and not (self.draining() and self.drained())
+
+    def ready(self):
+        """
+        Обрабатывает ли этап задачи прогретой моделью
+        """
+        return bool(self.warmed.value)
+
+    def reload(self, model_path=None, poll_interval=0.05):
+        """
+        Перезагружает модель без остановки обработки: запускает новый процесс этапа, который загружает
+        и прогревает модель, пока старый процесс обрабатывает задачи, затем старый процесс завершает
+        начатую группу, и задачи переходят к новому
+        :param model_path: путь к новому файлу модели, None - повторно загрузить текущий
+        :raise ModelLoadingError: новый процесс не смог загрузить модель; обработку продолжает старый процесс
+        """
+        previous_path = self.model_path
+        model_path = model_path or previous_path
+        if model_path is None or not os.path.isfile(model_path):
+            raise ModelLoadingError('Model file {} does not exist'.format(model_path))
+        self.model_path = model_path
+        # модель, переданная при создании, заменяется загруженной из файла
+        self.model = None
+        if self.process.pid is None:
+            # этап не запущен и загрузит модель при запуске
+            return
+        self.generation += 1
+        self.status = Value('i', self.LOADING)
+        self.error = Array('c', 512)
+        process = Process(target=self.reloaded_worker)
+        process.daemon = True
+        process.start()
+        try:
+            self.wait_process(process, poll_interval)
+        except ModelLoadingError:
+            process.join()
+            self.model_path = previous_path
+            raise
+        previous, self.process = self.process, process
+        previous.join()
+
+    def wait_loaded(self, poll_interval=0.05):
+        """
+        Ожидает, пока запущенный процесс этапа загрузит и прогреет модель
+        :raise ModelLoadingError: модель не загружена
+        """
+        self.wait_process(self.process, poll_interval)
+
+    def wait_process(self, process, poll_interval):
+        """
+        Ожидает, пока процесс этапа process начнёт обработку
+        :raise ModelLoadingError: процесс не смог загрузить модель
+        """
+        while self.status.value in (self.LOADING, self.WARMING) and process.is_alive():
+            sleep(poll_interval)
+        if self.status.value != self.SERVING:
+            reason = self.error.value.decode('utf-8', errors='replace') or 'the model process exited'
+            raise ModelLoadingError('Unable to load the model from {}: {}'.format(self.model_path, reason))
+
     def job(self):
         """
         Применяет модель к группе данных
         """
-        batch = self.input.get()
+        try:
+            message = self.input.get(timeout=self.drain_check_interval)
+        except Empty:
+            return
+        batch = self.drop_expired(message)
+        if not batch:
+            return
+        if self.scheduler is not None:
+            self.scheduler.acquire(self.model_index, batch_cells(batch) * (1 + self.input.qsize()))
+        started = time()
+        try:
+            if getattr(self.model, 'supports_arrays', False):
+                results = self.apply_arrays(batch)
+            else:
+                results = self.apply_lists(batch)
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.release(self.model_index, time() - started)
+        results = self.trim(*results) if getattr(self.model, 'returns_lengths', False) else self.trim(results)
+        if self.latency_estimator is not None:
+            self.latency_estimator.observe(batch_cells(batch), time() - started)
+
+        for i, result in enumerate(results):
+            batch[i].data = result
+        self.output.put(batch)
+
+    def apply_lists(self, batch):
+        """
+        Применяет модель к группе, дополненной до одной длины списками
+        """
         data = list(map(lambda task: task.data, batch))
         max_len = max(map(lambda x: len(x), data))
 
         def pad_sequence(seq):
-            return seq + [-1] * (max_len - len(seq))
+            return list(seq) + [self.pad_value] * (max_len - len(seq))
 
         data = list(map(pad_sequence, data))
 
-        for i, result in enumerate(self.model.process(data)):
-            batch[i].data = result
-        self.output.put(batch)
+        return self.model.process(data)
+
+    def apply_arrays(self, batch):
+        """
+        Применяет модель к группе, записанной в переиспользуемую матрицу np.int32
+        """
+        lengths = np.fromiter((len(task.data) for task in batch), dtype=np.int32, count=len(batch))
+        max_len = int(lengths.max())
+
+        size = len(batch) * max_len
+        if self._buffer is None or self._buffer.size < size:
+            self._buffer = np.empty(max(size, 2 * (0 if self._buffer is None else self._buffer.size)), dtype=np.int32)
+        data = self._buffer[:size].reshape(len(batch), max_len)
+        data.fill(self.pad_value)
+        for row, task, length in zip(data, batch, lengths):
+            row[:length] = task.data
+
+        mask = np.arange(max_len) < lengths[:, None]
+        return self.model.process(data, lengths=lengths, mask=mask)
+
+    def trim(self, results, lengths=None):
+        """
+        Обрезает результаты модели до настоящей длины, чтобы дополнение не передавалось следующим этапам.
+        Длина матрицы результатов находится одним проходом по всей матрице: до первого отрицательного значения
+        или eos_id модели. Обрезанные результаты собираются в переиспользуемый буфер
+        :param results: матрица (batch, out_len) или список последовательностей
+        :param lengths: длины результатов, возвращённые моделью
+        :return: список результатов; если выходная очередь копирует данные при отправке - срезы буфера,
+            иначе списки, не ссылающиеся на буферы этапа
+        """
+        rows = results
+        if not isinstance(results, np.ndarray):
+            try:
+                results = np.asarray(results)
+            except ValueError:
+                # последовательности разной длины
+                results = None
+        if results is None or results.ndim != 2 or results.dtype.kind not in 'iu':
+            return [self.trim_row(row, None if lengths is None else lengths[i]) for i, row in enumerate(rows)]
+
+        width = results.shape[1]
+        if lengths is None:
+            stop = results < 0
+            eos_id = getattr(self.model, 'eos_id', None)
+            if eos_id is not None:
+                stop |= results == eos_id
+            lengths = np.where(stop.any(axis=1), stop.argmax(axis=1), width)
+        lengths = np.minimum(np.asarray(lengths, dtype=np.int64), width)
+        ends = np.cumsum(lengths)
+        total = int(ends[-1]) if len(ends) else 0
+
+        if self._arena is None or self._arena.size < total:
+            self._arena = np.empty(max(total, 2 * (0 if self._arena is None else self._arena.size)), dtype=np.int32)
+        tokens = self._arena[:total]
+        tokens[:] = results[np.arange(width) < lengths[:, None]]
+
+        starts = (ends - lengths).tolist()
+        ends = ends.tolist()
+        if getattr(self._output, 'copies_on_put', False):
+            return [tokens[start:end] for start, end in zip(starts, ends)]
+        values = tokens.tolist()
+        return [values[start:end] for start, end in zip(starts, ends)]
+
+    def trim_row(self, result, length=None):
+        """
+        Обрезает один результат модели до настоящей длины
+        """
+        if isinstance(result, np.ndarray):
+            row = result
+        else:
+            try:
+                row = np.asarray(result)
+            except ValueError:
+                return result
+        if row.ndim != 1 or row.dtype.kind not in 'iu':
+            return result.tolist() if isinstance(result, np.ndarray) else result
+        if length is None:
+            stop = row < 0
+            eos_id = getattr(self.model, 'eos_id', None)
+            if eos_id is not None:
+                stop |= row == eos_id
+            length = int(stop.argmax()) if stop.any() else len(row)
+        # результаты не должны ссылаться на буферы модели
+        return row[:length].tolist()
@@ -1,28 +1,65 @@
 from pipeline import Worker
+from text_encoders import CharEncoder
+from streaming import IncrementalDecoder, split_chunks
 
 
 class Tokenizer(Worker):
     """
-    Этап токенизации
+    Этап токенизации.
+    Забирает до max_tasks ожидающих задач, кодирует их строки одним вызовом и отправляет одним сообщением
     """
+    def __init__(self, encoder=None, max_tasks=64, wait=0.0003):
+        """
+        :param encoder: кодировщик строк (text_encoders), по умолчанию посимвольный
+        :param max_tasks: максимальное количество задач в сообщении
+        :param wait: сколько секунд после первой задачи ждать следующих
+        """
+        super(Tokenizer, self).__init__()
+        self.encoder = encoder or CharEncoder()
+        self.max_tasks = max_tasks
+        self.wait = wait
+
     def job(self):
         """
         Выполняет токенизацию
         """
-        task = self.input.get()
-        task.data = list(map(lambda ch: ord(ch), task.data))
-        self.output.put(task)
+        tasks = self.drop_expired(self.get_tasks(self.max_tasks, self.wait))
+        if not tasks:
+            return
+        for task, tokens in zip(tasks, self.encoder.encode_batch([task.data for task in tasks])):
+            task.data = tokens
+        self.output.put(tasks)
 
 
 class Detokenizer(Worker):
     """
-    Этап детокенизации
+    Этап детокенизации.
+    Получает группы целиком от этапа модели, а также забирает уже ожидающие задачи, пока их меньше max_tasks;
+    токены декодируются одним вызовом, а результаты отправляются одним сообщением.
+    Части результатов (StreamChunk) декодируются по мере поступления и отправляются перед задачами
     """
+    def __init__(self, encoder=None, max_tasks=64, wait=0):
+        """
+        :param encoder: кодировщик строк (text_encoders), по умолчанию посимвольный
+        :param max_tasks: максимальное количество задач в сообщении
+        :param wait: сколько секунд после первой задачи ждать следующих
+        """
+        super(Detokenizer, self).__init__()
+        self.encoder = encoder or CharEncoder()
+        self.max_tasks = max_tasks
+        self.wait = wait
+        self.streams = IncrementalDecoder(self.encoder)
+
     def job(self):
         """
         Выполняет детокенизацию
         """
-        task = self.input.get()
-        task.data = ''.join(map(lambda ch: chr(ch), filter(lambda ch: ch >= 0, task.data)))
-        self.output.put(task)
-
+        chunks, tasks = split_chunks(self.drop_expired(self.get_tasks(self.max_tasks, self.wait)))
+        self.streams.expire(self.clock())
+        self.streams.decode(chunks)
+        if tasks:
+            for task, text in zip(tasks, self.encoder.decode_batch([task.data for task in tasks])):
+                task.data = text
+            self.streams.finish(tasks)
+        if chunks or tasks:
+            self.output.put(chunks + tasks)